@@ -1 +1,25 @@
-from gendb_app import app
\ No newline at end of file
+from gendb_app import app, db
+from gendb_app.marker_cache import marker_cache
+from gendb_app.individual_index import individual_index
+
+
+# WSGI application factory for production servers, e.g.
+#   gunicorn -c gunicorn.conf.py "app:create_app()"
+# The app is warmed up before it is returned. With a pre-forking server that loads the
+# app before forking, the warmed caches are then shared by every worker.
+def create_app():
+    warm_up()
+    return app
+
+
+# Loads the marker catalogue and individual index and compiles every template, then
+# closes the database connections used, so that no connection is inherited by forked
+# workers
+def warm_up():
+    with app.app_context():
+        marker_cache.refresh()
+        individual_index.refresh()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        db.session.remove()
+    db.engine.dispose()
@@ -0,0 +1,123 @@
+# Deterministic synthetic upload files for the benchmarks, in the formats accepted by
+# the upload routes. The same seed and scale always give byte for byte the same files.
+#
+# Usage (from the gendb directory), writing the four files to a directory:
+#   python benchmarks/datagen.py --scale small --out /tmp/gendb_data
+
+import argparse
+import os
+import random
+
+ALLELES = 'ACGT'
+MISSING = 'x'
+
+# individuals, markers, phenotypes
+SCALES = {
+    'tiny': (50, 200, 5),
+    'small': (200, 2000, 10),
+    'medium': (1000, 10000, 20),
+    'large': (5000, 50000, 50),
+}
+
+
+class Dataset(object):
+    def __init__(self, num_individuals, num_markers, num_phenotypes, seed=1, missing_rate=0.01):
+        self.num_individuals = num_individuals
+        self.num_markers = num_markers
+        self.num_phenotypes = num_phenotypes
+        self.seed = seed
+        self.missing_rate = missing_rate
+
+        rand = random.Random(seed)
+        self.markers = make_markers(rand, num_markers)
+        self.individuals = make_individuals(rand, num_individuals)
+
+    # Each file is a list of CSV lines, built on demand
+    def markers_csv(self):
+        return ["{},{},{},2,{},{}\n".format(name, chromosome, position, a, b)
+                for name, chromosome, position, (a, b) in self.markers]
+
+    def individuals_csv(self):
+        return ["{},{}\n".format(full_id, gender) for full_id, gender, _, _ in self.individuals]
+
+    def phenotypes_csv(self):
+        rand = random.Random(self.seed + 1)
+        names = ["pheno{}".format(index + 1) for index in range(self.num_phenotypes)]
+        lines = ["ID," + ",".join(names) + "\n"]
+        for full_id, _, _, _ in self.individuals:
+            values = [MISSING if rand.random() < self.missing_rate else "{:.2f}".format(rand.gauss(100, 15))
+                      for _ in names]
+            lines.append(full_id + "," + ",".join(values) + "\n")
+        return lines
+
+    # Founders draw their alleles from the marker's frequency, children inherit one
+    # allele from each parent so the file has no Mendelian errors
+    def genotypes_csv(self):
+        rand = random.Random(self.seed + 2)
+        lines = []
+        for name, _, _, alleles in self.markers:
+            frequency = rand.uniform(0.05, 0.95)
+            calls = {}
+            for full_id, _, father, mother in self.individuals:
+                if father is not None:
+                    call = (rand.choice(calls[father]), rand.choice(calls[mother]))
+                else:
+                    call = tuple(alleles[0] if rand.random() < frequency else alleles[1] for _ in range(2))
+                calls[full_id] = call
+
+                if rand.random() < self.missing_rate:
+                    lines.append("{},{},{},{}\n".format(full_id, name, MISSING, MISSING))
+                else:
+                    lines.append("{},{},{},{}\n".format(full_id, name, call[0], call[1]))
+        return lines
+
+
+def make_markers(rand, num_markers):
+    markers = []
+    per_chromosome = max(num_markers // 22, 1)
+    for index in range(num_markers):
+        chromosome = min(index // per_chromosome + 1, 22)
+        position = (index % per_chromosome + 1) * 1000 + rand.randint(0, 999)
+        alleles = tuple(sorted(rand.sample(ALLELES, 2)))
+        markers.append(("rs{}".format(1000000 + index), chromosome, position, alleles))
+    return markers
+
+
+# (full ID, gender, father ID, mother ID) in families of a father, mother and one to
+# three children, spread across a handful of clinics
+def make_individuals(rand, num_individuals):
+    individuals = []
+    family = 0
+    while len(individuals) < num_individuals:
+        family += 1
+        clinic = "C{}".format(family % 5 + 1)
+        prefix = "{}_F{:05d}_".format(clinic, family)
+        father, mother = prefix + "1", prefix + "2"
+        individuals.append((father, 1, None, None))
+        individuals.append((mother, 2, None, None))
+        for member in range(3, 3 + rand.randint(1, 3)):
+            individuals.append((prefix + str(member), rand.randint(1, 2), father, mother))
+    # Parents come before their children, so cutting the list never orphans a child
+    return individuals[:num_individuals]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic GenDB upload files")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', required=True, help="Directory to write the files to")
+    args = parser.parse_args()
+
+    dataset = Dataset(*SCALES[args.scale], seed=args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    for name, lines in (('markers.csv', dataset.markers_csv()),
+                        ('individuals.csv', dataset.individuals_csv()),
+                        ('phenotypes.csv', dataset.phenotypes_csv()),
+                        ('genotypes.csv', dataset.genotypes_csv())):
+        with open(os.path.join(args.out, name), 'w') as csv_file:
+            csv_file.writelines(lines)
+        print("{:<16} {:>10,} lines".format(name, len(lines)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Times the pages with cached fragments (the marker, member and user tables) with the
+# fragment cache off, in memory only and in memory backed by a directory, and checks
+# that a cached page is the same as one rendered from scratch. Then checks that adding
+# markers, members and users shows on the next request. Runs against an in-memory
+# SQLite database.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/fragment_cache.py --scale small
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+import config
+from datagen import Dataset, SCALES
+
+PROJECT_ID = 1
+EXTRA_USERS = 500
+
+PATHS = ['/markers', '/project/{}'.format(PROJECT_ID), '/admin/users']
+
+
+def configure():
+    config.Config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    config.Config.WTF_CSRF_ENABLED = False
+    config.Config.SNAPSHOT_ENABLED = False
+    # Pages are compared as sent
+    config.Config.COMPRESS_ENABLED = False
+    config.Config.HASH_METHOD = 'pbkdf2:sha256:1000'
+    config.Config.SALT_LENGTH = 8
+
+
+def upload(client, url, field, lines):
+    body = "".join(lines).encode('utf-8')
+    client.post(url, data={field: (BytesIO(body), field + '.csv')}, content_type='multipart/form-data')
+
+
+def get_page(client, path):
+    response = client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError("{} gave {}".format(path, response.status_code))
+    return response.get_data(as_text=True)
+
+
+def time_page(client, path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        get_page(client, path)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fragment cache of the heavy templates")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    configure()
+    from gendb_app import app, db
+    from gendb_app.models import User
+    from gendb_app.fragment_cache import fragment_cache
+
+    dataset = Dataset(*SCALES[args.scale])
+    db.create_all()
+    user = User(email='bench@example.com', full_name='Benchmark', is_sys_admin=True)
+    user.set_password('bench')
+    db.session.add(user)
+    for number in range(EXTRA_USERS):
+        extra = User(email='user{}@example.com'.format(number), full_name='User {}'.format(number),
+                     is_sys_admin=False, password_hash='-')
+        db.session.add(extra)
+    db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    client.post('/add_project', data={'title': 'Benchmark', 'desc': 'Synthetic data'})
+    for number in range(0, EXTRA_USERS, 5):
+        client.post('/add_member/{}'.format(PROJECT_ID), data={'email': 'user{}@example.com'.format(number)})
+    upload(client, '/markers/upload', 'markers', dataset.markers_csv())
+    # Read the flashed messages
+    client.get('/index')
+
+    cache_dir = tempfile.mkdtemp(prefix='gendb_fragments_')
+    setups = [('off', False, None), ('memory', True, None), ('directory', True, cache_dir)]
+    print("{} markers, {} users".format(dataset.num_markers, EXTRA_USERS + 1))
+    print("  {:<16} {}".format("page", "".join("{:>14}".format(name + " ms") for name, _, _ in setups)))
+
+    ok = True
+    pages = {}
+    timings = {path: [] for path in PATHS}
+    for name, enabled, directory in setups:
+        app.config['FRAGMENT_CACHE_ENABLED'] = enabled
+        app.config['FRAGMENT_CACHE_DIR'] = directory
+        fragment_cache.clear()
+        for path in PATHS:
+            # The first request fills the cache
+            page = get_page(client, path)
+            pages.setdefault(path, page)
+            if page != pages[path] or get_page(client, path) != pages[path]:
+                print("  {} differs with the cache {}".format(path, name))
+                ok = False
+            timings[path].append(time_page(client, path, args.repeat))
+
+    for path in PATHS:
+        print("  {:<16} {}".format(path, "".join("{:>14.2f}".format(seconds * 1000) for seconds in timings[path])))
+
+    # Another worker process has its own memory, the directory should still be shared
+    fragment_cache.clear()
+    hits, misses = fragment_cache.hits, fragment_cache.misses
+    get_page(client, '/markers')
+    shared = fragment_cache.hits > hits and fragment_cache.misses == misses
+    ok &= shared
+    print("  from the directory after clearing memory: {}".format("hit" if shared else "MISS"))
+
+    # Every change should show on the next request
+    upload(client, '/markers/upload', 'markers', ["rs_fragment_check,1,1,2,A,G\n"])
+    client.post('/add_member/{}'.format(PROJECT_ID), data={'email': 'user1@example.com'})
+    client.post('/add_user', data={'email': 'fragment@example.com', 'full_name': 'Fragment Check',
+                                   'password': 'fragment'})
+    client.get('/index')
+    for path, text in (('/markers', 'rs_fragment_check'), ('/project/{}'.format(PROJECT_ID), 'user1@example.com'),
+                       ('/admin/users', 'fragment@example.com')):
+        shown = text in get_page(client, path)
+        ok &= shown
+        print("  after the change {:<14} {}".format(path, "shown" if shown else "NOT SHOWN"))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Times the individual search index on synthetic individual IDs spread over several
+# projects: building the index, reloading one project after an upload's worth of
+# individuals is added to it, and exact and prefix lookups of random IDs. No database is
+# used, the individuals are loaded into the index directly.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/individual_search.py --individuals 2000000 --projects 20
+
+import argparse
+import os
+import random
+import sys
+import time
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+from gendb_app.individual_index import IndividualIndex, full_ind_id
+
+MEMBERS_PER_FAMILY = 5
+CLINICS = 50
+
+
+# (project_id, clinic_id, family_id, member_id, ind_id) rows, in individual ID order
+def individual_rows(num_individuals, num_projects, first_id=1):
+    for offset in range(num_individuals):
+        ind_id = first_id + offset
+        family = ind_id // MEMBERS_PER_FAMILY
+        yield (family % num_projects + 1, 'C{:03d}'.format(family % CLINICS), 'F{:07d}'.format(family),
+               ind_id % MEMBERS_PER_FAMILY + 1, ind_id)
+
+
+def percentile(times, fraction):
+    return sorted(times)[min(int(len(times) * fraction), len(times) - 1)] * 1000
+
+
+def time_searches(index, project_ids, queries, limit):
+    times = []
+    found = 0
+    for query in queries:
+        start = time.perf_counter()
+        found += len(index.search(project_ids, query, limit))
+        times.append(time.perf_counter() - start)
+    return times, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Individual search index build and lookup times")
+    parser.add_argument('--individuals', type=int, default=1000000)
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--upload', type=int, default=10000, help="Individuals added after the build")
+    parser.add_argument('--searches', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=100, help="Most results per search")
+    args = parser.parse_args()
+
+    index = IndividualIndex()
+    project_ids = list(range(1, args.projects + 1))
+    start = time.perf_counter()
+    index.load(project_ids, individual_rows(args.individuals, args.projects))
+    print("Built index of {:,} individuals in {:.2f} s".format(args.individuals, time.perf_counter() - start))
+
+    # An individuals upload into a project changes its individuals version, so the whole
+    # project is reloaded
+    rows = [row for row in individual_rows(args.individuals + args.upload * args.projects, args.projects)
+            if row[0] == 1]
+    start = time.perf_counter()
+    index.load([1], rows)
+    print("Reloaded a project of {:,} individuals after adding {:,} in {:.2f} s".format(
+        len(rows), args.upload, time.perf_counter() - start))
+
+    rng = random.Random(0)
+    rows = list(individual_rows(args.searches, args.projects, first_id=rng.randrange(args.individuals)))
+    exact = [full_ind_id(clinic, family, member) for _, clinic, family, member, _ in rows]
+    families = [full_ind_id(clinic, family, '')[:-1] for _, clinic, family, _, _ in rows]
+    clinics = ['C{:03d}'.format(rng.randrange(CLINICS)) for _ in range(args.searches)]
+
+    for name, queries in (('exact ID', exact), ('family prefix', families), ('clinic prefix', clinics)):
+        times, found = time_searches(index, project_ids, queries, args.limit)
+        print("  {:<14} {:>6} searches  {:>8.1f} results each   p50 {:>7.3f} ms   p99 {:>7.3f} ms".format(
+            name, len(queries), found / len(queries), percentile(times, 0.5), percentile(times, 0.99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Times the upload file handlers and the full upload routes on synthetic data, against
+# an in-memory SQLite database. Each stage reports rows per second, the number of SQL
+# statements executed and the peak resident memory of the process so far.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/ingest.py --scale small --json before.json
+#   python benchmarks/ingest.py --scale small --json after.json --compare before.json
+#   python benchmarks/ingest.py --individuals 500 --markers 5000 --staging --compress
+#
+# Results saved with --json record the commit they were run on, so runs of different
+# commits can be compared with --compare.
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from io import StringIO, BytesIO
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+import config
+from datagen import Dataset, SCALES
+
+PROJECT_ID = 1
+
+
+def configure(staging, chunked=False):
+    config.Config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    config.Config.WTF_CSRF_ENABLED = False
+    config.Config.UPLOAD_STAGING = staging
+    config.Config.UPLOAD_CHUNKED = chunked
+    # Only the benchmark user's password is hashed, keep it quick
+    config.Config.HASH_METHOD = 'pbkdf2:sha256:1000'
+    config.Config.SALT_LENGTH = 8
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=GENDB_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+class Benchmark(object):
+    def __init__(self, app, db, counter):
+        self.app = app
+        self.db = db
+        self.counter = counter
+        self.results = []
+
+    def measure(self, stage, rows, fn):
+        queries = self.counter.count
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+
+        result = {
+            'stage': stage,
+            'rows': rows,
+            'seconds': round(seconds, 4),
+            'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+            'queries': self.counter.count - queries,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        self.results.append(result)
+        print("  {:<24} {:>10,} rows {:>9.3f} s {:>12,.0f} rows/s {:>9,} queries {:>8.1f} MB".format(
+            stage, rows, seconds, result['rows_per_sec'] or 0, result['queries'], result['peak_rss_mb']))
+
+    # Runs a csv_to_* handler alone, nothing it returns is stored
+    def handler(self, stage, handler, lines, *args):
+        text = "".join(lines)
+
+        def run():
+            error, result = handler(csv.reader(StringIO(text)), *args)
+            if error:
+                raise RuntimeError("{} found errors in the generated file".format(stage))
+
+        with self.app.app_context():
+            self.measure(stage, data_rows(lines, stage), run)
+            self.db.session.rollback()
+
+    # Posts the file to an upload route as a browser would
+    def route(self, stage, client, url, field, lines, compress):
+        body = "".join(lines).encode('utf-8')
+        name = field + '.csv'
+        if compress:
+            body = gzip.compress(body)
+            name += '.gz'
+
+        def run():
+            response = client.post(url, data={field: (BytesIO(body), name)},
+                                   content_type='multipart/form-data')
+            location = response.headers.get('Location', '')
+            if response.status_code != 302 or 'upload_report' in location:
+                raise RuntimeError("{} upload failed: {} {}".format(stage, response.status_code, location))
+
+        self.measure(stage, data_rows(lines, stage), run)
+
+
+def data_rows(lines, stage):
+    return len(lines) - 1 if 'phenotypes' in stage else len(lines)
+
+
+def run_benchmark(dataset, compress):
+    from gendb_app import app, db
+    from gendb_app.models import User
+    from gendb_app.filehandling.handling import csv_to_markers, csv_to_individuals, csv_to_phenotypes, \
+        csv_to_genotypes
+
+    db.create_all()
+    user = User(email='bench@example.com', full_name='Benchmark', is_sys_admin=True)
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    client.post('/add_project', data={'title': 'Benchmark', 'desc': 'Synthetic data'})
+
+    bench = Benchmark(app, db, QueryCounter(db.engine))
+    markers = dataset.markers_csv()
+    individuals = dataset.individuals_csv()
+    phenotypes = dataset.phenotypes_csv()
+    genotypes = dataset.genotypes_csv()
+
+    # Each handler runs against the data uploaded by the stages before it
+    bench.handler('csv_to_markers', csv_to_markers, markers)
+    bench.route('upload_markers', client, '/markers/upload', 'markers', markers, compress)
+    bench.handler('csv_to_individuals', csv_to_individuals, individuals, PROJECT_ID)
+    bench.route('upload_individuals', client, '/project/{}/upload/individuals'.format(PROJECT_ID),
+                'individuals', individuals, compress)
+    bench.handler('csv_to_phenotypes', csv_to_phenotypes, phenotypes, PROJECT_ID)
+    bench.route('upload_phenotypes', client, '/project/{}/upload/phenotypes'.format(PROJECT_ID),
+                'phenotypes', phenotypes, compress)
+    bench.handler('csv_to_genotypes', csv_to_genotypes, genotypes, PROJECT_ID)
+    bench.route('upload_genotypes', client, '/project/{}/upload/genotypes'.format(PROJECT_ID),
+                'genotypes', genotypes, compress)
+
+    return bench.results
+
+
+def compare(results, previous):
+    before = {result['stage']: result for result in previous['results']}
+    print("Compared with {} ({}):".format(previous.get('commit'), previous.get('created')))
+    for result in results:
+        old = before.get(result['stage'])
+        if old is None or not old['rows_per_sec'] or not result['rows_per_sec']:
+            continue
+        print("  {:<24} {:>12,.0f} -> {:>12,.0f} rows/s  x{:.2f}   queries {:>9,} -> {:>9,}".format(
+            result['stage'], old['rows_per_sec'], result['rows_per_sec'],
+            result['rows_per_sec'] / old['rows_per_sec'], old['queries'], result['queries']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload handler and route throughput")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--individuals', type=int, help="Overrides the scale")
+    parser.add_argument('--markers', type=int, help="Overrides the scale")
+    parser.add_argument('--phenotypes', type=int, help="Overrides the scale")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--staging', action='store_true', help="Upload through the staging table ingest")
+    parser.add_argument('--chunked', action='store_true', help="Commit uploads a chunk of rows at a time")
+    parser.add_argument('--compress', action='store_true', help="Upload gzip compressed files")
+    parser.add_argument('--json', help="Write the results to this file as JSON")
+    parser.add_argument('--compare', help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    num_individuals, num_markers, num_phenotypes = SCALES[args.scale]
+    dataset = Dataset(args.individuals or num_individuals, args.markers or num_markers,
+                      args.phenotypes or num_phenotypes, seed=args.seed)
+
+    configure(args.staging, args.chunked)
+    print("{} individuals, {} markers, {} phenotypes{}{}".format(
+        dataset.num_individuals, dataset.num_markers, dataset.num_phenotypes,
+        ", staging ingest" if args.staging else "", ", chunked commits" if args.chunked else "",
+        ", gzip uploads" if args.compress else ""))
+    results = run_benchmark(dataset, args.compress)
+
+    report = {
+        'benchmark': 'ingest',
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'individuals': dataset.num_individuals,
+        'markers': dataset.num_markers,
+        'phenotypes': dataset.num_phenotypes,
+        'seed': args.seed,
+        'staging': args.staging,
+        'chunked': args.chunked,
+        'compress': args.compress,
+        'results': results,
+    }
+
+    if args.compare:
+        with open(args.compare) as json_file:
+            compare(results, json.load(json_file))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# Serves a synthetic project with `flask run` and with Gunicorn in turn, and measures
+# the throughput and latency of concurrent logged in users browsing it. The data is
+# held in a SQLite database file created for the run. The users run on the same machine
+# as the server, so the gain from more workers is bounded by the spare CPU cores.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/load.py --scale tiny --users 16 --seconds 20
+#   python benchmarks/load.py --servers gunicorn --workers 8 --threads 4
+
+import argparse
+import http.cookiejar
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from io import BytesIO
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+from datagen import Dataset, SCALES
+
+EMAIL = 'load@example.com'
+PASSWORD = 'load'
+PROJECT_ID = 1
+
+# Pages each user requests in turn
+PATHS = ['/index', '/project/{}'.format(PROJECT_ID), '/markers', '/project/{}/qc/report'.format(PROJECT_ID)]
+
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+# Creates the database and uploads the dataset through the routes, in this process
+def create_database(database_url, dataset):
+    os.environ['DATABASE_URL'] = database_url
+    import config
+    config.Config.WTF_CSRF_ENABLED = False
+    from gendb_app import app, db
+    from gendb_app.models import User
+
+    db.create_all()
+    user = User(email=EMAIL, full_name='Load test', is_sys_admin=True)
+    user.set_password(PASSWORD)
+    db.session.add(user)
+    db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'email': EMAIL, 'password': PASSWORD})
+    client.post('/add_project', data={'title': 'Load test', 'desc': 'Synthetic data'})
+    for url, field, lines in (('/markers/upload', 'markers', dataset.markers_csv()),
+                              ('/project/{}/upload/individuals', 'individuals', dataset.individuals_csv()),
+                              ('/project/{}/upload/phenotypes', 'phenotypes', dataset.phenotypes_csv()),
+                              ('/project/{}/upload/genotypes', 'genotypes', dataset.genotypes_csv())):
+        body = "".join(lines).encode('utf-8')
+        client.post(url.format(PROJECT_ID), data={field: (BytesIO(body), field + '.csv')},
+                    content_type='multipart/form-data')
+    client.post('/project/{}/qc/run'.format(PROJECT_ID))
+    db.session.remove()
+    db.engine.dispose()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(server, port, args):
+    if server == 'flask':
+        return [sys.executable, '-m', 'flask', 'run', '--port', str(port)]
+    return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{}'.format(port),
+            '--workers', str(args.workers), '--threads', str(args.threads),
+            'app:create_app()']
+
+
+def wait_for_server(base_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited with code {}".format(process.returncode))
+        try:
+            urllib.request.urlopen(base_url + '/login', timeout=1).close()
+            return
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start within {} seconds".format(timeout))
+
+
+# One user's session, logged in through the login form
+class User(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+        page = self.get('/login')
+        token = CSRF_PATTERN.search(page)
+        data = {'email': EMAIL, 'password': PASSWORD}
+        if token:
+            data['csrf_token'] = token.group(1)
+        with self.opener.open(base_url + '/login', urllib.parse.urlencode(data).encode()) as response:
+            if not response.geturl().endswith('/index'):
+                raise RuntimeError("Login failed")
+
+    def get(self, path):
+        with self.opener.open(self.base_url + path, timeout=60) as response:
+            return response.read().decode('utf-8')
+
+
+def run_load(base_url, num_users, seconds):
+    users = [User(base_url) for _ in range(num_users)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    stop = start + seconds
+
+    def browse(user, offset):
+        times = []
+        failed = 0
+        index = offset
+        while time.perf_counter() < stop:
+            request_start = time.perf_counter()
+            try:
+                user.get(PATHS[index % len(PATHS)])
+                times.append(time.perf_counter() - request_start)
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                failed += 1
+            index += 1
+        with lock:
+            latencies.extend(times)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=browse, args=(user, offset)) for offset, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'p95': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+    }
+
+
+def benchmark_server(server, database_url, args):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, FLASK_APP='app')
+    process = subprocess.Popen(server_command(server, port, args), cwd=GENDB_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        base_url = 'http://127.0.0.1:{}'.format(port)
+        wait_for_server(base_url, process)
+        return run_load(base_url, args.users, args.seconds)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent browsing throughput of flask run and Gunicorn")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='tiny')
+    parser.add_argument('--users', type=int, default=16, help="Concurrent users")
+    parser.add_argument('--seconds', type=float, default=20, help="Length of each run")
+    parser.add_argument('--servers', nargs='+', choices=['flask', 'gunicorn'], default=['flask', 'gunicorn'])
+    parser.add_argument('--workers', type=int, default=4, help="Gunicorn worker processes")
+    parser.add_argument('--threads', type=int, default=4, help="Gunicorn threads per worker")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='gendb_load_')
+    database_url = 'sqlite:///' + os.path.join(directory, 'gendb.db')
+    print("Creating the {} dataset in {}".format(args.scale, directory))
+    create_database(database_url, Dataset(*SCALES[args.scale]))
+
+    results = {}
+    for server in args.servers:
+        result = results[server] = benchmark_server(server, database_url, args)
+        print("  {:<10} {:>8,} requests {:>6} errors {:>9.1f} req/s   p50 {:>8.1f} ms   p95 {:>8.1f} ms".format(
+            server, result['requests'], result['errors'], result['requests_per_sec'],
+            result['p50'] or 0, result['p95'] or 0))
+
+    if 'flask' in results and 'gunicorn' in results and results['flask']['requests_per_sec']:
+        print("Gunicorn throughput x{:.2f} of flask run".format(
+            results['gunicorn']['requests_per_sec'] / results['flask']['requests_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
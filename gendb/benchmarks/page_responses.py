@@ -0,0 +1,128 @@
+# Times the large pages and downloads of a synthetic project three ways: a first
+# request, the browser asking again with the ETag and Last-Modified of its copy, and a
+# request accepting gzip. Checks that a repeated request gets 304 Not Modified, that
+# the compressed body decompresses to the same bytes, and that changing the project's
+# data gives its pages a new ETag. Runs against an in-memory SQLite database.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/page_responses.py --scale small
+
+import argparse
+import gzip
+import os
+import sys
+import time
+from io import BytesIO
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+import config
+from datagen import Dataset, SCALES
+
+PROJECT_ID = 1
+
+PATHS = ['/markers', '/project/{}'.format(PROJECT_ID), '/admin/sys_logs', '/admin/proj_logs',
+         '/project/{}/qc/report'.format(PROJECT_ID), '/project/{}/export/ped'.format(PROJECT_ID)]
+
+
+def configure():
+    config.Config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    config.Config.WTF_CSRF_ENABLED = False
+    config.Config.SNAPSHOT_ENABLED = False
+    config.Config.HASH_METHOD = 'pbkdf2:sha256:1000'
+    config.Config.SALT_LENGTH = 8
+
+
+def upload(client, url, field, lines):
+    body = "".join(lines).encode('utf-8')
+    client.post(url.format(PROJECT_ID), data={field: (BytesIO(body), field + '.csv')},
+                content_type='multipart/form-data')
+
+
+def timed_get(client, path, headers=None):
+    start = time.perf_counter()
+    response = client.get(path, headers=headers or {})
+    body = response.get_data()
+    return response, body, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conditional GET and compression of pages and downloads")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    configure()
+    from gendb_app import app, db
+    from gendb_app.models import User
+
+    dataset = Dataset(*SCALES[args.scale])
+    db.create_all()
+    user = User(email='bench@example.com', full_name='Benchmark', is_sys_admin=True)
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    client.post('/add_project', data={'title': 'Benchmark', 'desc': 'Synthetic data'})
+    upload(client, '/markers/upload', 'markers', dataset.markers_csv())
+    upload(client, '/project/{}/upload/individuals', 'individuals', dataset.individuals_csv())
+    upload(client, '/project/{}/upload/genotypes', 'genotypes', dataset.genotypes_csv())
+    client.post('/project/{}/qc/run'.format(PROJECT_ID))
+    # Read the flashed messages, pages showing them are never answered with 304
+    client.get('/index')
+
+    print("{} individuals, {} markers".format(dataset.num_individuals, dataset.num_markers))
+    print("  {:<28} {:>9} {:>9} {:>11} {:>11} {:>8}".format(
+        "path", "full ms", "304 ms", "bytes", "gzip bytes", ""))
+    ok = True
+    etags = {}
+    for path in PATHS:
+        full = not_modified = compressed = None
+        for _ in range(args.repeat):
+            response, body, seconds = timed_get(client, path)
+            full = min(full or seconds, seconds)
+
+            validators = {}
+            if response.headers.get('ETag'):
+                validators['If-None-Match'] = response.headers['ETag']
+            if response.headers.get('Last-Modified'):
+                validators['If-Modified-Since'] = response.headers['Last-Modified']
+            again, _, seconds = timed_get(client, path, validators)
+            not_modified = min(not_modified or seconds, seconds)
+
+            zipped, zipped_body, _ = timed_get(client, path, {'Accept-Encoding': 'gzip'})
+            compressed = len(zipped_body)
+
+        etags[path] = response.headers.get('ETag')
+        problems = []
+        if again.status_code != 304:
+            problems.append("repeat gave {}".format(again.status_code))
+        if zipped.headers.get('Content-Encoding') == 'gzip':
+            if gzip.decompress(zipped_body) != body:
+                problems.append("gzip body differs")
+        elif len(body) >= app.config['COMPRESS_MIN_BYTES']:
+            problems.append("not compressed")
+        ok &= not problems
+        print("  {:<28} {:>9.2f} {:>9.2f} {:>11,} {:>11,} {:>8}".format(
+            path, full * 1000, not_modified * 1000, len(body), compressed,
+            "ok" if not problems else ", ".join(problems)))
+
+    # Any change to the project's data changes its page and export
+    client.post('/project/{}/upload/phenotypes'.format(PROJECT_ID),
+                data={'phenotypes': (BytesIO("".join(dataset.phenotypes_csv()).encode('utf-8')), 'phenotypes.csv')},
+                content_type='multipart/form-data')
+    client.get('/index')
+    for path in ('/project/{}'.format(PROJECT_ID), '/project/{}/export/ped'.format(PROJECT_ID)):
+        response = client.get(path, headers={'If-None-Match': etags[path]})
+        changed = response.status_code == 200 and response.headers.get('ETag') != etags[path]
+        ok &= changed
+        print("  after a phenotype upload {:<24} {}".format(path, "new ETag" if changed else "UNCHANGED"))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Times the relatedness check on simulated families, and checks that it finds a sample
+# swap and a duplicated sample put into them. The engine is first run directly on
+# generated genotype codes at the given size, then through the relatedness page on a
+# smaller project uploaded to an in-memory SQLite database.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/relatedness.py --individuals 2000 --markers 100000
+#   python benchmarks/relatedness.py --individuals 5000 --markers 50000 --workers 8
+
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+import config
+from datagen import Dataset
+
+MISSING_RATE = 0.01
+
+
+def configure():
+    config.Config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    config.Config.WTF_CSRF_ENABLED = False
+    config.Config.SNAPSHOT_ENABLED = False
+    config.Config.HASH_METHOD = 'pbkdf2:sha256:1000'
+    config.Config.SALT_LENGTH = 8
+
+
+# Families of a father, mother and two children, as genotype codes (copies of the
+# second allele, -1 missing) with each family's row and whether each row is a parent
+def simulate(rand, num_individuals, num_markers):
+    num_families = num_individuals // 4
+    frequency = rand.uniform(0.05, 0.95, num_markers)
+    # Parents' two alleles, then each child takes one of each parent's at random
+    father = rand.random((num_families, 2, num_markers)) < frequency
+    mother = rand.random((num_families, 2, num_markers)) < frequency
+    children = []
+    for _ in range(2):
+        from_father = np.take_along_axis(father, rand.integers(0, 2, (num_families, 1, num_markers)), axis=1)
+        from_mother = np.take_along_axis(mother, rand.integers(0, 2, (num_families, 1, num_markers)), axis=1)
+        children.append(from_father[:, 0])
+        children.append(from_mother[:, 0])
+
+    codes = np.empty((num_families * 4, num_markers), dtype=np.int8)
+    codes[0::4] = father.sum(axis=1)
+    codes[1::4] = mother.sum(axis=1)
+    codes[2::4] = children[0].astype(np.int8) + children[1]
+    codes[3::4] = children[2].astype(np.int8) + children[3]
+    codes[rand.random(codes.shape) < MISSING_RATE] = -1
+
+    family_rows = np.repeat(np.arange(num_families), 4)
+    is_parent = np.tile([True, True, False, False], num_families)
+    names = ["C1_F{:05d}_{}".format(family + 1, member) for family in range(num_families) for member in (1, 2, 3, 4)]
+    return codes, family_rows, is_parent, names
+
+
+def engine(args):
+    from gendb_app.analysis.relatedness import GenotypePlanes, DeclaredFamilies, relatedness, DUPLICATE
+
+    rand = np.random.default_rng(args.seed)
+    codes, family_rows, is_parent, names = simulate(rand, args.individuals, args.markers)
+    # The first child of family 1 swapped with the first child of family 2, and the
+    # mother of family 3 sent twice, again as the father of family 4
+    codes[[2, 6]] = codes[[6, 2]]
+    codes[12] = codes[9]
+    print("{} individuals, {} markers".format(len(names), args.markers))
+
+    start = time.perf_counter()
+    planes = GenotypePlanes(len(names))
+    for column in range(0, args.markers, 10000):
+        planes.add(codes[:, column:column + 10000])
+    planes.finish()
+    packed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = relatedness(names, planes, DeclaredFamilies(family_rows, is_parent), args.min_markers, args.workers)
+    compared = time.perf_counter() - start
+    num_pairs = len(names) * (len(names) - 1) // 2
+    print("  packed in {:.2f} s, {:,} pairs compared in {:.2f} s ({:,.0f} pairs/s) on {} threads".format(
+        packed, num_pairs, compared, num_pairs / compared, args.workers or os.cpu_count()))
+
+    swapped = {swap.individual for swap in report.swap_candidates()}
+    duplicates = {(pair.individual_a, pair.individual_b) for pair in report.pairs if pair.observed == DUPLICATE}
+    # The father of family 4 no longer matches his children either
+    expected_swaps = {names[2], names[6], names[12]}
+    expected_duplicates = {(names[9], names[12])}
+    print("  {} related pairs, {} not as declared".format(len(report.pairs), len(report.problems)))
+    print("  likely swaps {}: {}".format(sorted(swapped), "ok" if swapped == expected_swaps else "UNEXPECTED"))
+    print("  duplicates {}: {}".format(sorted(duplicates), "ok" if duplicates == expected_duplicates else "UNEXPECTED"))
+    return swapped == expected_swaps and duplicates == expected_duplicates
+
+
+# The datagen genotypes of two children from different families are swapped by their
+# IDs before upload
+def route(args):
+    from gendb_app import app, db
+    from gendb_app.models import User
+
+    dataset = Dataset(args.route_individuals, args.route_markers, 1)
+    app.config['RELATEDNESS_MIN_MARKERS'] = min(args.min_markers, args.route_markers // 2)
+    children = [full_id for full_id, _, father, _ in dataset.individuals if father is not None]
+    first, second = children[0], next(child for child in children if child.split('_')[1] != children[0].split('_')[1])
+    swap = {first: second, second: first}
+    genotypes = []
+    for line in dataset.genotypes_csv():
+        full_id, rest = line.split(',', 1)
+        genotypes.append(swap.get(full_id, full_id) + ',' + rest)
+
+    db.create_all()
+    user = User(email='bench@example.com', full_name='Benchmark', is_sys_admin=True)
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    client.post('/add_project', data={'title': 'Benchmark', 'desc': 'Synthetic data'})
+    for url, field, lines in (('/markers/upload', 'markers', dataset.markers_csv()),
+                              ('/project/1/upload/individuals', 'individuals', dataset.individuals_csv()),
+                              ('/project/1/upload/genotypes', 'genotypes', genotypes)):
+        client.post(url, data={field: (BytesIO("".join(lines).encode('utf-8')), field + '.csv')},
+                    content_type='multipart/form-data')
+    client.get('/index')
+
+    start = time.perf_counter()
+    page = client.get('/project/1/relatedness').get_data(as_text=True)
+    seconds = time.perf_counter() - start
+    pairs = client.get('/project/1/relatedness/pairs').get_data(as_text=True)
+    found = first in page and second in page and "2 likely swaps" in page
+    print("Relatedness page, {} individuals and {} markers: {:.2f} s, {} related pairs, swap of {} and {} {}".format(
+        dataset.num_individuals, dataset.num_markers, seconds, len(pairs.splitlines()) - 1, first, second,
+        "found" if found else "NOT FOUND"))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relatedness check throughput and swap detection")
+    parser.add_argument('--individuals', type=int, default=2000)
+    parser.add_argument('--markers', type=int, default=100000)
+    parser.add_argument('--workers', type=int, help="Threads, one per core by default")
+    parser.add_argument('--min-markers', type=int, default=500)
+    parser.add_argument('--route-individuals', type=int, default=200)
+    parser.add_argument('--route-markers', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    configure()
+    ok = engine(args)
+    ok &= route(args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Times importing a consortium's user accounts from a CSV file against adding them one
+# form post at a time, hashing with the configured password hash. The import is timed
+# with its passwords hashed in this process and on the pool, and checked to have written
+# every user, membership and log entry, with passwords that log in. A file with errors
+# is checked to be rejected whole, without its passwords in the error report. Runs
+# against an in-memory SQLite database.
+#
+# Usage (from the gendb directory):
+#   python benchmarks/user_import.py --users 300
+#   python benchmarks/user_import.py --users 1000 --workers 8
+
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+GENDB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENDB_DIR)
+
+import config
+
+NUM_PROJECTS = 3
+
+
+def configure():
+    config.Config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    config.Config.WTF_CSRF_ENABLED = False
+    config.Config.SNAPSHOT_ENABLED = False
+
+
+def users_csv(prefix, num_users):
+    lines = []
+    for number in range(num_users):
+        # Every user joins a project, every tenth administers a second one
+        projects = str(number % NUM_PROJECTS + 1)
+        if number % 10 == 0:
+            projects += ";{}:admin".format((number + 1) % NUM_PROJECTS + 1)
+        lines.append("{0}{1}@example.com,{0} User {1},password-{1},0,{2}\n".format(prefix, number, projects))
+    return lines
+
+
+def import_file(client, lines, filename='users.csv'):
+    body = "".join(lines).encode('utf-8')
+    return client.post('/admin/users/import', data={'users': (BytesIO(body), filename)},
+                       content_type='multipart/form-data')
+
+
+def timed_import(client, app, prefix, num_users, workers):
+    app.config['USER_IMPORT_WORKERS'] = workers
+    start = time.perf_counter()
+    response = import_file(client, users_csv(prefix, num_users))
+    seconds = time.perf_counter() - start
+    if response.status_code != 302 or not response.location.endswith('/admin/users'):
+        raise RuntimeError("Import of {} users failed: {}".format(num_users, response.location))
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk user import against one account per form post")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--serial', type=int, default=20, help="Accounts added one at a time, to estimate the rest")
+    parser.add_argument('--workers', type=int, help="Hashing processes, one per core by default")
+    args = parser.parse_args()
+
+    configure()
+    from gendb_app import app, db
+    from gendb_app.models import User, ProjectMemship, SystemLog, ProjectLog
+    from gendb_app.filehandling.users import MASKED_PASSWORD
+
+    db.create_all()
+    admin = User(email='bench@example.com', full_name='Benchmark', is_sys_admin=True)
+    admin.set_password('bench')
+    db.session.add(admin)
+    db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    for number in range(NUM_PROJECTS):
+        client.post('/add_project', data={'title': 'Project {}'.format(number + 1), 'desc': 'Synthetic'})
+    client.get('/index')
+    print("{} method, {} processes on {} cores".format(app.config['HASH_METHOD'], args.workers or os.cpu_count(),
+                                                      os.cpu_count()))
+
+    start = time.perf_counter()
+    for number in range(args.serial):
+        client.post('/add_user', data={'email': 'serial{}@example.com'.format(number),
+                                       'full_name': 'Serial {}'.format(number), 'password': 'serial'})
+    per_user = (time.perf_counter() - start) / args.serial
+    print("  one form post per user        {:>8.2f} s for {} users (measured over {})".format(
+        per_user * args.users, args.users, args.serial))
+
+    in_process = timed_import(client, app, 'single', args.users, 1)
+    print("  import, hashed in process     {:>8.2f} s".format(in_process))
+    pooled = timed_import(client, app, 'pooled', args.users, args.workers)
+    print("  import, hashed on the pool    {:>8.2f} s".format(pooled))
+
+    ok = True
+    client.get('/index')
+    imported = User.query.filter(User.email.like('pooled%')).count()
+    memships = ProjectMemship.query.filter(ProjectMemship.user_email.like('pooled%')).count()
+    expected_memships = args.users + (args.users + 9) // 10
+    created_logs = SystemLog.query.filter(SystemLog.message.like('Created user account <pooled%')).count()
+    summaries = SystemLog.query.filter(SystemLog.message.like('Imported {} user accounts%'.format(args.users))).count()
+    added_logs = ProjectLog.query.filter(ProjectLog.message.like('Added user pooled%')).count()
+    admins = ProjectMemship.query.filter(ProjectMemship.user_email.like('pooled%'),
+                                         ProjectMemship.is_project_admin.is_(True)).count()
+    counts_ok = (imported, memships, created_logs, summaries, added_logs, admins) == \
+        (args.users, expected_memships, args.users, 2, expected_memships, (args.users + 9) // 10)
+    ok &= counts_ok
+    print("  {} users, {} memberships, {} account and {} project log entries: {}".format(
+        imported, memships, created_logs, added_logs, "ok" if counts_ok else "UNEXPECTED"))
+
+    # The last user of the pooled import, whose password was hashed by the pool
+    last = args.users - 1
+    login_client = app.test_client()
+    login_client.post('/login', data={'email': 'pooled{}@example.com'.format(last),
+                                      'password': 'password-{}'.format(last)})
+    logged_in = login_client.get('/index').status_code == 200
+    ok &= logged_in
+    print("  imported password logs in: {}".format("ok" if logged_in else "FAILED"))
+
+    # An existing account, a repeated email and a missing project reject the whole file
+    bad = users_csv('rejected', 5) + ["pooled0@example.com,Again,secret-again,0\n",
+                                      "REJECTED2@example.com,Twice,secret-twice,0\n",
+                                      "other@example.com,Other,secret-other,0,99\n"]
+    response = import_file(client, bad)
+    report = client.get(response.location).get_data(as_text=True)
+    rejected = User.query.filter(User.email.like('rejected%')).count() == 0 and report.count('alert-danger') >= 3
+    masked = 'secret-' not in report and MASKED_PASSWORD in report
+    ok &= rejected and masked
+    print("  file with errors rejected: {}, passwords masked in the report: {}".format(
+        "ok" if rejected else "NO", "ok" if masked else "NO"))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,14 @@ from flask_login import LoginManager
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# MySQL's default REPEATABLE READ would have each transaction read the rows committed
+# as of its first read. An upload then reads the project's stored rows from before it
+# took the upload lock, missing those of the upload before it, see
+# gendb_app.filehandling.locking. READ COMMITTED reads the latest committed rows
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('mysql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {},
+                                                   isolation_level='READ COMMITTED')
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
@@ -14,4 +22,4 @@ login = LoginManager(app)
 login.login_view = 'login'
 login.login_message_category = 'info'
 
-from gendb_app import routes, models
\ No newline at end of file
+from gendb_app import routes, models, instrumentation, responses
\ No newline at end of file
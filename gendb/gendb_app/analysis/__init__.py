@@ -0,0 +1,7 @@
+from gendb_app.analysis.genotypes import decode, MISSING_CODE
+from gendb_app.analysis.snapshot import load_chromosome, iter_chromosomes, update_snapshot, remove_snapshot
+from gendb_app.analysis.tally import update_tally, clear_tally
+from gendb_app.analysis.qc import run_project_qc, qc_summary, tally_statistics, marker_statistics, genotype_counts
+from gendb_app.analysis.mendel import check_project_mendel
+from gendb_app.analysis.relatedness import check_project_relatedness
+from gendb_app.analysis.families import update_families, clear_families, family_members, project_trios
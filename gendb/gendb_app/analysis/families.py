@@ -0,0 +1,64 @@
+from sqlalchemy.orm import aliased
+
+from gendb_app import db
+from gendb_app.models import Family, Individual
+from gendb_app.analysis.mendel import FATHER_MEMBER_ID, MOTHER_MEMBER_ID
+
+# Number of family IDs per IN clause when reading existing families
+QUERY_CHUNK_SIZE = 1000
+
+
+# Adds newly inserted individuals to their project's family index, in the caller's
+# transaction. The individuals must have been flushed so that they have IDs
+def update_families(project_id, individuals):
+    keys = sorted({(ind.clinic_id, ind.family_id) for ind in individuals})
+    family_ids = sorted({family_id for _, family_id in keys})
+
+    families = {}
+    for start in range(0, len(family_ids), QUERY_CHUNK_SIZE):
+        chunk = family_ids[start:start + QUERY_CHUNK_SIZE]
+        for family in Family.query.filter(Family.project_id == project_id, Family.family_id.in_(chunk)):
+            families[(family.clinic_id, family.family_id)] = family
+
+    for clinic_id, family_id in keys:
+        if (clinic_id, family_id) not in families:
+            family = Family(project_id=project_id, clinic_id=clinic_id, family_id=family_id,
+                            num_members=0, num_children=0)
+            db.session.add(family)
+            families[(clinic_id, family_id)] = family
+
+    for ind in individuals:
+        family = families[(ind.clinic_id, ind.family_id)]
+        family.num_members += 1
+        member_id = int(ind.member_id)
+        if member_id == FATHER_MEMBER_ID:
+            family.father_id = ind.id
+        elif member_id == MOTHER_MEMBER_ID:
+            family.mother_id = ind.id
+        else:
+            family.num_children += 1
+
+
+def clear_families(project_id):
+    Family.query.filter_by(project_id=project_id).delete()
+
+
+# Members of one family, found through the individual unique constraint's index
+def family_members(project_id, clinic_id, family_id):
+    return Individual.query.filter_by(project_id=project_id, clinic_id=clinic_id, family_id=family_id).\
+        order_by(Individual.member_id).all()
+
+
+# (child, father, mother) Individual rows of every trio in the project's complete families
+def project_trios(project_id):
+    father = aliased(Individual)
+    mother = aliased(Individual)
+    return db.session.query(Individual, father, mother).\
+        join(Family, db.and_(Family.project_id == Individual.project_id,
+                             Family.clinic_id == Individual.clinic_id,
+                             Family.family_id == Individual.family_id)).\
+        join(father, father.id == Family.father_id).\
+        join(mother, mother.id == Family.mother_id).\
+        filter(Family.project_id == project_id,
+               Individual.member_id.notin_((FATHER_MEMBER_ID, MOTHER_MEMBER_ID))).\
+        order_by(Family.clinic_id, Family.family_id, Individual.member_id)
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import text, bindparam
+
+from gendb_app import app, db
+from gendb_app.models import Individual
+from gendb_app.marker_cache import marker_cache
+
+# A genotype is stored as a single int8 code: the two allele indices (positions in the
+# marker's sorted allele list) are unordered, so the pair lo <= hi is numbered
+# triangularly as hi * (hi + 1) / 2 + lo. With 2 alleles the codes are 0 = AA,
+# 1 = AB and 2 = BB. A missing genotype is -1.
+MISSING_CODE = -1
+MAX_ALLELES = 15
+NUM_CODES = MAX_ALLELES * (MAX_ALLELES + 1) // 2
+
+# Number of genotype rows fetched from the database at a time
+FETCH_SIZE = 100000
+
+
+def num_codes(num_alleles):
+    return num_alleles * (num_alleles + 1) // 2
+
+
+def genotype_code(allele_1, allele_2):
+    lo, hi = min(allele_1, allele_2), max(allele_1, allele_2)
+    return hi * (hi + 1) // 2 + lo
+
+
+def genotype_codes(allele_1, allele_2):
+    lo = np.minimum(allele_1, allele_2).astype(np.int16)
+    hi = np.maximum(allele_1, allele_2).astype(np.int16)
+    return (hi * (hi + 1) // 2 + lo).astype(np.int8)
+
+
+def build_code_tables():
+    allele_1 = np.empty(NUM_CODES, dtype=np.int8)
+    allele_2 = np.empty(NUM_CODES, dtype=np.int8)
+    for hi in range(MAX_ALLELES):
+        for lo in range(hi + 1):
+            code = hi * (hi + 1) // 2 + lo
+            allele_1[code] = lo
+            allele_2[code] = hi
+
+    # Number of copies of each allele carried by each genotype code
+    dosage = np.zeros((NUM_CODES, MAX_ALLELES), dtype=np.int64)
+    dosage[np.arange(NUM_CODES), allele_1] += 1
+    dosage[np.arange(NUM_CODES), allele_2] += 1
+    return allele_1, allele_2, dosage
+
+
+CODE_ALLELE_1, CODE_ALLELE_2, CODE_DOSAGE = build_code_tables()
+
+
+# Splits a code matrix into its two allele index matrices, missing entries become -1
+def decode(codes):
+    missing = codes < 0
+    safe = np.where(missing, 0, codes)
+    allele_1 = np.where(missing, MISSING_CODE, CODE_ALLELE_1[safe])
+    allele_2 = np.where(missing, MISSING_CODE, CODE_ALLELE_2[safe])
+    return allele_1, allele_2
+
+
+# Genotypes of every individual of a project at every catalogue marker on one chromosome
+class ChromosomeGenotypes(object):
+    def __init__(self, chromosome, ind_ids, markers, codes):
+        self.chromosome = chromosome
+        # Sorted individual IDs, one per row of codes
+        self.ind_ids = ind_ids
+        # Cached markers ordered by position, one per column of codes
+        self.markers = markers
+        self.codes = codes
+
+    @property
+    def num_alleles(self):
+        return np.array([len(marker.alleles) for marker in self.markers], dtype=np.int64)
+
+
+def catalogue_markers():
+    marker_cache.refresh()
+    markers = [marker for marker in marker_cache.by_id.values() if len(marker.alleles) <= MAX_ALLELES]
+    return sorted(markers, key=lambda marker: (marker.chromosome, marker.position, marker.id))
+
+
+def project_individual_ids(project_id):
+    ids = db.session.query(Individual.id).filter_by(project_id=project_id).order_by(Individual.id)
+    return np.array([row[0] for row in ids], dtype=np.int64)
+
+
+# Places genotype rows into a code matrix of the given individuals and markers, neither
+# of which may be empty
+class CodeMatrixLookup(object):
+    def __init__(self, ind_ids, markers):
+        self.ind_ids = ind_ids
+        # Marker ID -> column, and (column, allele character) -> allele index
+        marker_ids = np.array([marker.id for marker in markers], dtype=np.int64)
+        self.column_of = np.full(marker_ids.max() + 1, -1, dtype=np.int64)
+        self.column_of[marker_ids] = np.arange(len(markers))
+        self.allele_index = np.full((len(markers), 128), MISSING_CODE, dtype=np.int8)
+        for column, marker in enumerate(markers):
+            for index, allele in enumerate(marker.alleles):
+                self.allele_index[column, ord(allele)] = index
+
+    # Matrix rows, columns and codes of the given genotypes, leaving out any of other
+    # individuals or markers and any with calls that are not alleles of their marker
+    def locate(self, row_ids, row_markers, calls_1, calls_2):
+        row_ids = np.array(row_ids, dtype=np.int64)
+        rows_pos = np.minimum(np.searchsorted(self.ind_ids, row_ids), len(self.ind_ids) - 1)
+        row_markers = np.array(row_markers, dtype=np.int64)
+        in_range = row_markers < len(self.column_of)
+        cols = np.where(in_range, self.column_of[np.where(in_range, row_markers, 0)], -1)
+        keep = (cols >= 0) & (self.ind_ids[rows_pos] == row_ids)
+
+        # Every call is a single ASCII character, so the calls can be decoded in one go
+        chars_1 = np.frombuffer(''.join(calls_1).encode('ascii'), dtype=np.uint8)
+        chars_2 = np.frombuffer(''.join(calls_2).encode('ascii'), dtype=np.uint8)
+        alleles_1 = self.allele_index[np.where(keep, cols, 0), chars_1 & 0x7f]
+        alleles_2 = self.allele_index[np.where(keep, cols, 0), chars_2 & 0x7f]
+        keep &= (alleles_1 >= 0) & (alleles_2 >= 0)
+        return rows_pos[keep], cols[keep], genotype_codes(alleles_1[keep], alleles_2[keep])
+
+
+# Pulls a project's genotypes at the given markers (ordered by chromosome and position)
+# into an individuals x markers code matrix, with a single pass over the genotype table
+def load_markers(project_id, ind_ids, markers):
+    codes = np.full((len(ind_ids), len(markers)), MISSING_CODE, dtype=np.int8)
+    if len(markers) == 0 or len(ind_ids) == 0:
+        return codes
+    lookup = CodeMatrixLookup(ind_ids, markers)
+
+    chromosomes = sorted({marker.chromosome for marker in markers})
+    query = text(
+        "SELECT genotype.ind_id, genotype.marker_id, genotype.call_1, genotype.call_2 "
+        "FROM genotype JOIN individual ON individual.id = genotype.ind_id "
+        "JOIN marker ON marker.id = genotype.marker_id "
+        "WHERE individual.project_id = :project_id AND marker.chromosome IN :chromosomes").\
+        bindparams(bindparam('chromosomes', expanding=True)).\
+        execution_options(stream_results=True)
+
+    result = db.session.execute(query, {'project_id': project_id, 'chromosomes': chromosomes})
+    while True:
+        # Plain tuples straight from the DBAPI cursor, skipping SQLAlchemy's row wrapping
+        rows = result.cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        rows_pos, cols, row_codes = lookup.locate(*zip(*rows))
+        codes[rows_pos, cols] = row_codes
+    result.close()
+
+    return codes
+
+
+# Catalogue markers grouped by chromosome, as chromosome -> markers ordered by position
+def chromosome_markers():
+    by_chromosome = OrderedDict()
+    for marker in catalogue_markers():
+        by_chromosome.setdefault(marker.chromosome, []).append(marker)
+    return by_chromosome
+
+
+# Yields the genotypes of a project one chromosome at a time, optionally only of the
+# given chromosomes. Chromosomes are read from the database in groups, with one pass
+# over the genotypes per group, so that no group's code matrix is larger than
+# ANALYSIS_MAX_MATRIX_BYTES
+def iter_chromosomes(project_id, chromosomes=None):
+    ind_ids = project_individual_ids(project_id)
+    by_chromosome = chromosome_markers()
+    if chromosomes is not None:
+        by_chromosome = OrderedDict((chromosome, markers) for chromosome, markers in by_chromosome.items()
+                                    if chromosome in chromosomes)
+
+    max_columns = max(app.config['ANALYSIS_MAX_MATRIX_BYTES'] // max(len(ind_ids), 1), 1)
+    group = []
+    for chromosome, markers in by_chromosome.items():
+        if group and sum(len(group_markers) for _, group_markers in group) + len(markers) > max_columns:
+            for genotypes in load_group(project_id, ind_ids, group):
+                yield genotypes
+            group = []
+        group.append((chromosome, markers))
+
+    if group:
+        for genotypes in load_group(project_id, ind_ids, group):
+            yield genotypes
+
+
+def load_group(project_id, ind_ids, group):
+    markers = [marker for _, chromosome_markers in group for marker in chromosome_markers]
+    codes = load_markers(project_id, ind_ids, markers)
+
+    start = 0
+    for chromosome, chromosome_markers in group:
+        end = start + len(chromosome_markers)
+        yield ChromosomeGenotypes(chromosome, ind_ids, chromosome_markers, codes[:, start:end])
+        start = end
+
+
+# Pulls a project's genotypes on a single chromosome
+def load_chromosome(project_id, chromosome, ind_ids=None):
+    if ind_ids is None:
+        ind_ids = project_individual_ids(project_id)
+    markers = [marker for marker in catalogue_markers() if marker.chromosome == chromosome]
+    return ChromosomeGenotypes(chromosome, ind_ids, markers, load_markers(project_id, ind_ids, markers))
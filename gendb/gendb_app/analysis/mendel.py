@@ -0,0 +1,158 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from gendb_app import db
+from gendb_app.models import Individual
+from gendb_app.analysis.genotypes import decode
+from gendb_app.analysis.snapshot import iter_chromosomes
+
+# Family member identifiers of the parents, every other member is taken to be their child
+FATHER_MEMBER_ID = 1
+MOTHER_MEMBER_ID = 2
+
+# Number of children checked at once, bounds the size of the comparison arrays
+CHILD_BLOCK_SIZE = 256
+
+
+class FamilyResult(object):
+    def __init__(self, clinic_id, family_id, has_father, has_mother, children):
+        self.clinic_id = clinic_id
+        self.family_id = family_id
+        self.has_father = has_father
+        self.has_mother = has_mother
+        self.children = children
+        self.errors = 0
+        self.checked = 0
+
+    @property
+    def error_rate(self):
+        return self.errors / self.checked if self.checked else None
+
+
+class MendelReport(object):
+    def __init__(self, families, markers, marker_errors, marker_checked):
+        self.families = families
+        # Cached markers, with the error and checked genotype counts of each
+        self.markers = markers
+        self.marker_errors = marker_errors
+        self.marker_checked = marker_checked
+
+    @property
+    def total_errors(self):
+        return int(self.marker_errors.sum()) if len(self.marker_errors) else 0
+
+    # (marker, errors, checked) of the markers with most errors first
+    def worst_markers(self, limit=None):
+        order = np.argsort(-self.marker_errors, kind='stable')
+        order = order[self.marker_errors[order] > 0]
+        if limit is not None:
+            order = order[:limit]
+        return [(self.markers[i], int(self.marker_errors[i]), int(self.marker_checked[i])) for i in order]
+
+
+def carries(allele, parent_1, parent_2):
+    return (allele == parent_1) | (allele == parent_2)
+
+
+# Boolean (children x markers) arrays of Mendelian errors and of genotypes that could be
+# checked. A parent row of -1 means that parent is not in the project; with both parents
+# the child must take one allele from each, with one parent it must share an allele.
+def mendel_errors(alleles_1, alleles_2, child_rows, father_rows, mother_rows):
+    c1 = alleles_1[child_rows]
+    c2 = alleles_2[child_rows]
+    checked = c1 >= 0
+
+    f1 = alleles_1[np.maximum(father_rows, 0)]
+    f2 = alleles_2[np.maximum(father_rows, 0)]
+    m1 = alleles_1[np.maximum(mother_rows, 0)]
+    m2 = alleles_2[np.maximum(mother_rows, 0)]
+    has_father = ((father_rows >= 0)[:, None]) & (f1 >= 0)
+    has_mother = ((mother_rows >= 0)[:, None]) & (m1 >= 0)
+
+    trio = has_father & has_mother
+    trio_ok = (carries(c1, f1, f2) & carries(c2, m1, m2)) | (carries(c2, f1, f2) & carries(c1, m1, m2))
+    father_ok = carries(c1, f1, f2) | carries(c2, f1, f2)
+    mother_ok = carries(c1, m1, m2) | carries(c2, m1, m2)
+
+    ok = np.where(trio, trio_ok, np.where(has_father, father_ok, mother_ok))
+    checked &= has_father | has_mother
+    return checked & ~ok, checked
+
+
+# Checks the genotypes of every child in the project against its declared parents
+def check_project_mendel(project_id):
+    individuals = db.session.query(Individual.id, Individual.clinic_id,
+                                   Individual.family_id, Individual.member_id).\
+        filter_by(project_id=project_id).order_by(Individual.id).all()
+
+    members = OrderedDict()
+    for ind_id, clinic_id, family_id, member_id in individuals:
+        members.setdefault((clinic_id, family_id), {})[int(member_id)] = ind_id
+
+    families = []
+    child_ids = []
+    father_ids = []
+    mother_ids = []
+    family_index = []
+    for (clinic_id, family_id), family in members.items():
+        father = family.get(FATHER_MEMBER_ID)
+        mother = family.get(MOTHER_MEMBER_ID)
+        children = [ind_id for member_id, ind_id in family.items()
+                    if member_id not in (FATHER_MEMBER_ID, MOTHER_MEMBER_ID)]
+        if not children or (father is None and mother is None):
+            continue
+
+        for child in children:
+            child_ids.append(child)
+            father_ids.append(father if father is not None else -1)
+            mother_ids.append(mother if mother is not None else -1)
+            family_index.append(len(families))
+        families.append(FamilyResult(clinic_id, family_id, father is not None,
+                                     mother is not None, len(children)))
+
+    family_index = np.array(family_index, dtype=np.int64)
+    family_errors = np.zeros(len(families), dtype=np.int64)
+    family_checked = np.zeros(len(families), dtype=np.int64)
+    markers = []
+    marker_errors = []
+    marker_checked = []
+
+    for chromosome in iter_chromosomes(project_id):
+        if not chromosome.markers:
+            continue
+
+        def rows_of(ids):
+            ids = np.array(ids, dtype=np.int64)
+            rows = np.searchsorted(chromosome.ind_ids, ids)
+            return np.where(ids >= 0, rows, -1)
+
+        child_rows = rows_of(child_ids)
+        father_rows = rows_of(father_ids)
+        mother_rows = rows_of(mother_ids)
+        alleles_1, alleles_2 = decode(chromosome.codes)
+
+        errors_here = np.zeros(len(chromosome.markers), dtype=np.int64)
+        checked_here = np.zeros(len(chromosome.markers), dtype=np.int64)
+        for start in range(0, len(child_rows), CHILD_BLOCK_SIZE):
+            block = slice(start, start + CHILD_BLOCK_SIZE)
+            errors, checked = mendel_errors(alleles_1, alleles_2, child_rows[block],
+                                            father_rows[block], mother_rows[block])
+            errors_here += errors.sum(axis=0)
+            checked_here += checked.sum(axis=0)
+            family_errors += np.bincount(family_index[block], weights=errors.sum(axis=1),
+                                         minlength=len(families)).astype(np.int64)
+            family_checked += np.bincount(family_index[block], weights=checked.sum(axis=1),
+                                          minlength=len(families)).astype(np.int64)
+
+        markers.extend(chromosome.markers)
+        marker_errors.append(errors_here)
+        marker_checked.append(checked_here)
+
+    for family, errors, checked in zip(families, family_errors, family_checked):
+        family.errors = int(errors)
+        family.checked = int(checked)
+
+    return MendelReport(families, markers,
+                        np.concatenate(marker_errors) if marker_errors else np.zeros(0, dtype=np.int64),
+                        np.concatenate(marker_checked) if marker_checked else np.zeros(0, dtype=np.int64))
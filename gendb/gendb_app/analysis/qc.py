@@ -0,0 +1,162 @@
+from datetime import datetime
+import math
+
+import numpy as np
+from sqlalchemy import func
+
+from gendb_app import app, db
+from gendb_app.models import MarkerQC
+from gendb_app.analysis.genotypes import catalogue_markers, num_codes, CODE_DOSAGE
+from gendb_app.analysis.snapshot import iter_chromosomes
+from gendb_app.analysis.tally import tally_counts, project_individual_count
+
+# Number of marker_qc rows inserted per statement
+INSERT_BATCH_SIZE = 10000
+
+erfc = np.frompyfunc(math.erfc, 1, 1)
+
+
+# Counts of each genotype class per marker, as a markers x codes matrix
+def genotype_counts(codes, num_alleles):
+    counts = np.zeros((codes.shape[1], num_codes(num_alleles)), dtype=np.int64)
+    for code in range(counts.shape[1]):
+        counts[:, code] = np.count_nonzero(codes == code, axis=0)
+    return counts
+
+
+# Per-marker summary statistics from genotype class counts. 'num_alleles' is the
+# number of possible alleles of each marker and 'num_individuals' the number of
+# individuals a call was expected for.
+#
+# Hardy-Weinberg equilibrium uses the 1 degree of freedom chi-squared test, which can be
+# evaluated for every marker at once, and is only given for markers with two alleles
+def marker_statistics(counts, num_alleles, num_individuals):
+    max_alleles = max(int(num_alleles.max()), 1) if len(num_alleles) else 1
+    counts = counts[:, :num_codes(max_alleles)]
+
+    n_called = counts.sum(axis=1)
+    n_missing = np.maximum(num_individuals - n_called, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        call_rate = np.where(num_individuals > 0, n_called / np.maximum(num_individuals, 1), np.nan)
+
+    allele_counts = counts.dot(CODE_DOSAGE[:counts.shape[1], :max_alleles])
+    order = np.argsort(-allele_counts, axis=1, kind='stable')
+    major = order[:, 0]
+    minor = order[:, 1] if max_alleles > 1 else np.full(len(counts), -1)
+    minor = np.where(minor < num_alleles, minor, -1)
+
+    total_alleles = 2 * n_called
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minor_counts = np.where(minor >= 0, allele_counts[np.arange(len(counts)), np.maximum(minor, 0)], 0)
+        maf = np.where(total_alleles > 0, minor_counts / total_alleles, np.nan)
+
+    hwe_p = np.full(len(counts), np.nan)
+    biallelic = (num_alleles == 2) & (n_called > 0)
+    if biallelic.any():
+        observed = counts[biallelic][:, :3].astype(np.float64)
+        n = observed.sum(axis=1)
+        p = (2 * observed[:, 0] + observed[:, 1]) / (2 * n)
+        q = 1 - p
+        expected = np.stack([n * p * p, 2 * n * p * q, n * q * q], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chi_sq = np.where(expected > 0, (observed - expected) ** 2 / expected, 0).sum(axis=1)
+        hwe_p[biallelic] = erfc(np.sqrt(chi_sq / 2)).astype(np.float64)
+
+    return {
+        'n_called': n_called,
+        'n_missing': n_missing,
+        'call_rate': call_rate,
+        'allele_counts': allele_counts,
+        'major': major,
+        'minor': minor,
+        'maf': maf,
+        'hwe_p': hwe_p,
+    }
+
+
+def none_if_nan(value):
+    return None if np.isnan(value) else float(value)
+
+
+# Derived statistics of every catalogue marker for a project straight from its genotype
+# tallies, without reading the genotype table. Returns the cached markers and their stats
+def tally_statistics(project_id):
+    markers = catalogue_markers()
+    counts = tally_counts(project_id, markers)
+    num_alleles = np.array([len(marker.alleles) for marker in markers], dtype=np.int64)
+    return markers, marker_statistics(counts, num_alleles, project_individual_count(project_id))
+
+
+# Yields (markers, stats) for the project, from the tallies or by reading every genotype
+def project_statistics(project_id, rescan):
+    if not rescan:
+        yield tally_statistics(project_id)
+        return
+
+    for chromosome in iter_chromosomes(project_id):
+        if not chromosome.markers:
+            continue
+        num_alleles = chromosome.num_alleles
+        counts = genotype_counts(chromosome.codes, int(num_alleles.max()))
+        yield chromosome.markers, marker_statistics(counts, num_alleles, len(chromosome.ind_ids))
+
+
+# Recomputes and stores the QC statistics of every marker genotyped in a project. By
+# default the statistics come from the genotype tallies; 'rescan' reads the genotypes
+# themselves, chromosome by chromosome from the project's snapshot. Catalogue markers
+# with no called genotype in the project are left out rather than counted as failing.
+# Returns the number of markers stored and the number left out
+def run_project_qc(project_id, rescan=False):
+    computed = datetime.utcnow()
+    MarkerQC.query.filter_by(project_id=project_id).delete()
+
+    num_markers = 0
+    num_untyped = 0
+    for markers, stats in project_statistics(project_id, rescan):
+        rows = []
+        for column, marker in enumerate(markers):
+            if stats['n_called'][column] == 0:
+                num_untyped += 1
+                continue
+            minor = stats['minor'][column]
+            rows.append({
+                'project_id': project_id,
+                'marker_id': marker.id,
+                'n_called': int(stats['n_called'][column]),
+                'n_missing': int(stats['n_missing'][column]),
+                'call_rate': none_if_nan(stats['call_rate'][column]),
+                'major_allele': marker.alleles[stats['major'][column]] if marker.alleles else None,
+                'minor_allele': marker.alleles[minor] if minor >= 0 else None,
+                'maf': none_if_nan(stats['maf'][column]),
+                'hwe_p': none_if_nan(stats['hwe_p'][column]),
+                'computed': computed,
+            })
+
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            db.session.execute(MarkerQC.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+        num_markers += len(rows)
+
+    db.session.commit()
+    return num_markers, num_untyped
+
+
+# Headline numbers for the project page, or None if QC has never been run
+def qc_summary(project_id):
+    total, mean_call_rate, computed = db.session.query(
+        func.count(MarkerQC.marker_id),
+        func.avg(MarkerQC.call_rate),
+        func.max(MarkerQC.computed)
+    ).filter(MarkerQC.project_id == project_id).one()
+
+    if total == 0:
+        return None
+
+    query = MarkerQC.query.filter_by(project_id=project_id)
+    return {
+        'markers': total,
+        'mean_call_rate': mean_call_rate,
+        'computed': computed,
+        'low_call_rate': query.filter(MarkerQC.call_rate < app.config['QC_MIN_CALL_RATE']).count(),
+        'low_maf': query.filter(MarkerQC.maf < app.config['QC_MIN_MAF']).count(),
+        'hwe_failed': query.filter(MarkerQC.hwe_p < app.config['QC_HWE_P_THRESHOLD']).count(),
+    }
@@ -0,0 +1,346 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import os
+
+import numpy as np
+
+from gendb_app import app, db
+from gendb_app.models import Individual
+from gendb_app.analysis.genotypes import catalogue_markers
+from gendb_app.analysis.snapshot import iter_chromosomes
+from gendb_app.analysis.mendel import FATHER_MEMBER_ID, MOTHER_MEMBER_ID
+from gendb_app.individual_index import full_ind_id
+from gendb_app.filehandling.export_cache import cached_file
+
+# Identity by state (IBS) between every two individuals of a project, and the kinship
+# estimated from it, compared with the relationships declared by their IDs to find
+# sample swaps, duplicated samples and unexpected relatives.
+#
+# Only biallelic markers are used, at most RELATEDNESS_MAX_MARKERS of them spread evenly
+# over the catalogue. Each individual's genotypes are bit-packed into planes, 64 markers
+# to a word: called, homozygous for the first allele, heterozygous, and homozygous for
+# the second. A pair is then compared with bitwise ANDs and popcounts of whole words.
+# Blocks of individuals are compared on RELATEDNESS_WORKERS threads, numpy releasing the
+# GIL for the word operations.
+#
+# Kinship is the KING-robust estimate (Manichaikul et al. 2010) over the markers called
+# in both individuals, (N het/het - 2 N IBS0) / (N het in one + N het in the other). It
+# is about 0.5 for duplicates and 0.25 for first degree relatives, halving with each
+# further degree.
+#
+# Reports are cached on disk with the project exports, by project and data version, so
+# a project's pairs are compared once per change to its data, by one request at a time
+# across worker processes; requests arriving meanwhile wait for its report. The last
+# few reports read are also kept in memory.
+
+# Relationship degrees, and the kinship above which each is inferred (KING's cut-offs)
+DUPLICATE, FIRST_DEGREE, SECOND_DEGREE, THIRD_DEGREE, UNRELATED = range(5)
+DEGREE_NAMES = ["Duplicate", "First degree", "Second degree", "Third degree", "Unrelated"]
+KINSHIP_BOUNDS = np.array([0.0442, 0.0884, 0.177, 0.354])
+
+# Individuals per block of the all pairs comparison, each block pair is one task
+BLOCK_SIZE = 256
+
+# Reports of the last few projects checked, by project and data version
+REPORT_CACHE_SIZE = 4
+
+# Kind of the report files in the export cache, see gendb_app.filehandling.export_cache
+REPORT_FILE_KIND = 'relatedness'
+REPORT_COLUMNS = ['a', 'b', 'markers', 'ibs0', 'ibs1', 'ibs2', 'kinship', 'expected', 'observed']
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+# Packs a boolean individuals x markers matrix into 64 markers per uint64 word
+def pack_bits(bits):
+    packed = np.packbits(bits, axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+# Bit planes of individuals x markers genotype codes of biallelic markers, where 0, 1
+# and 2 are the number of copies of the second allele and -1 is missing
+class GenotypePlanes(object):
+    def __init__(self, num_individuals):
+        self.num_individuals = num_individuals
+        self.num_markers = 0
+        self.parts = []
+        self.called = self.hom_first = self.het = self.hom_second = None
+
+    def add(self, codes):
+        self.num_markers += codes.shape[1]
+        self.parts.append([pack_bits(codes >= 0), pack_bits(codes == 0), pack_bits(codes == 1),
+                           pack_bits(codes == 2)])
+
+    def finish(self):
+        if self.parts:
+            planes = [np.hstack(part) for part in zip(*self.parts)]
+        else:
+            planes = [np.zeros((self.num_individuals, 0), dtype=np.uint64)] * 4
+        self.called, self.hom_first, self.het, self.hom_second = planes
+        self.parts = []
+        return self
+
+
+# Declared relationships: the family of each individual and whether it is a parent
+class DeclaredFamilies(object):
+    def __init__(self, family_rows, is_parent):
+        self.family_rows = np.asarray(family_rows, dtype=np.int64)
+        self.is_parent = np.asarray(is_parent, dtype=bool)
+
+    # Parents and their children, and children of the same family, are declared first
+    # degree relatives; the two parents of a family and members of different families
+    # are declared unrelated
+    def expected(self, rows_a, rows_b):
+        same_family = self.family_rows[rows_a][:, None] == self.family_rows[rows_b][None, :]
+        both_parents = self.is_parent[rows_a][:, None] & self.is_parent[rows_b][None, :]
+        return np.where(same_family & ~both_parents, FIRST_DEGREE, UNRELATED)
+
+
+def degree_of(kinship):
+    return UNRELATED - np.searchsorted(KINSHIP_BOUNDS, kinship, side='right')
+
+
+# A declared relationship not borne out is worth reporting, except distant relatives
+# found among individuals declared unrelated, which are common and the least certain
+def is_problem(expected, observed):
+    return observed >= 0 and observed != expected and not (expected == UNRELATED and observed == THIRD_DEGREE)
+
+
+# Pair counts of the individuals of two blocks, as arrays of (rows of a, rows of b):
+# markers called in both, IBS0, IBS2, both heterozygous, and heterozygous in a and in b
+def compare_blocks(planes, rows_a, rows_b):
+    shape = (len(rows_a), len(rows_b))
+    called, ibs0, ibs2 = np.empty(shape, np.int64), np.empty(shape, np.int64), np.empty(shape, np.int64)
+    het_het, het_a, het_b = np.empty(shape, np.int64), np.empty(shape, np.int64), np.empty(shape, np.int64)
+
+    called_b, hom_first_b = planes.called[rows_b], planes.hom_first[rows_b]
+    het_plane_b, hom_second_b = planes.het[rows_b], planes.hom_second[rows_b]
+    for i, row in enumerate(rows_a):
+        called[i] = popcount(called_b & planes.called[row])
+        ibs0[i] = popcount(hom_second_b & planes.hom_first[row]) + popcount(hom_first_b & planes.hom_second[row])
+        het_het[i] = popcount(het_plane_b & planes.het[row])
+        ibs2[i] = popcount(hom_first_b & planes.hom_first[row]) + het_het[i] + \
+            popcount(hom_second_b & planes.hom_second[row])
+        het_a[i] = popcount(called_b & planes.het[row])
+        het_b[i] = popcount(het_plane_b & planes.called[row])
+    return called, ibs0, ibs2, het_het, het_a, het_b
+
+
+# Compares two blocks, keeping the pairs declared or found to be related, as columns
+# (row a, row b, markers, IBS0, IBS1, IBS2, kinship, expected degree, observed degree).
+# Pairs with fewer than 'min_markers' called in both have an observed degree of -1
+def related_pairs(planes, declared, min_markers, block_a, block_b):
+    rows_a, rows_b = np.arange(*block_a), np.arange(*block_b)
+    called, ibs0, ibs2, het_het, het_a, het_b = compare_blocks(planes, rows_a, rows_b)
+
+    hets = het_a + het_b
+    kinship = np.divide(het_het - 2 * ibs0, hets, out=np.zeros(called.shape), where=hets > 0)
+    observed = np.where(called >= min_markers, degree_of(kinship), -1)
+    expected = declared.expected(rows_a, rows_b)
+
+    keep = (expected != UNRELATED) | ((observed >= 0) & (observed != UNRELATED))
+    # Each pair once, and never an individual with itself
+    keep &= rows_a[:, None] < rows_b[None, :]
+    a, b = np.nonzero(keep)
+    return (rows_a[a], rows_b[b], called[a, b], ibs0[a, b], called[a, b] - ibs0[a, b] - ibs2[a, b],
+            ibs2[a, b], kinship[a, b], expected[a, b], observed[a, b])
+
+
+# Compares every pair of individuals, returning the columns of related_pairs for all
+# the pairs kept
+def compare_all(planes, declared, min_markers, workers=None):
+    starts = range(0, planes.num_individuals, BLOCK_SIZE)
+    blocks = [(start, min(start + BLOCK_SIZE, planes.num_individuals)) for start in starts]
+    tasks = [(block_a, block_b) for i, block_a in enumerate(blocks) for block_b in blocks[i:]]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(lambda task: related_pairs(planes, declared, min_markers, *task), tasks))
+    if not results:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(9))
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+class RelatedPair(object):
+    __slots__ = ('individual_a', 'individual_b', 'markers', 'ibs0', 'ibs1', 'ibs2', 'kinship',
+                 'expected', 'observed')
+
+    def __init__(self, individual_a, individual_b, markers, ibs0, ibs1, ibs2, kinship, expected, observed):
+        self.individual_a = individual_a
+        self.individual_b = individual_b
+        self.markers = markers
+        self.ibs0 = ibs0
+        self.ibs1 = ibs1
+        self.ibs2 = ibs2
+        self.kinship = kinship
+        self.expected = expected
+        self.observed = observed
+
+    @property
+    def expected_name(self):
+        return DEGREE_NAMES[self.expected]
+
+    @property
+    def observed_name(self):
+        return DEGREE_NAMES[self.observed] if self.observed >= 0 else "Too few markers"
+
+    @property
+    def problem(self):
+        return is_problem(self.expected, self.observed)
+
+    # Proportions of the markers called in both sharing 0, 1 and 2 alleles
+    @property
+    def ibs_proportions(self):
+        if not self.markers:
+            return None
+        return self.ibs0 / self.markers, self.ibs1 / self.markers, self.ibs2 / self.markers
+
+
+# An individual none of whose declared first degree relatives it is found related to,
+# with the individuals it is found to be the duplicate or first degree relative of
+class SwapCandidate(object):
+    def __init__(self, individual, declared, matches):
+        self.individual = individual
+        self.declared = declared
+        self.matches = matches
+
+
+class RelatednessReport(object):
+    def __init__(self, num_individuals, num_markers, pairs):
+        self.num_individuals = num_individuals
+        self.num_markers = num_markers
+        # Pairs declared or found to be related, most closely related first
+        self.pairs = pairs
+
+    @property
+    def problems(self):
+        return [pair for pair in self.pairs if pair.problem]
+
+    @property
+    def duplicates(self):
+        return [pair for pair in self.pairs if pair.observed == DUPLICATE]
+
+    # Individuals whose declared relatives were all compared and none confirmed are
+    # likely swapped, their close matches elsewhere show where the sample may belong.
+    # Those with the most declared relatives, so the most evidence, come first
+    def swap_candidates(self):
+        declared = OrderedDict()
+        confirmed = set()
+        matches = {}
+        for pair in self.pairs:
+            for individual, other in ((pair.individual_a, pair.individual_b), (pair.individual_b, pair.individual_a)):
+                if pair.expected == FIRST_DEGREE and pair.observed >= 0:
+                    declared.setdefault(individual, []).append(other)
+                    if pair.observed <= FIRST_DEGREE:
+                        confirmed.add(individual)
+                elif pair.expected == UNRELATED and 0 <= pair.observed <= FIRST_DEGREE:
+                    matches.setdefault(individual, []).append((other, pair))
+
+        candidates = [SwapCandidate(individual, relatives, matches.get(individual, []))
+                      for individual, relatives in declared.items() if individual not in confirmed]
+        return sorted(candidates, key=lambda candidate: (-len(candidate.declared), -len(candidate.matches)))
+
+
+# Biallelic catalogue markers are thinned to RELATEDNESS_MAX_MARKERS by taking every
+# n-th, returns n
+def marker_stride():
+    num_biallelic = sum(1 for marker in catalogue_markers() if len(marker.alleles) == 2)
+    max_markers = app.config['RELATEDNESS_MAX_MARKERS']
+    return max(-(-num_biallelic // max_markers), 1)
+
+
+def project_planes(project_id, num_individuals):
+    planes = GenotypePlanes(num_individuals)
+    stride = marker_stride()
+    seen = 0
+    for chromosome in iter_chromosomes(project_id):
+        biallelic = np.array([len(marker.alleles) == 2 for marker in chromosome.markers], dtype=bool)
+        columns = np.nonzero(biallelic)[0]
+        # Every stride-th biallelic marker of the catalogue, counting across chromosomes
+        selected = columns[(seen + np.arange(len(columns))) % stride == 0]
+        seen += len(columns)
+        if len(selected):
+            # With two alleles the genotype codes are 0 = AA, 1 = AB, 2 = BB
+            planes.add(np.asarray(chromosome.codes[:, selected]))
+    return planes.finish()
+
+
+# Returns the names of the project's individuals, the number of markers compared and
+# the columns of compare_all
+def project_relatedness(project_id):
+    individuals = db.session.query(Individual.id, Individual.clinic_id, Individual.family_id,
+                                   Individual.member_id).\
+        filter_by(project_id=project_id).order_by(Individual.id).all()
+
+    # Rows are in individual ID order, as are the rows of the genotype matrices
+    families = {}
+    family_rows = []
+    is_parent = []
+    names = []
+    for _, clinic_id, family_id, member_id in individuals:
+        family_rows.append(families.setdefault((clinic_id, family_id), len(families)))
+        is_parent.append(int(member_id) in (FATHER_MEMBER_ID, MOTHER_MEMBER_ID))
+        names.append(full_ind_id(clinic_id, family_id, member_id))
+
+    planes = project_planes(project_id, len(individuals))
+    columns = compare_all(planes, DeclaredFamilies(family_rows, is_parent),
+                          app.config['RELATEDNESS_MIN_MARKERS'], app.config['RELATEDNESS_WORKERS'])
+    return names, planes.num_markers, columns
+
+
+# Compares every pair of the named individuals, one per row of the planes
+def relatedness(names, planes, declared, min_markers, workers=None):
+    columns = compare_all(planes, declared, min_markers, workers)
+    return report_from_columns(names, planes.num_markers, columns)
+
+
+def report_from_columns(names, num_markers, columns):
+    pairs = [RelatedPair(names[a], names[b], int(markers), int(ibs0), int(ibs1), int(ibs2), float(kinship),
+                         int(expected), int(observed))
+             for a, b, markers, ibs0, ibs1, ibs2, kinship, expected, observed in zip(*columns)]
+    pairs.sort(key=lambda pair: -pair.kinship)
+    return RelatednessReport(len(names), num_markers, pairs)
+
+
+# Writer of the cached report file, the compared columns as an uncompressed .npz
+def write_report(project_id, report_file):
+    names, num_markers, columns = project_relatedness(project_id)
+    np.savez(report_file, names=np.array(names, dtype=str), num_markers=num_markers,
+             **dict(zip(REPORT_COLUMNS, columns)))
+
+
+def read_report(path):
+    with np.load(path, allow_pickle=False) as stored:
+        return report_from_columns(stored['names'].tolist(), int(stored['num_markers']),
+                                   [stored[column] for column in REPORT_COLUMNS])
+
+
+reports = OrderedDict()
+reports_lock = Lock()
+
+
+# The relatedness report of a project, computed again only once its data has changed
+def check_project_relatedness(project):
+    key = (project.id, project.data_version)
+    with reports_lock:
+        report = reports.get(key)
+        if report is not None:
+            reports.move_to_end(key)
+            return report
+
+    report = read_report(cached_file(project.id, project.data_version, REPORT_FILE_KIND, write_report))
+    with reports_lock:
+        reports[key] = report
+        while len(reports) > REPORT_CACHE_SIZE:
+            reports.popitem(last=False)
+    return report
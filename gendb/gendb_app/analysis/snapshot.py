@@ -0,0 +1,242 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from gendb_app import app, db
+from gendb_app.models import Project
+from gendb_app.analysis import genotypes as database
+from gendb_app.analysis.genotypes import ChromosomeGenotypes, CodeMatrixLookup, chromosome_markers, \
+    project_individual_ids
+
+# Materialised genotypes of each project: per chromosome, the individuals x markers code
+# matrix is kept as a .npy file beside the individual and marker IDs of its rows and
+# columns, and is read back memory mapped rather than from the genotype table.
+#
+# A chromosome's snapshot is only used while its individuals and markers are still
+# those of the project and catalogue, and it was written at the project's current
+# Project.data_version. Uploaded genotypes are written into the matrix in place once
+# committed, moving it on to the version they committed. Any chromosome that has gone
+# stale (new individuals or markers, an upload that could not be applied in place, or
+# one whose snapshot update never ran) is rebuilt from the database the next time it is
+# read.
+
+
+def project_dir(project_id):
+    return os.path.join(app.config['SNAPSHOT_DIR'], str(int(project_id)))
+
+
+def codes_path(directory, chromosome):
+    return os.path.join(directory, 'chr{}.npy'.format(chromosome))
+
+
+def index_path(directory, chromosome):
+    return os.path.join(directory, 'chr{}.index.npz'.format(chromosome))
+
+
+# Writers of a project's snapshot hold the lock exclusively, readers shared, so a
+# reader never sees the matrix of one build with the index of another. Rebuilds hold it
+# while reading the database, so genotypes stored meanwhile are written into the new
+# matrix rather than the one it replaces
+@contextmanager
+def snapshot_lock(directory, exclusive):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ids_of(markers):
+    return np.array([marker.id for marker in markers], dtype=np.int64)
+
+
+def project_data_version(project_id):
+    return db.session.query(Project.data_version).filter(Project.id == project_id).scalar()
+
+
+# The data version the chromosome's snapshot was written at, None if there is none
+def snapshot_version(directory, chromosome):
+    try:
+        with np.load(index_path(directory, chromosome)) as index:
+            return int(index['data_version']) if 'data_version' in index else None
+    except FileNotFoundError:
+        return None
+
+
+# The chromosome's matrix, memory mapped, or None if there is no snapshot or it is stale
+def read_chromosome(directory, chromosome, ind_ids, markers, data_version, mode='r'):
+    try:
+        with np.load(index_path(directory, chromosome)) as index:
+            stored_ind_ids, stored_marker_ids = index['ind_ids'], index['marker_ids']
+            # Snapshots written before they were versioned are stale
+            stored_version = int(index['data_version']) if 'data_version' in index else None
+        codes = np.load(codes_path(directory, chromosome), mmap_mode=mode)
+    except FileNotFoundError:
+        return None
+
+    if stored_version != data_version or not (np.array_equal(stored_ind_ids, ind_ids) and
+                                               np.array_equal(stored_marker_ids, ids_of(markers))):
+        return None
+    return ChromosomeGenotypes(chromosome, ind_ids, markers, codes)
+
+
+# Each file is written under a new name and moved into place, readers that already have
+# the old matrix mapped keep reading it
+def write_chromosome(directory, genotypes, data_version):
+    suffix = '.{}.tmp'.format(uuid.uuid4().hex)
+    codes_tmp = codes_path(directory, genotypes.chromosome) + suffix
+    try:
+        with open(codes_tmp, 'wb') as codes_file:
+            np.save(codes_file, genotypes.codes)
+        os.replace(codes_tmp, codes_path(directory, genotypes.chromosome))
+    finally:
+        if os.path.exists(codes_tmp):
+            os.remove(codes_tmp)
+    write_index(directory, genotypes, data_version)
+
+
+def write_index(directory, genotypes, data_version):
+    index_tmp = index_path(directory, genotypes.chromosome) + '.{}.tmp'.format(uuid.uuid4().hex)
+    try:
+        with open(index_tmp, 'wb') as index_file:
+            np.savez(index_file, ind_ids=genotypes.ind_ids, marker_ids=ids_of(genotypes.markers),
+                     data_version=data_version)
+        os.replace(index_tmp, index_path(directory, genotypes.chromosome))
+    finally:
+        if os.path.exists(index_tmp):
+            os.remove(index_tmp)
+
+
+def remove_chromosome(directory, chromosome):
+    for path in (codes_path(directory, chromosome), index_path(directory, chromosome)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Rebuilt snapshots are given the data version read before their genotypes. Genotypes
+# committed between the two make the snapshot look older than it is, so at worst it is
+# rebuilt again, never kept out of date
+def save_chromosomes(project_id, chromosomes):
+    directory = project_dir(project_id)
+    with snapshot_lock(directory, exclusive=True):
+        data_version = project_data_version(project_id)
+        for genotypes in database.iter_chromosomes(project_id, chromosomes):
+            write_chromosome(directory, genotypes, data_version)
+
+
+# Projects without individuals have nothing to map, and are always read from the database
+def use_snapshot(ind_ids):
+    return app.config['SNAPSHOT_ENABLED'] and len(ind_ids) > 0
+
+
+# Yields the genotypes of a project one chromosome at a time, as
+# gendb_app.analysis.genotypes.iter_chromosomes, reading them from the snapshot. Stale
+# chromosomes are rebuilt first
+def iter_chromosomes(project_id):
+    ind_ids = project_individual_ids(project_id)
+    if not use_snapshot(ind_ids):
+        for genotypes in database.iter_chromosomes(project_id):
+            yield genotypes
+        return
+
+    directory = project_dir(project_id)
+    by_chromosome = chromosome_markers()
+    data_version = project_data_version(project_id)
+    with snapshot_lock(directory, exclusive=False):
+        stale = {chromosome for chromosome, markers in by_chromosome.items()
+                 if read_chromosome(directory, chromosome, ind_ids, markers, data_version) is None}
+    if stale:
+        save_chromosomes(project_id, stale)
+
+    for chromosome, markers in by_chromosome.items():
+        with snapshot_lock(directory, exclusive=False):
+            genotypes = read_chromosome(directory, chromosome, ind_ids, markers, data_version)
+        # Changed again since it was rebuilt, read this once from the database
+        if genotypes is None:
+            genotypes = database.load_chromosome(project_id, chromosome, ind_ids)
+        yield genotypes
+
+
+# A project's genotypes on a single chromosome, read from the snapshot
+def load_chromosome(project_id, chromosome, ind_ids=None):
+    project_ind_ids = project_individual_ids(project_id)
+    markers = chromosome_markers().get(chromosome)
+    # Only whole projects are kept in the snapshot
+    if not use_snapshot(project_ind_ids) or not markers or \
+            (ind_ids is not None and not np.array_equal(ind_ids, project_ind_ids)):
+        return database.load_chromosome(project_id, chromosome, ind_ids)
+
+    directory = project_dir(project_id)
+    data_version = project_data_version(project_id)
+    with snapshot_lock(directory, exclusive=False):
+        genotypes = read_chromosome(directory, chromosome, project_ind_ids, markers, data_version)
+    if genotypes is not None:
+        return genotypes
+
+    with snapshot_lock(directory, exclusive=True):
+        # Another request may have rebuilt it while this one waited for the lock
+        genotypes = read_chromosome(directory, chromosome, project_ind_ids, markers, data_version)
+        if genotypes is None:
+            genotypes = database.load_chromosome(project_id, chromosome, project_ind_ids)
+            write_chromosome(directory, genotypes, data_version)
+    return genotypes
+
+
+# Brings the snapshot up to date with a change to the project's data, after it is
+# committed along with one bump of the project's data version. Call it after every such
+# commit, even one storing no genotypes, or the whole snapshot is rebuilt when next read.
+# 'genotype_rows' are the (ind_id, marker_id, call_1, call_2) rows written, which are
+# copied into the matrices in place. Without them the chromosomes of the given markers
+# are left to be rebuilt when read.
+#
+# Only chromosomes written at the version before the commit are moved on to the
+# committed version. Any other missed a change, such as an upload whose snapshot update
+# never ran, and is left to be rebuilt
+def update_snapshot(project_id, marker_ids, genotype_rows=None):
+    if not app.config['SNAPSHOT_ENABLED']:
+        return
+
+    directory = project_dir(project_id)
+    if not os.path.isdir(directory):
+        return
+
+    by_chromosome = chromosome_markers()
+    chromosome_of = {marker.id: chromosome for chromosome, markers in by_chromosome.items() for marker in markers}
+    rows_of = defaultdict(list)
+    for row in genotype_rows or ():
+        rows_of[chromosome_of.get(row[1])].append(row)
+    written = {chromosome_of[marker_id] for marker_id in marker_ids if marker_id in chromosome_of}
+    ind_ids = project_individual_ids(project_id)
+
+    with snapshot_lock(directory, exclusive=True):
+        data_version = project_data_version(project_id)
+        for chromosome, markers in by_chromosome.items():
+            stored_version = snapshot_version(directory, chromosome)
+            # Rebuilt since the commit, or never built
+            if stored_version == data_version or stored_version is None:
+                continue
+
+            genotypes = None
+            if stored_version == data_version - 1 and (chromosome not in written or rows_of.get(chromosome)):
+                genotypes = read_chromosome(directory, chromosome, ind_ids, markers, stored_version, mode='r+')
+            if genotypes is None:
+                remove_chromosome(directory, chromosome)
+                continue
+
+            rows = rows_of.get(chromosome)
+            if rows:
+                rows_pos, cols, codes = CodeMatrixLookup(ind_ids, genotypes.markers).locate(*zip(*rows))
+                genotypes.codes[rows_pos, cols] = codes
+                genotypes.codes.flush()
+            write_index(directory, genotypes, data_version)
+
+
+def remove_snapshot(project_id):
+    shutil.rmtree(project_dir(project_id), ignore_errors=True)
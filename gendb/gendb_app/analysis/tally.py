@@ -0,0 +1,99 @@
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import and_, bindparam
+
+from gendb_app import db
+from gendb_app.models import GenotypeTally, Individual
+from gendb_app.analysis.genotypes import genotype_code, num_codes
+
+# Number of marker IDs per IN clause when reading existing tallies
+QUERY_CHUNK_SIZE = 1000
+
+
+def genotype_class(call_1, call_2):
+    return (call_1, call_2) if call_1 <= call_2 else (call_2, call_1)
+
+
+# Adds the given (marker_id, call_1, call_2) -> count increments to a project's tallies,
+# increments may be negative when stored genotypes are replaced
+def apply_increments(project_id, increments):
+    increments = {key: n for key, n in increments.items() if n != 0}
+    if not increments:
+        return
+
+    marker_ids = sorted({marker_id for marker_id, _, _ in increments})
+    existing = set()
+    for start in range(0, len(marker_ids), QUERY_CHUNK_SIZE):
+        chunk = marker_ids[start:start + QUERY_CHUNK_SIZE]
+        existing.update(db.session.query(GenotypeTally.marker_id, GenotypeTally.call_1, GenotypeTally.call_2).
+                        filter(GenotypeTally.project_id == project_id, GenotypeTally.marker_id.in_(chunk)))
+
+    updates = []
+    inserts = []
+    for (marker_id, call_1, call_2), n in increments.items():
+        if (marker_id, call_1, call_2) in existing:
+            updates.append({'b_marker_id': marker_id, 'b_call_1': call_1, 'b_call_2': call_2, 'b_n': n})
+        else:
+            inserts.append({'project_id': project_id, 'marker_id': marker_id,
+                            'call_1': call_1, 'call_2': call_2, 'n_genotypes': n})
+
+    table = GenotypeTally.__table__
+    if updates:
+        statement = table.update().\
+            where(and_(table.c.project_id == project_id,
+                       table.c.marker_id == bindparam('b_marker_id'),
+                       table.c.call_1 == bindparam('b_call_1'),
+                       table.c.call_2 == bindparam('b_call_2'))).\
+            values(n_genotypes=table.c.n_genotypes + bindparam('b_n'))
+        db.session.execute(statement, updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+
+# Counts a validated upload batch into the project's tallies, in the caller's transaction.
+# 'genotypes' are the Genotype objects being inserted. 'replaced' maps (ind_id,
+# marker_id) to the stored (call_1, call_2) of any genotypes the batch overwrites.
+# Missing calls are not stored, so are not counted either: a marker's missing calls are
+# the project's individuals less its called genotypes.
+def update_tally(project_id, genotypes, replaced=None):
+    increments = Counter()
+    for geno in genotypes:
+        increments[(geno.marker_id,) + genotype_class(geno.call_1, geno.call_2)] += 1
+        if replaced:
+            old = replaced.get((geno.ind_id, geno.marker_id))
+            if old is not None:
+                increments[(geno.marker_id,) + genotype_class(*old)] -= 1
+
+    apply_increments(project_id, increments)
+
+
+def clear_tally(project_id):
+    GenotypeTally.query.filter_by(project_id=project_id).delete()
+
+
+# Genotype class counts of a project at the given cached markers, as the markers x codes
+# matrix used by gendb_app.analysis.qc
+def tally_counts(project_id, markers):
+    max_alleles = max([len(marker.alleles) for marker in markers] + [1])
+    counts = np.zeros((len(markers), num_codes(max_alleles)), dtype=np.int64)
+    column_of = {marker.id: column for column, marker in enumerate(markers)}
+
+    rows = db.session.query(GenotypeTally.marker_id, GenotypeTally.call_1,
+                            GenotypeTally.call_2, GenotypeTally.n_genotypes).\
+        filter(GenotypeTally.project_id == project_id)
+
+    for marker_id, call_1, call_2, n in rows:
+        column = column_of.get(marker_id)
+        if column is None:
+            continue
+
+        alleles = markers[column].alleles
+        if call_1 in alleles and call_2 in alleles:
+            counts[column, genotype_code(alleles.index(call_1), alleles.index(call_2))] += n
+
+    return counts
+
+
+def project_individual_count(project_id):
+    return Individual.query.filter_by(project_id=project_id).count()
@@ -1,20 +1,50 @@
+from gendb_app import app
 from gendb_app.filehandling.handling import csv_to_markers, csv_to_individuals, csv_to_phenotypes, csv_to_genotypes
-from io import StringIO
+from gendb_app.filehandling.users import csv_to_users
+from gendb_app.filehandling.compression import open_upload, READ_ERRORS
+from gendb_app.filehandling.exceptions import UploadFileError
+from io import TextIOWrapper
 import csv
 
 
-def file_to_obj_list(file_type, file_handle, project_id):
-    contents = file_handle.stream.read().decode('utf-8')
-    stream = StringIO(contents, newline=None)
-    csv_input = csv.reader(stream)
+# Reads the upload a row at a time, compressed uploads are decompressed as they are read
+def file_to_csv(file_handle):
+    stream = TextIOWrapper(open_upload(file_handle.stream), encoding='utf-8', newline=None)
+    return UploadRows(csv.reader(stream))
+
+
+# Iterator over the rows of an upload, counting the rows read so far
+class UploadRows(object):
+    def __init__(self, csv_input):
+        self.csv_input = csv_input
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            row = next(self.csv_input)
+        except READ_ERRORS as e:
+            raise UploadFileError("The file could not be read: {}".format(e))
+        self.count += 1
+        return row
+
+
+# 'csv_input' is the rows of the upload, as returned by file_to_csv. 'skipped' and
+# 'progress' are passed on to the handlers other than markers, see handling.row_chunks
+def file_to_obj_list(file_type, csv_input, project_id, skipped=0, progress=None):
+    max_errors = app.config['UPLOAD_ERROR_CAP']
 
     if file_type == "MARKERS":
-        return csv_to_markers(csv_input)
+        return csv_to_markers(csv_input, max_errors)
     elif file_type == "INDIVIDUALS":
-        return csv_to_individuals(csv_input, project_id)
+        return csv_to_individuals(csv_input, project_id, max_errors, skipped, progress)
     elif file_type == "PHENOTYPES":
-        return csv_to_phenotypes(csv_input, project_id)
+        return csv_to_phenotypes(csv_input, project_id, max_errors, skipped, progress)
     elif file_type == "GENOTYPES":
-        return csv_to_genotypes(csv_input, project_id)
+        return csv_to_genotypes(csv_input, project_id, max_errors, skipped, progress)
+    elif file_type == "USERS":
+        return csv_to_users(csv_input, max_errors)
 
     # TODO else statement
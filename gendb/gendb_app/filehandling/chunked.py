@@ -0,0 +1,100 @@
+from hashlib import sha1
+from itertools import chain, islice
+
+from gendb_app import app, db
+from gendb_app.models import Project, UploadState
+from gendb_app.filehandling import file_to_csv, file_to_obj_list
+
+# Chunked ingest of individual, phenotype and genotype uploads, used when UPLOAD_CHUNKED
+# is set. The whole file is validated first, as for any upload, then the result is stored
+# and committed about UPLOAD_COMMIT_CHUNK_SIZE rows at a time. Each commit also records
+# the rows stored so far in the upload's UploadState, and the chunk's objects are then
+# expunged so the session never holds more than one chunk. Uploading the same file again
+# after an interrupted ingest skips the rows already committed rather than starting again.
+
+# Lines before the first data row of each upload type
+HEADER_LINES = {"INDIVIDUALS": 0, "PHENOTYPES": 1, "GENOTYPES": 0}
+
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+# SHA-1 of the uploaded file's contents as sent, leaving the stream at its start
+def upload_digest(stream):
+    digest = sha1()
+    for block in iter(lambda: stream.read(DIGEST_BLOCK_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class ChunkedUpload(object):
+    def __init__(self, file_handle, file_type, project_id, filename, user_email):
+        self.file_type = file_type
+        self.project_id = project_id
+        self.header_lines = HEADER_LINES[file_type]
+        digest = upload_digest(file_handle.stream)
+
+        self.state = UploadState.query.filter_by(project_id=project_id, upload_type=file_type,
+                                                 digest=digest, finished=False).first()
+        if self.state is None:
+            self.state = UploadState(project_id=project_id, upload_type=file_type, digest=digest,
+                                     filename=filename, user_email=user_email, committed_rows=0)
+        # Data rows stored by an earlier, interrupted upload of the same file
+        self.skipped = self.state.committed_rows
+        self.rows = file_to_csv(file_handle)
+        # (line, length of each result list) after each chunk the handler validated
+        self.progress = []
+
+    # Data rows of the file read so far, skipped ones included
+    @property
+    def num_rows(self):
+        return max(self.rows.count - self.header_lines, 0)
+
+    # Validates the rows not yet committed, returning the same as file_to_obj_list
+    def validate(self):
+        header = list(islice(self.rows, self.header_lines))
+        # The file may be compressed, so committed rows are read past rather than seeked over
+        for _ in islice(self.rows, self.skipped):
+            pass
+        return file_to_obj_list(self.file_type, chain(header, self.rows), self.project_id,
+                                self.skipped, self.progress)
+
+    # Stores the result of validate() a chunk at a time, each chunk in its own transaction,
+    # and returns the sum of what 'store' returns. 'store' is given the chunk's part of each
+    # result list (the genotype handler returns two) and stores it in the open transaction.
+    # 'committed', if given, is called the same way once the chunk is committed. The upload
+    # is marked finished, to be committed by the caller along with its log entry.
+    def commit(self, result, store, committed=None):
+        parts = result if isinstance(result, tuple) else (result,)
+        chunk_rows = app.config['UPLOAD_COMMIT_CHUNK_SIZE']
+        self.state.total_rows = self.num_rows
+        db.session.add(self.state)
+        # Objects the request already had, such as the current user, stay in the session
+        kept = set(db.session.identity_map.values())
+        kept.add(self.state)
+
+        num_inserted = 0
+        start_line = self.header_lines + self.skipped
+        starts = (0,) * len(parts)
+        for index, (line, *ends) in enumerate(self.progress):
+            if line - start_line < chunk_rows and index < len(self.progress) - 1:
+                continue
+
+            chunk = [part[start:end] for part, start, end in zip(parts, starts, ends)]
+            num_inserted += store(*chunk)
+            self.state.committed_rows = line - self.header_lines
+            Project.bump_data_version(self.project_id, individuals=self.file_type == "INDIVIDUALS")
+            db.session.commit()
+
+            for obj in list(db.session.identity_map.values()):
+                if obj not in kept:
+                    db.session.expunge(obj)
+            # Let the committed objects be freed
+            for part, start, end in zip(parts, starts, ends):
+                part[start:end] = [None] * (end - start)
+            if committed is not None:
+                committed(*chunk)
+            start_line, starts = line, tuple(ends)
+
+        self.state.finished = True
+        return num_inserted
@@ -0,0 +1,63 @@
+import bz2
+import gzip
+import io
+import lzma
+import zipfile
+import zlib
+
+from gendb_app.filehandling.exceptions import UploadFileError
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZIP_MAGIC = b'PK\x03\x04'
+
+# Errors raised part way through reading a damaged compressed file
+READ_ERRORS = (OSError, EOFError, lzma.LZMAError, zlib.error, zipfile.BadZipFile, UnicodeDecodeError)
+
+
+# Gives file-like objects that are not io streams, such as SpooledTemporaryFile before
+# Python 3.11, the interface TextIOWrapper needs
+class RawUpload(io.RawIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Returns a binary stream of the uploaded file's contents, decompressing gzip, bzip2,
+# xz and single file zip uploads as they are read. The format is found from the
+# file's first bytes rather than its name
+def open_upload(stream):
+    magic = stream.read(len(XZ_MAGIC))
+    stream.seek(0)
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if magic.startswith(BZIP2_MAGIC):
+        return bz2.BZ2File(stream, mode='rb')
+    if magic.startswith(XZ_MAGIC):
+        return lzma.LZMAFile(stream, mode='rb')
+    if magic.startswith(ZIP_MAGIC):
+        return open_zip_member(stream)
+    if not isinstance(stream, io.IOBase):
+        return io.BufferedReader(RawUpload(stream))
+    return stream
+
+
+def open_zip_member(stream):
+    try:
+        archive = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile:
+        raise UploadFileError("The zip file could not be read")
+
+    members = [member for member in archive.infolist() if not member.is_dir()]
+    if len(members) != 1:
+        raise UploadFileError("A zip file should contain exactly one file, found {}".format(len(members)))
+    return archive.open(members[0])
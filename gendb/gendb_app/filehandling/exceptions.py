@@ -1,4 +1,10 @@
+from collections import Counter
+
+
+# A single cell of an error report, a report row is a tuple of these
 class ErrorObject(object):
+    __slots__ = ('message', 'error')
+
     def __init__(self, message, error=None):
         self.message = message
         self.error = error
@@ -7,6 +13,25 @@ class ErrorObject(object):
         return self.message
 
 
+# The rows of an upload's error report. Once 'max_rows' rows have been collected the
+# handler stops reading the file and 'truncated' is set. 'classes' counts the rows by
+# the name of the exception that caused them
+class ErrorList(list):
+    def __init__(self, max_rows=None):
+        super().__init__()
+        self.max_rows = max_rows
+        self.truncated = False
+        self.classes = Counter()
+
+    def add(self, row, error):
+        self.append(row)
+        self.classes[error.__name__ if isinstance(error, type) else type(error).__name__] += 1
+
+    @property
+    def full(self):
+        return self.max_rows is not None and len(self) >= self.max_rows
+
+
 class IncorrectNumberOfColumnsError(ValueError):
     def __init__(self, message):
         super().__init__(message)
@@ -22,6 +47,15 @@ class NoObjectToInsertException(Exception):
         super().__init__()
 
 
+# Raised for a genotype row where both calls are missing, nothing is inserted for it
+# but the row still counts when looking for genotypes repeated in the file
+class MissingGenotypeException(NoObjectToInsertException):
+    def __init__(self, ind_id, marker_id):
+        super().__init__()
+        self.ind_id = ind_id
+        self.marker_id = marker_id
+
+
 # TODO: move specific errors over to this general error with column number
 class CsvCellError(ValueError):
     def __init__(self, col_num, message):
@@ -62,4 +96,17 @@ class MarkerNumAllelesError(ValueError):
 
 class MarkerChromosomeOutOfRange(ValueError):
     def __init__(self, message):
-        super().__init__(message)
\ No newline at end of file
+        super().__init__(message)
+
+
+# Raised for a row repeating a record given earlier in the same file
+class DuplicateInFileError(ValueError):
+    def __init__(self, message, col_num=0):
+        super().__init__(message)
+        self.col_num = col_num
+
+
+# Raised when an uploaded file cannot be read at all, rather than for its contents
+class UploadFileError(ValueError):
+    def __init__(self, message):
+        super().__init__(message)
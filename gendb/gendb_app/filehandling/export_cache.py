@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+import fcntl
+import gzip
+import os
+import re
+import shutil
+import uuid
+
+from gendb_app import app
+from gendb_app.filehandling.exports import EXPORT_FORMATS
+
+# Generated exports are kept on disk, named by project, data version and format, and
+# served from there until the project's data changes. Every change to a project's data
+# bumps Project.data_version, so a cached export is never out of date, only unused.
+# Exports read genotypes from the project's snapshot, which is only used at the data
+# version it was written at (see gendb_app.analysis.snapshot). An export requested
+# between an upload's commit and its snapshot update rebuilds the snapshot rather than
+# caching the genotypes from before the upload under the new version.
+# Files are evicted least recently used first once the cache is larger than
+# EXPORT_CACHE_MAX_BYTES; serving a file updates its modification time.
+# Analysis results kept on disk, such as the relatedness report, are cached the same
+# way under their own kind of file, see cached_file.
+# Exports sent to clients accepting gzip are compressed once, into a copy beside the
+# export that is cached, evicted and removed along with it.
+EXPORT_NAME_PATTERN = re.compile(r'^(\d+)_(\d+)\.(\w+)(?:\.gz)?$')
+GZIP_SUFFIX = '.gz'
+
+
+def export_name(project_id, data_version, export_format):
+    return "{}_{}.{}".format(int(project_id), int(data_version), export_format)
+
+
+def export_path(project_id, data_version, export_format):
+    return os.path.join(app.config['EXPORT_CACHE_DIR'], export_name(project_id, data_version, export_format))
+
+
+# One export of a project and format is generated at a time, across worker processes
+@contextmanager
+def export_lock(project_id, export_format):
+    path = os.path.join(app.config['EXPORT_CACHE_DIR'], "{}.{}.lock".format(int(project_id), export_format))
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Returns the path of the export, generating it if it is not cached
+def cached_export(project_id, data_version, export_format):
+    _, _, writer = EXPORT_FORMATS[export_format]
+    return cached_file(project_id, data_version, export_format, writer)
+
+
+# Returns the path of the project's cached file of the given kind, calling
+# writer(project_id, file) to write it if it is not cached
+def cached_file(project_id, data_version, export_format, writer):
+    path = export_path(project_id, data_version, export_format)
+    if touch(path):
+        return path
+
+    os.makedirs(app.config['EXPORT_CACHE_DIR'], exist_ok=True)
+    with export_lock(project_id, export_format):
+        # Generated by another request while this one waited
+        if touch(path):
+            return path
+
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as export_file:
+                writer(project_id, export_file)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    remove_old_versions(project_id, data_version, export_format)
+    evict(keep=path)
+    return path
+
+
+# Returns the path of the gzip compressed copy of the export, compressing the cached
+# export if there is no copy yet
+def compressed_export(project_id, data_version, export_format):
+    path = cached_export(project_id, data_version, export_format)
+    gzip_path = path + GZIP_SUFFIX
+    if touch(gzip_path):
+        return gzip_path
+
+    with export_lock(project_id, export_format):
+        if touch(gzip_path):
+            return gzip_path
+
+        tmp_path = "{}.{}.tmp".format(gzip_path, uuid.uuid4().hex)
+        try:
+            with open(path, 'rb') as export_file, \
+                    gzip.open(tmp_path, 'wb', compresslevel=app.config['COMPRESS_LEVEL']) as gzip_file:
+                shutil.copyfileobj(export_file, gzip_file)
+            os.replace(tmp_path, gzip_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    evict(keep=gzip_path)
+    return gzip_path
+
+
+# Marks a cached export as used, returns False if it is not cached
+def touch(path):
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def cached_files():
+    cache_dir = app.config['EXPORT_CACHE_DIR']
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        match = EXPORT_NAME_PATTERN.match(name)
+        if match:
+            yield os.path.join(cache_dir, name), int(match.group(1)), int(match.group(2)), match.group(3)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_old_versions(project_id, data_version, export_format):
+    for path, file_project, file_version, file_format in cached_files():
+        if file_project == int(project_id) and file_format == export_format and file_version < int(data_version):
+            remove_file(path)
+
+
+def remove_project_exports(project_id):
+    for path, file_project, _, _ in cached_files():
+        if file_project == int(project_id):
+            remove_file(path)
+
+
+# Removes the least recently used exports until the cache fits in EXPORT_CACHE_MAX_BYTES
+def evict(keep=None):
+    files = []
+    for path, _, _, _ in cached_files():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= app.config['EXPORT_CACHE_MAX_BYTES']:
+            break
+        if path != keep:
+            remove_file(path)
+            total -= size
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+import csv
+import io
+
+import numpy as np
+
+from gendb_app import db
+from gendb_app.models import Individual, Phenotype, PhenotypeDefinition
+from gendb_app.analysis.genotypes import CODE_ALLELE_1, CODE_ALLELE_2, MAX_ALLELES
+from gendb_app.analysis.snapshot import iter_chromosomes
+from gendb_app.analysis.mendel import FATHER_MEMBER_ID, MOTHER_MEMBER_ID
+from gendb_app.filehandling.handling import IND_ID_SEPARATOR, MISSING_DATA_SYM
+
+# Project exports, each written to a binary file object by its writer. Genotypes are
+# read from the project's snapshot, see gendb_app.analysis.snapshot, and written in
+# blocks of about BLOCK_BYTES.
+#
+# PED and MAP are the PLINK text formats. BED, BIM and FAM are the PLINK binary formats,
+# which can only hold markers with at most two alleles, so any others are left out.
+# Member 1 of a family is its father and member 2 its mother, they are written as the
+# parents of the family's other members where they are in the project, and as founders
+# themselves. The phenotype column is left missing; phenotypes are exported as their
+# own matrix.
+
+BLOCK_BYTES = 64 * 1024 * 1024
+
+PLINK_MISSING_ALLELE = ord('0')
+PLINK_MISSING_PHENOTYPE = '-9'
+
+# PLINK BED genotype bits, indexed by genotype code: homozygous first allele,
+# heterozygous, homozygous second allele. Missing genotypes are 0b01
+BED_MAGIC = bytes([0x6c, 0x1b, 0x01])
+BED_BITS = np.array([0b00, 0b10, 0b11], dtype=np.uint8)
+BED_MISSING = 0b01
+
+
+def full_id(ind):
+    return IND_ID_SEPARATOR.join((ind.clinic_id, ind.family_id, str(ind.member_id)))
+
+
+# The project's individuals and genotypes, with the individuals in the row order of
+# the genotype matrices
+def project_genotypes(project_id):
+    chromosomes = list(iter_chromosomes(project_id))
+    by_id = {ind.id: ind for ind in Individual.query.filter_by(project_id=project_id)}
+    if chromosomes:
+        individuals = [by_id[ind_id] for ind_id in chromosomes[0].ind_ids]
+    else:
+        individuals = [by_id[ind_id] for ind_id in sorted(by_id)]
+    return individuals, chromosomes
+
+
+# Full IDs of each family's father and mother in the project, by (clinic, family) then
+# member ID
+def family_parents(individuals):
+    parents = {}
+    for ind in individuals:
+        if ind.member_id in (FATHER_MEMBER_ID, MOTHER_MEMBER_ID):
+            parents.setdefault((ind.clinic_id, ind.family_id), {})[ind.member_id] = full_id(ind)
+    return parents
+
+
+# The first six columns of the PED and FAM formats. 'parents' is from family_parents
+def family_columns(ind, parents):
+    father = mother = '0'
+    if ind.member_id not in (FATHER_MEMBER_ID, MOTHER_MEMBER_ID):
+        family = parents.get((ind.clinic_id, ind.family_id), {})
+        father = family.get(FATHER_MEMBER_ID, '0')
+        mother = family.get(MOTHER_MEMBER_ID, '0')
+    return "{}{}{} {} {} {} {} {}".format(ind.clinic_id, IND_ID_SEPARATOR, ind.family_id, full_id(ind), father,
+                                          mother, ind.gender if ind.gender in (1, 2) else 0,
+                                          PLINK_MISSING_PHENOTYPE)
+
+
+def biallelic(chromosome):
+    return np.array([len(marker.alleles) <= 2 for marker in chromosome.markers], dtype=bool)
+
+
+# Allele characters of each marker, as a markers x alleles matrix
+def allele_chars(markers):
+    chars = np.full((len(markers), MAX_ALLELES), PLINK_MISSING_ALLELE, dtype=np.uint8)
+    for column, marker in enumerate(markers):
+        for index, allele in enumerate(marker.alleles):
+            chars[column, index] = ord(allele)
+    return chars
+
+
+# PED genotype columns of a block of rows of a code matrix, as an individuals x
+# (markers * 4) array of characters: allele, space, allele, space
+def ped_calls(codes, chars):
+    codes = np.asarray(codes)
+    missing = codes < 0
+    safe = np.where(missing, 0, codes)
+    columns = np.arange(codes.shape[1])
+    calls = np.full(codes.shape + (4,), ord(' '), dtype=np.uint8)
+    calls[:, :, 0] = np.where(missing, PLINK_MISSING_ALLELE, chars[columns, CODE_ALLELE_1[safe]])
+    calls[:, :, 2] = np.where(missing, PLINK_MISSING_ALLELE, chars[columns, CODE_ALLELE_2[safe]])
+    return calls.reshape(codes.shape[0], -1)
+
+
+def write_ped(project_id, out):
+    individuals, chromosomes = project_genotypes(project_id)
+    parents = family_parents(individuals)
+    chars = [allele_chars(chromosome.markers) for chromosome in chromosomes]
+    num_markers = sum(len(chromosome.markers) for chromosome in chromosomes)
+    block_rows = max(BLOCK_BYTES // max(num_markers * 4, 1), 1)
+
+    for start in range(0, len(individuals), block_rows):
+        end = min(start + block_rows, len(individuals))
+        parts = [ped_calls(chromosome.codes[start:end], chromosome_chars)
+                 for chromosome, chromosome_chars in zip(chromosomes, chars)]
+        calls = np.concatenate(parts, axis=1) if parts else np.zeros((end - start, 0), dtype=np.uint8)
+        for ind, row in zip(individuals[start:end], calls):
+            out.write(family_columns(ind, parents).encode('utf-8'))
+            if len(row):
+                out.write(b' ')
+                out.write(row[:-1].tobytes())
+            out.write(b'\n')
+
+
+def write_map(project_id, out):
+    _, chromosomes = project_genotypes(project_id)
+    for chromosome in chromosomes:
+        out.write("".join("{} {} 0 {}\n".format(marker.chromosome, marker.name, marker.position)
+                          for marker in chromosome.markers).encode('utf-8'))
+
+
+def write_fam(project_id, out):
+    individuals, _ = project_genotypes(project_id)
+    parents = family_parents(individuals)
+    out.write("".join(family_columns(ind, parents) + "\n" for ind in individuals).encode('utf-8'))
+
+
+def write_bim(project_id, out):
+    _, chromosomes = project_genotypes(project_id)
+    for chromosome in chromosomes:
+        for marker, keep in zip(chromosome.markers, biallelic(chromosome)):
+            if keep:
+                alleles = marker.alleles + ('0',) * (2 - len(marker.alleles))
+                out.write("{} {} 0 {} {} {}\n".format(marker.chromosome, marker.name, marker.position,
+                                                      alleles[0], alleles[1]).encode('utf-8'))
+
+
+# Marker major, each marker's genotypes packed four individuals to a byte
+def write_bed(project_id, out):
+    individuals, chromosomes = project_genotypes(project_id)
+    out.write(BED_MAGIC)
+    num_individuals = len(individuals)
+    padded = -(-num_individuals // 4) * 4
+    block_markers = max(BLOCK_BYTES // max(padded, 1), 1)
+
+    for chromosome in chromosomes:
+        columns = np.flatnonzero(biallelic(chromosome))
+        for start in range(0, len(columns), block_markers):
+            codes = np.asarray(chromosome.codes[:, columns[start:start + block_markers]]).T
+            bits = np.full((codes.shape[0], padded), 0, dtype=np.uint8)
+            bits[:, :num_individuals] = np.where(codes < 0, BED_MISSING, BED_BITS[np.clip(codes, 0, 2)])
+            packed = bits[:, 0::4] | (bits[:, 1::4] << 2) | (bits[:, 2::4] << 4) | (bits[:, 3::4] << 6)
+            out.write(packed.tobytes())
+
+
+# Phenotypes as a CSV file in the upload format, an ID column and then one column per
+# phenotype
+def write_phenotypes(project_id, out):
+    definitions = PhenotypeDefinition.query.filter_by(project_id=project_id).\
+        order_by(PhenotypeDefinition.id).all()
+    column_of = {definition.id: index for index, definition in enumerate(definitions)}
+
+    values = {}
+    query = db.session.query(Phenotype.ind_id, Phenotype.pheno_id, Phenotype.value).\
+        filter(Phenotype.ind_id.in_(db.session.query(Individual.id).filter_by(project_id=project_id)))
+    for ind_id, pheno_id, value in query:
+        values.setdefault(ind_id, [MISSING_DATA_SYM] * len(definitions))[column_of[pheno_id]] = value
+
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(["ID"] + [definition.name for definition in definitions])
+    for ind in Individual.query.filter_by(project_id=project_id).order_by(Individual.id):
+        writer.writerow([full_id(ind)] + values.get(ind.id, [MISSING_DATA_SYM] * len(definitions)))
+    text.flush()
+    text.detach()
+
+
+# Format -> (file extension, mimetype, writer)
+EXPORT_FORMATS = OrderedDict([
+    ('ped', ('ped', 'text/plain', write_ped)),
+    ('map', ('map', 'text/plain', write_map)),
+    ('bed', ('bed', 'application/octet-stream', write_bed)),
+    ('bim', ('bim', 'text/plain', write_bim)),
+    ('fam', ('fam', 'text/plain', write_fam)),
+    ('phenotypes', ('csv', 'text/csv', write_phenotypes)),
+])
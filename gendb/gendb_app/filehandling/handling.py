@@ -1,15 +1,26 @@
-from sqlalchemy.orm.exc import NoResultFound
+from collections import namedtuple
+from itertools import islice
 
-from gendb_app.models import Marker, MarkerAllele, Individual, Phenotype, Genotype
+from sqlalchemy import func
+
+from gendb_app import app, db
+from gendb_app.models import Marker, Individual, Phenotype, PhenotypeDefinition, Genotype
+from gendb_app.marker_cache import marker_cache
 from gendb_app.filehandling.exceptions \
-    import IndividualIDFormatError, IndividualMemberIDError, IndividualGenderError, ErrorObject, \
+    import IndividualIDFormatError, IndividualMemberIDError, IndividualGenderError, ErrorObject, ErrorList, \
     IncorrectNumberOfColumnsError, IndividualIDNotPresentError, PhenotypeValueError, MarkerNumAllelesError, \
-    DataAlreadyInDatabaseError, CsvCellError, NoObjectToInsertException
+    DataAlreadyInDatabaseError, CsvCellError, MissingGenotypeException, DuplicateInFileError
 
 MISSING_DATA_SYM = 'x'
 IND_ID_SEPARATOR = '_'
 VALID_GENDER_VALUES = ['0', '1', '2']
 
+# Number of rows of an upload resolved against the database at once, with one query
+UPLOAD_CHUNK_SIZE = 1000
+
+# A validated row of a markers file, to be inserted into the catalogue
+NewMarker = namedtuple('NewMarker', ['name', 'chromosome', 'position', 'alleles'])
+
 
 # Takes a full individual ID and splits into its three parts
 # Returns false if the format is invalid
@@ -30,54 +41,128 @@ def full_ind_id_to_parts(full_id):
     return clinic, family, member
 
 
-# TODO: Change all handlers to use cleaner code with CsvCellError
-def csv_to_markers(csv_input):
+# Splits the rows of an upload into lists of UPLOAD_CHUNK_SIZE rows.
+# The individual, phenotype and genotype handlers can also be given:
+#   'skipped' - the number of data rows left out from the start of the file, so that
+#               error reports still give the file's own line numbers
+#   'progress' - a list, to which (line number, length of each result list) is appended
+#                after each chunk, for gendb_app.filehandling.chunked to split the
+#                result by line
+def row_chunks(csv_input):
+    rows = iter(csv_input)
+    chunk = list(islice(rows, UPLOAD_CHUNK_SIZE))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, UPLOAD_CHUNK_SIZE))
+
+
+# Resolves the full IDs of a project's individuals to their integer IDs. Projects of up
+# to UPLOAD_PRELOAD_INDIVIDUALS individuals are loaded whole with a single query, larger
+# ones a chunk of rows at a time, loading only the clinics and families named in the chunk
+class ProjectIndividuals(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.ids = {}
+        count = db.session.query(func.count(Individual.id)).filter(Individual.project_id == project_id).scalar()
+        self.preloaded = count <= app.config['UPLOAD_PRELOAD_INDIVIDUALS']
+        if self.preloaded:
+            self.add(self.query())
+
+    def query(self):
+        return db.session.query(Individual.clinic_id, Individual.family_id, Individual.member_id, Individual.id).\
+            filter(Individual.project_id == self.project_id)
+
+    def add(self, rows):
+        for clinic, family, member, ind_id in rows:
+            self.ids[(clinic, family, int(member))] = ind_id
+
+    # Loads the individuals needed by a chunk of rows whose first column is a full ID
+    def load(self, rows):
+        if self.preloaded:
+            return
+
+        clinics = set()
+        families = set()
+        for row in rows:
+            try:
+                clinic, family, _ = full_ind_id_to_parts(row[0])
+                clinics.add(clinic)
+                families.add(family)
+            except (IndexError, IndividualIDFormatError, IndividualMemberIDError):
+                pass
+        self.ids = {}
+        if families:
+            self.add(self.query().filter(Individual.clinic_id.in_(clinics), Individual.family_id.in_(families)))
+
+    # The integer ID of the individual, None if it is not stored
+    def get(self, clinic, family, member):
+        return self.ids.get((clinic, family, int(member)))
+
+
+# Error report row for a problem with the line as a whole
+def line_error(row_num, message):
+    return (ErrorObject(str(row_num), error=message),)
+
+
+# Error report row showing every cell of the line, with the message against one of them
+def cell_error(row_num, row, col_num, message):
+    return (ErrorObject(str(row_num)),) + \
+        tuple(ErrorObject(cell, error=message if index == col_num else None) for index, cell in enumerate(row))
+
+
+# Each handler stops reading the file after 'max_errors' rows with errors. Valid objects
+# are only kept while no error has been found, as they are never inserted
+# Markers are checked against the catalogue a chunk of rows at a time, with one query
+# per chunk, and are only inserted once the whole file is valid. On success the result
+# is the list of NewMarkers to insert, see gendb_app.filehandling.storing.store_markers
+def csv_to_markers(csv_input, max_errors=None):
     markers = []
-    alleles = []
-    errors = []
+    errors = ErrorList(max_errors)
+    # Name -> line of each valid marker read so far
+    first_lines = {}
 
     row_num = 0
-    for row in csv_input:
-        row_num += 1
-
-        try:
-            marker, mk_alleles = row_to_markers(row)
-            markers.append(marker)
-            alleles.extend(mk_alleles)
-        except IncorrectNumberOfColumnsError as e:
-            row_errors = [ErrorObject(str(row_num), error=str(e))]
-            errors.append(row_errors)
-        except MarkerNumAllelesError as e:
-            row_errors = [ErrorObject(str(row_num))]
-            for cell in row[0:3]:
-                row_errors.append(ErrorObject(cell))
-            row_errors.append(ErrorObject(row[3], error=str(e)))
-            errors.append(row_errors)
-        except DataAlreadyInDatabaseError as e:
-            row_errors = [ErrorObject(str(row_num))]
-            row_errors.append(ErrorObject(row[0], error=str(e)))
-            for cell in row[1:]:
-                row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
-        except CsvCellError as e:
-            row_errors = [ErrorObject(str(row_num))]
-            for col_num, cell in enumerate(row):
-                if col_num == e.col_num:
-                    row_errors.append(ErrorObject(cell, error=str(e)))
-                else:
-                    row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
+    for chunk in row_chunks(csv_input):
+        names = {row[0] for row in chunk if row}
+        stored = {name for name, in db.session.query(Marker.name).filter(Marker.name.in_(names))}
+
+        for row in chunk:
+            row_num += 1
+
+            try:
+                marker = row_to_marker(row, stored, first_lines)
+                first_lines[marker.name] = row_num
+                if not errors:
+                    markers.append(marker)
+                continue
+            except IncorrectNumberOfColumnsError as e:
+                errors.add(line_error(row_num, str(e)), e)
+            except MarkerNumAllelesError as e:
+                errors.add(cell_error(row_num, row, 3, str(e)), e)
+            except DataAlreadyInDatabaseError as e:
+                errors.add(cell_error(row_num, row, 0, str(e)), e)
+            except DuplicateInFileError as e:
+                errors.add(cell_error(row_num, row, e.col_num, str(e)), e)
+            except CsvCellError as e:
+                errors.add(cell_error(row_num, row, e.col_num, str(e)), e)
+
+            if errors.full:
+                errors.truncated = True
+                break
+        if errors.truncated:
+            break
 
     error_found = len(errors) != 0
     if error_found:
         return error_found, errors
     else:
-        return error_found, (markers, alleles)
+        return error_found, markers
 
 
-def row_to_markers(row):
+# 'stored' is the names of the row's chunk already in the catalogue, 'first_lines' the
+# markers given earlier in the file
+def row_to_marker(row, stored, first_lines):
     # TODO Possibly add a test that the position is within range for that chromosome
-    # TODO test all given alleles are different
 
     NUM_REQ_COLS = 4
 
@@ -92,11 +177,21 @@ def row_to_markers(row):
     if len(row) != NUM_REQ_COLS + num_alleles:
         raise MarkerNumAllelesError("Given number of alleles ({}) does not match the number given".format(num_alleles))
 
-    result = Marker.query.get(row[0])
-    if result is not None:
+    name = row[0]
+    if name in first_lines:
+        raise DuplicateInFileError("Marker already given on line {}".format(first_lines[name]))
+    if name in stored:
         raise DataAlreadyInDatabaseError("Marker already in database")
 
-    marker = Marker(id=row[0], chromosome=row[1], position=row[2])
+    try:
+        chromosome = int(row[1])
+    except ValueError:
+        raise CsvCellError(1, "Chromosome must be a number")
+    try:
+        position = int(row[2])
+    except ValueError:
+        raise CsvCellError(2, "Position must be a number")
+
     alleles = []
 
     col_num = NUM_REQ_COLS - 1
@@ -112,43 +207,50 @@ def row_to_markers(row):
         if allele_symbol == MISSING_DATA_SYM:
             raise CsvCellError(col_num, "Cannot be the missing data symbol")
 
+        if allele_symbol in alleles:
+            raise CsvCellError(col_num, "Allele already given for this marker")
+
         # TODO Capitalise, same for genotype
-        alleles.append(MarkerAllele(marker=row[0], allele=allele_symbol))
+        alleles.append(allele_symbol)
 
-    return marker, alleles
+    return NewMarker(name, chromosome, position, tuple(alleles))
 
 
-def csv_to_individuals(csv_input, project_id):
+def csv_to_individuals(csv_input, project_id, max_errors=None, skipped=0, progress=None):
     individuals = []
-    errors = []
-
-    row_num = 0
-    for row in csv_input:
-        row_num += 1
-        try:
-            ind = row_to_individual(row, project_id)
-            individuals.append(ind)
-        except IncorrectNumberOfColumnsError as e:
-            row_errors = [ErrorObject(str(row_num), error=str(e))]
-            errors.append(row_errors)
-        except (IndividualIDFormatError, IndividualMemberIDError) as e:
-            row_errors = [row_num,
-                          ErrorObject(row[0], error=str(e)),
-                          ErrorObject(row[1])]
-            errors.append(row_errors)
-        except IndividualGenderError as e:
-            row_errors = [row_num,
-                          ErrorObject(row[0]),
-                          ErrorObject(row[1], error=str(e))]
-            errors.append(row_errors)
-        except CsvCellError as e:
-            row_errors = [ErrorObject(str(row_num))]
-            for col_num, cell in enumerate(row):
-                if col_num == e.col_num:
-                    row_errors.append(ErrorObject(cell, error=str(e)))
-                else:
-                    row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
+    errors = ErrorList(max_errors)
+    stored = ProjectIndividuals(project_id)
+    # (clinic, family, member) -> line of each valid individual read so far
+    first_lines = {}
+
+    row_num = skipped
+    for chunk in row_chunks(csv_input):
+        stored.load(chunk)
+
+        for row in chunk:
+            row_num += 1
+            try:
+                ind = row_to_individual(row, project_id, stored, first_lines)
+                first_lines[(ind.clinic_id, ind.family_id, int(ind.member_id))] = row_num
+                if not errors:
+                    individuals.append(ind)
+                continue
+            except IncorrectNumberOfColumnsError as e:
+                errors.add(line_error(row_num, str(e)), e)
+            except (IndividualIDFormatError, IndividualMemberIDError) as e:
+                errors.add(cell_error(row_num, row, 0, str(e)), e)
+            except IndividualGenderError as e:
+                errors.add(cell_error(row_num, row, 1, str(e)), e)
+            except (CsvCellError, DuplicateInFileError) as e:
+                errors.add(cell_error(row_num, row, e.col_num, str(e)), e)
+
+            if errors.full:
+                errors.truncated = True
+                break
+        if errors.truncated:
+            break
+        if progress is not None:
+            progress.append((row_num, len(individuals)))
 
     error_found = len(errors) != 0
     if error_found:
@@ -157,23 +259,20 @@ def csv_to_individuals(csv_input, project_id):
         return error_found, individuals
 
 
-def row_to_individual(row, project_id):
+# 'stored' is the project's ProjectIndividuals, 'first_lines' the individuals given
+# earlier in the file
+def row_to_individual(row, project_id, stored, first_lines):
     if len(row) != 2:
         raise IncorrectNumberOfColumnsError("Expected 2 columns, got {}".format(len(row)))
 
     clinic, family, member = full_ind_id_to_parts(row[0])
     gender = row[1]
 
-    # Get integer individual ID
-    try:
-        ind = Individual.query.filter_by(project_id=project_id, clinic_id=clinic,
-                                         family_id=family, member_id=member).one()
-
-        # An existing individual with these details exists
+    line = first_lines.get((clinic, family, int(member)))
+    if line is not None:
+        raise DuplicateInFileError("An individual with this ID is already given on line {}".format(line))
+    if stored.get(clinic, family, member) is not None:
         raise CsvCellError(0, "An individual with this ID already exists in this project")
-    except NoResultFound:
-        # Do nothing, expecting no result to already exist
-        pass
 
     if gender not in VALID_GENDER_VALUES:
         raise IndividualGenderError("Not a valid gender value")
@@ -187,51 +286,77 @@ def row_to_individual(row, project_id):
                       gender=gender)
 
 
-def csv_to_phenotypes(csv_input, project_id):
-    error_found = False
+def csv_to_phenotypes(csv_input, project_id, max_errors=None, skipped=0, progress=None):
     phenotypes = []
-    errors = []
+    errors = ErrorList(max_errors)
 
     # Read in list of phenotype names from header
     headers = next(csv_input, None)
     pheno_names = headers.copy()
     pheno_names.pop(0)
 
-    row_num = 1
-    for row in csv_input:
-        row_num += 1
-        try:
-            phenos = row_to_phenotypes(row, project_id, pheno_names)
-            phenotypes.extend(phenos)
-        except IncorrectNumberOfColumnsError as e:
-            error_found = True
-            row_errors = [ErrorObject(str(row_num), error=str(e))]
-            errors.append(row_errors)
-        except IndividualIDNotPresentError as e:
-            error_found = True
-            row_errors = [ErrorObject(str(row_num)),
-                          ErrorObject(row[0], error=str(e))]
-            for cell in row[1:]:
-                row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
-        except PhenotypeValueError as e:
-            error_found = True
-            row_errors = [ErrorObject(str(row_num))]
-            for index, cell in enumerate(row):
-                if index == e.col_num:
-                    row_errors.append(ErrorObject(cell, error=str(e)))
-                else:
-                    row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
+    # Resolve each phenotype name to its definition once for the whole file
+    definitions = resolve_phenotype_definitions(project_id, pheno_names)
+    stored = ProjectIndividuals(project_id)
+    # (individual ID, phenotype name) -> line of each value read so far
+    first_lines = {}
+
+    row_num = 1 + skipped
+    for chunk in row_chunks(csv_input):
+        stored.load(chunk)
+
+        for row in chunk:
+            row_num += 1
+            try:
+                phenos = row_to_phenotypes(row, project_id, definitions, stored, first_lines)
+                for pheno in phenos:
+                    first_lines[(pheno.ind_id, pheno.definition.name)] = row_num
+                if not errors:
+                    phenotypes.extend(phenos)
+                continue
+            except IncorrectNumberOfColumnsError as e:
+                errors.add(line_error(row_num, str(e)), e)
+            except (IndividualIDFormatError, IndividualMemberIDError, IndividualIDNotPresentError) as e:
+                errors.add(cell_error(row_num, row, 0, str(e)), e)
+            except (PhenotypeValueError, DuplicateInFileError) as e:
+                errors.add(cell_error(row_num, row, e.col_num, str(e)), e)
+
+            if errors.full:
+                errors.truncated = True
+                break
+        if errors.truncated:
+            break
+        if progress is not None:
+            progress.append((row_num, len(phenotypes)))
 
+    error_found = len(errors) != 0
     if error_found:
         return error_found, (headers, errors)
     else:
         return error_found, phenotypes
 
 
-def row_to_phenotypes(row, project_id, pheno_names):
-    expected_cols = len(pheno_names) + 1
+# Maps each phenotype name to its definition within the project, in the same order
+# Definitions not yet stored are created and will be inserted along with the first
+# phenotype value that references them
+def resolve_phenotype_definitions(project_id, pheno_names):
+    stored = PhenotypeDefinition.query.filter(PhenotypeDefinition.project_id == project_id,
+                                              PhenotypeDefinition.name.in_(pheno_names)).all()
+    by_name = {definition.name: definition for definition in stored}
+
+    definitions = []
+    for name in pheno_names:
+        if name not in by_name:
+            by_name[name] = PhenotypeDefinition(project_id=project_id, name=name)
+        definitions.append(by_name[name])
+
+    return definitions
+
+
+# 'stored' is the project's ProjectIndividuals, 'first_lines' the values given earlier
+# in the file
+def row_to_phenotypes(row, project_id, definitions, stored, first_lines):
+    expected_cols = len(definitions) + 1
     if len(row) != expected_cols:
         raise IncorrectNumberOfColumnsError("Expected {} columns, got {}".format(expected_cols, len(row)))
 
@@ -239,16 +364,13 @@ def row_to_phenotypes(row, project_id, pheno_names):
     clinic, family, member = full_ind_id_to_parts(full_id)
 
     # Get integer individual ID
-    try:
-        ind = Individual.query.filter_by(project_id=project_id, clinic_id=clinic,
-                                     family_id=family, member_id=member).one()
-    except NoResultFound:
+    ind_id = stored.get(clinic, family, member)
+    if ind_id is None:
         raise IndividualIDNotPresentError("No individual stored with the ID {}".format(full_id))
-    ind_id = ind.id
 
     phenos = []
-    index=0
-    for pheno_val in row[1:]:
+    names = set()
+    for index, pheno_val in enumerate(row[1:]):
 
         if pheno_val is None or pheno_val == "":
             raise PhenotypeValueError(index+1, "Phenotype value cannot be blank")
@@ -257,44 +379,63 @@ def row_to_phenotypes(row, project_id, pheno_names):
             # Nothing to insert into the database
             continue
 
-        pheno = Phenotype(ind_id=ind_id, name=pheno_names[index],
+        name = definitions[index].name
+        line = first_lines.get((ind_id, name))
+        if line is not None:
+            raise DuplicateInFileError("Phenotype already given for this individual on line {}".format(line),
+                                       index + 1)
+        if name in names:
+            raise DuplicateInFileError("Phenotype given more than once on this line", index + 1)
+        names.add(name)
+
+        pheno = Phenotype(ind_id=ind_id, definition=definitions[index],
                           value=pheno_val)
         phenos.append(pheno)
-        index += 1
 
     return phenos
 
 
-def csv_to_genotypes(csv_input, project_id):
+def csv_to_genotypes(csv_input, project_id, max_errors=None, skipped=0, progress=None):
     genotypes = []
-    errors = []
-
-    row_num = 0
-    for row in csv_input:
-        row_num += 1
-
-        try:
-            geno = row_to_genotype(row, project_id)
-            genotypes.append(geno)
-        except NoObjectToInsertException:
-            continue
-        except IncorrectNumberOfColumnsError as e:
-            row_errors = [ErrorObject(str(row_num), error=str(e))]
-            errors.append(row_errors)
-        except (IndividualIDFormatError, IndividualMemberIDError) as e:
-            row_errors = [row_num,
-                          ErrorObject(row[0], error=str(e))]
-            for cell in row[1:]:
-                row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
-        except CsvCellError as e:
-            row_errors = [ErrorObject(str(row_num))]
-            for col_num, cell in enumerate(row):
-                if col_num == e.col_num:
-                    row_errors.append(ErrorObject(cell, error=str(e)))
-                else:
-                    row_errors.append(ErrorObject(cell))
-            errors.append(row_errors)
+    errors = ErrorList(max_errors)
+
+    # Pick up any markers added since the catalogue was last loaded
+    marker_cache.refresh()
+
+    stored = ProjectIndividuals(project_id)
+    # (ind_id, marker_id) -> line of each valid genotype read so far, missing ones included
+    first_lines = {}
+
+    row_num = skipped
+    for chunk in row_chunks(csv_input):
+        stored.load(chunk)
+
+        for row in chunk:
+            row_num += 1
+
+            try:
+                geno = row_to_genotype(row, project_id, stored, first_lines)
+                first_lines[(geno.ind_id, geno.marker_id)] = row_num
+                if not errors:
+                    genotypes.append(geno)
+                continue
+            except MissingGenotypeException as e:
+                first_lines[(e.ind_id, e.marker_id)] = row_num
+                continue
+            except IncorrectNumberOfColumnsError as e:
+                errors.add(line_error(row_num, str(e)), e)
+            except (IndividualIDFormatError, IndividualMemberIDError) as e:
+                errors.add(cell_error(row_num, row, 0, str(e)), e)
+            except (CsvCellError, DuplicateInFileError) as e:
+                errors.add(cell_error(row_num, row, e.col_num, str(e)), e)
+
+            if errors.full:
+                errors.truncated = True
+                break
+        if errors.truncated:
+            break
+        if progress is not None:
+            progress.append((row_num, len(genotypes)))
 
     error_found = len(errors) != 0
     if error_found:
@@ -303,45 +444,43 @@ def csv_to_genotypes(csv_input, project_id):
         return error_found, genotypes
 
 
-def row_to_genotype(row, project_id):
-    # TODO: Test if this ind already has this marker stored
-
+# 'stored' is the project's ProjectIndividuals, 'first_lines' the genotypes given
+# earlier in the file
+def row_to_genotype(row, project_id, stored, first_lines):
     if len(row) != 4:
         raise IncorrectNumberOfColumnsError("Expected 4 columns, got {}".format(len(row)))
 
     clinic, family, member = full_ind_id_to_parts(row[0])
-    marker = row[1]
+    marker_name = row[1]
     call_1 = row[2]
     call_2 = row[3]
 
-    try:
-        ind = Individual.query.filter_by(project_id=project_id, clinic_id=clinic,
-                                     family_id=family, member_id=member).one()
-    except NoResultFound:
+    ind_id = stored.get(clinic, family, member)
+    if ind_id is None:
         raise CsvCellError(0, "No individual stored with this ID")
 
-    try:
-        Marker.query.filter_by(id=marker).one()
-    except NoResultFound:
+    marker = marker_cache.get(marker_name)
+    if marker is None:
         raise CsvCellError(1, "Invalid marker - not stored in marker management system")
 
+    line = first_lines.get((ind_id, marker.id))
+    if line is not None:
+        raise DuplicateInFileError("A genotype for this individual and marker is already given on line {}".format(line),
+                                   col_num=1)
+
     if call_1 == MISSING_DATA_SYM:
         if call_2 == MISSING_DATA_SYM:
             # Don't insert if data missing
-            raise NoObjectToInsertException()
+            raise MissingGenotypeException(ind_id, marker.id)
         else:
             raise CsvCellError(2, "Either both alleles must be missing, or neither")
     elif call_2 == MISSING_DATA_SYM:
         raise CsvCellError(3, "Either both alleles must be missing, or neither")
 
-    try:
-        MarkerAllele.query.filter_by(marker=marker, allele=call_1).one()
-    except NoResultFound:
+    if call_1 not in marker.alleles:
         raise CsvCellError(2, "Not a valid allele for this marker")
 
-    try:
-        MarkerAllele.query.filter_by(marker=marker, allele=call_2).one()
-    except NoResultFound:
+    if call_2 not in marker.alleles:
         raise CsvCellError(3, "Not a valid allele for this marker")
 
-    return Genotype(ind_id=ind.id, marker=marker, call_1=call_1, call_2=call_2)
+    return Genotype(ind_id=ind_id, marker_id=marker.id, call_1=call_1, call_2=call_2)
@@ -0,0 +1,103 @@
+import fcntl
+import os
+import time
+
+from flask import g
+from sqlalchemy import text
+
+from gendb_app import app, db
+from gendb_app.filehandling.exceptions import UploadFileError
+
+# Serialises the part of an upload that writes to its project. Files are still read and
+# validated in parallel, but from the check against the rows already stored until the
+# request ends only one upload per project runs, so two overlapping uploads can no longer
+# both pass and then deadlock or fail on a unique constraint at commit. Uploads into
+# different projects do not wait for each other.
+#
+# On MySQL this is a named lock (GET_LOCK) held on a connection of its own, so it is
+# shared by every worker on every host and survives the commits of a chunked upload.
+# Other databases use a file lock in UPLOAD_LOCK_DIR, which only covers one host. SQLite
+# has a single writer, so there every upload shares one lock whatever its project.
+#
+# The checks made once the lock is held must see what the upload before committed,
+# although the request's transaction began before the lock was taken. On MySQL that
+# needs READ COMMITTED, set up in gendb_app/__init__.py.
+
+# How often a waiting upload tries a file lock again
+LOCK_POLL_SECONDS = 0.1
+
+
+class MySQLUploadLock(object):
+    def __init__(self, project_id):
+        # Lock names are server wide, so include the database
+        self.name = "{}.upload.{}".format(db.engine.url.database, int(project_id))
+        self.conn = None
+
+    def acquire(self, timeout):
+        self.conn = db.engine.connect()
+        acquired = self.conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                     {'name': self.name, 'timeout': timeout}).scalar()
+        if acquired != 1:
+            self.conn.close()
+            return False
+        return True
+
+    def release(self):
+        try:
+            self.conn.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': self.name})
+        finally:
+            self.conn.close()
+
+
+class FileUploadLock(object):
+    def __init__(self, name):
+        self.path = os.path.join(app.config['UPLOAD_LOCK_DIR'], "{}.lock".format(name))
+        self.lock_file = None
+
+    def acquire(self, timeout):
+        os.makedirs(app.config['UPLOAD_LOCK_DIR'], exist_ok=True)
+        self.lock_file = open(self.path, 'a')
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self.lock_file.close()
+                    return False
+                time.sleep(LOCK_POLL_SECONDS)
+
+    def release(self):
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        finally:
+            self.lock_file.close()
+
+
+# Waits up to UPLOAD_LOCK_TIMEOUT seconds for the project's upload lock, which is then
+# held until the end of the request. Call before the upload's first write, or its first
+# read of rows another upload could be writing
+def lock_project_uploads(project_id):
+    if g.get('upload_lock') is not None:
+        return
+
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        lock = MySQLUploadLock(project_id)
+    elif dialect == 'sqlite':
+        lock = FileUploadLock('all')
+    else:
+        lock = FileUploadLock("project-{}".format(int(project_id)))
+    if not lock.acquire(app.config['UPLOAD_LOCK_TIMEOUT']):
+        raise UploadFileError("Another upload into this project is still being stored, please try again later")
+    g.upload_lock = lock
+
+
+@app.teardown_appcontext
+def release_upload_lock(exc):
+    lock = g.pop('upload_lock', None)
+    if lock is not None:
+        # Whatever the upload left uncommitted is rolled back before the next one starts
+        db.session.rollback()
+        lock.release()
@@ -0,0 +1,98 @@
+from itertools import islice
+import json
+import os
+import re
+import time
+import uuid
+
+from gendb_app import app
+from gendb_app.filehandling.exceptions import ErrorObject
+
+# Error reports of failed uploads are stored as JSON lines files, named by a random ID.
+# The first line holds the report details and each following line one row of errors,
+# as a list of [cell, error] pairs, so a page can be read without loading the report
+REPORT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+REPORT_SUFFIX = '.jsonl'
+
+
+class ErrorReport(object):
+    def __init__(self, report_id, details):
+        self.report_id = report_id
+        self.title = details['title']
+        self.filename = details['filename']
+        self.headers = details['headers']
+        self.owner = details['owner']
+        self.num_rows = details['rows']
+        self.truncated = details['truncated']
+        self.created = details['created']
+
+    # Yields the error rows from 'start' onwards, at most 'count' of them
+    def rows(self, start=0, count=None):
+        stop = None if count is None else start + count
+        with open(report_path(self.report_id), encoding='utf-8') as report_file:
+            # Skip the details line
+            next(report_file)
+            for line in islice(report_file, start, stop):
+                yield tuple(ErrorObject(message, error) for message, error in json.loads(line))
+
+
+def report_path(report_id):
+    if not REPORT_ID_PATTERN.match(report_id):
+        raise ValueError("Invalid report ID")
+    return os.path.join(app.config['UPLOAD_REPORT_DIR'], report_id + REPORT_SUFFIX)
+
+
+# Writes the errors of a failed upload and returns the ID of the stored report.
+# 'errors' is the ErrorList returned by one of the file handlers
+def save_error_report(owner, title, filename, headers, errors):
+    report_dir = app.config['UPLOAD_REPORT_DIR']
+    os.makedirs(report_dir, exist_ok=True)
+    remove_expired_reports()
+
+    report_id = uuid.uuid4().hex
+    path = report_path(report_id)
+    details = {
+        'title': title,
+        'filename': filename,
+        'headers': list(headers),
+        'owner': owner,
+        'rows': len(errors),
+        'truncated': errors.truncated,
+        'created': time.time(),
+    }
+
+    # Written under a temporary name so a partly written report is never read
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as report_file:
+        report_file.write(json.dumps(details) + '\n')
+        for row in errors:
+            report_file.write(json.dumps([[cell.message, cell.error] for cell in row]) + '\n')
+    os.replace(tmp_path, path)
+
+    return report_id
+
+
+# Returns the stored report, or None if it does not exist or has expired
+def load_error_report(report_id):
+    try:
+        with open(report_path(report_id), encoding='utf-8') as report_file:
+            details = json.loads(report_file.readline())
+    except (ValueError, OSError):
+        return None
+
+    if time.time() - details['created'] > app.config['UPLOAD_REPORT_MAX_AGE']:
+        return None
+    return ErrorReport(report_id, details)
+
+
+def remove_expired_reports():
+    report_dir = app.config['UPLOAD_REPORT_DIR']
+    oldest = time.time() - app.config['UPLOAD_REPORT_MAX_AGE']
+    for name in os.listdir(report_dir):
+        path = os.path.join(report_dir, name)
+        try:
+            if name.endswith(REPORT_SUFFIX) and os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError:
+            # Removed by another worker
+            pass
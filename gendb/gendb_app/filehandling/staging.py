@@ -0,0 +1,437 @@
+from collections import Counter
+
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, select, and_, func, exists, case
+
+from gendb_app import db
+from gendb_app.models import Individual, Marker, MarkerAllele, Genotype, Phenotype
+from gendb_app.analysis.tally import apply_increments
+from gendb_app.filehandling.handling import full_ind_id_to_parts, resolve_phenotype_definitions, \
+    line_error, MISSING_DATA_SYM
+from gendb_app.filehandling.exceptions import ErrorObject, ErrorList, IndividualIDFormatError, \
+    IndividualMemberIDError, IndividualIDNotPresentError, IncorrectNumberOfColumnsError, CsvCellError, \
+    PhenotypeValueError, DataAlreadyInDatabaseError, DuplicateInFileError
+from gendb_app.filehandling.storing import create_temporary_table, genotype_insert, \
+    UPLOAD_MODE_FAIL, UPLOAD_MODE_SKIP, UPLOAD_MODE_OVERWRITE
+from gendb_app.filehandling.locking import lock_project_uploads
+
+# An alternative to the row by row handlers in gendb_app.filehandling.handling. The file
+# is only checked for its shape while it is read, each row going into a temporary
+# staging table. Everything that needs the database (unknown individuals and markers,
+# invalid alleles, duplicates) is then found with a few set-based queries, and the
+# valid rows are moved into their table with a single INSERT ... SELECT.
+
+# Number of rows per insert into a staging table
+STAGE_BATCH_SIZE = 10000
+
+# Raw cells are staged as text no matter their length, too long values simply fail to match
+RAW_LENGTH = 255
+
+
+# Errors found while staging a file, as line -> {column: message}. A column of None is
+# an error with the line as a whole. Each error is given the exception class the row by
+# row handlers would have raised for it, for the upload metrics.
+class StagedErrors(object):
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.cells = {}
+        self.classes = {}
+        # Cells of the lines with errors found while reading, the rest come from the staging table
+        self.rows = {}
+        self.truncated = False
+
+    @property
+    def full(self):
+        return self.max_rows is not None and len(self.cells) >= self.max_rows
+
+    def add(self, line, col_num, error_class, message, row=None):
+        self.classes.setdefault(line, []).append(error_class)
+        line_errors = self.cells.setdefault(line, {})
+        if col_num in line_errors:
+            message = line_errors[col_num] + "; " + message
+        line_errors[col_num] = message
+        if row is not None:
+            self.rows[line] = row
+
+    # Adds the lines matched by a query of staging table line numbers, ordered by line
+    def add_query(self, conn, query, col_num, error_class, message):
+        if self.max_rows is not None:
+            query = query.limit(self.max_rows)
+        lines = [line for line, in conn.execute(query)]
+        if self.max_rows is not None and len(lines) == self.max_rows:
+            # There may be more lines than were fetched
+            self.truncated = True
+        for line in lines:
+            self.add(line, col_num, error_class, message)
+
+    # Builds the report in the same form as the row by row handlers. 'rows_of' is given
+    # the lines whose cells were not kept while reading and returns line -> cells
+    def report(self, rows_of):
+        lines = sorted(self.cells)
+        errors = ErrorList(self.max_rows)
+        if self.max_rows is not None and len(lines) > self.max_rows:
+            lines = lines[:self.max_rows]
+            self.truncated = True
+        errors.truncated = self.truncated
+
+        rows = dict(self.rows)
+        rows.update(rows_of([line for line in lines if line not in rows]))
+        for line in lines:
+            for error_class in self.classes[line]:
+                errors.classes[error_class.__name__] += 1
+            line_errors = self.cells[line]
+            if None in line_errors:
+                errors.append(line_error(line, line_errors[None]))
+            else:
+                errors.append((ErrorObject(str(line)),) +
+                              tuple(ErrorObject(cell, error=line_errors.get(index))
+                                    for index, cell in enumerate(rows.get(line, ()))))
+        return errors
+
+
+# Rows are staged as they are read, 'stage_row' returns the staged values of a row or
+# None if it was rejected
+def stage_rows(conn, table, csv_input, errors, stage_row, first_line=1):
+    batch = []
+    line = first_line - 1
+    for row in csv_input:
+        line += 1
+        staged = stage_row(line, row)
+        if staged:
+            batch.extend(staged)
+        if errors.full:
+            errors.truncated = True
+            break
+        if len(batch) >= STAGE_BATCH_SIZE:
+            conn.execute(table.insert(), batch)
+            batch = []
+
+    if batch:
+        conn.execute(table.insert(), batch)
+
+
+def id_parts(line, row, errors):
+    try:
+        return full_ind_id_to_parts(row[0])
+    except (IndividualIDFormatError, IndividualMemberIDError) as e:
+        errors.add(line, 0, type(e), str(e), row)
+        return None
+
+
+# Fills in the staged rows' individual IDs from their clinic, family and member IDs
+def resolve_individuals(conn, stage, project_id):
+    ind = Individual.__table__
+    conn.execute(stage.update().values(ind_id=select([ind.c.id]).where(
+        and_(ind.c.project_id == project_id,
+             ind.c.clinic_id == stage.c.clinic_id,
+             ind.c.family_id == stage.c.family_id,
+             ind.c.member_id == stage.c.member_id)).as_scalar()))
+
+
+#
+#   Genotypes
+#
+
+
+def genotype_stage_table():
+    return Table('tmp_stage_genotype', MetaData(),
+                 Column('line', Integer, primary_key=True, autoincrement=False),
+                 Column('ind', String(RAW_LENGTH)),
+                 Column('clinic_id', String(RAW_LENGTH)),
+                 Column('family_id', String(RAW_LENGTH)),
+                 Column('member_id', Integer),
+                 Column('marker', String(RAW_LENGTH)),
+                 Column('call_1', String(RAW_LENGTH)),
+                 Column('call_2', String(RAW_LENGTH)),
+                 Column('ind_id', Integer),
+                 Column('marker_id', Integer),
+                 Index('ix_tmp_stage_genotype_keys', 'ind_id', 'marker_id'),
+                 prefixes=['TEMPORARY'])
+
+
+def genotype_class_columns(call_1, call_2):
+    return case([(call_1 <= call_2, call_1)], else_=call_2), case([(call_1 <= call_2, call_2)], else_=call_1)
+
+
+# Validates and stores a genotype file in the caller's transaction, updating the
+# project's tallies. Returns (error_found, errors) or (error_found, (genotypes written,
+# genotypes already stored, marker IDs written to)), following the upload 'mode' of
+# gendb_app.filehandling.storing
+def stage_genotypes(csv_input, project_id, mode, max_errors=None):
+    conn = db.session.connection()
+    stage = genotype_stage_table()
+    create_temporary_table(conn, stage)
+    try:
+        errors = StagedErrors(max_errors)
+
+        def stage_row(line, row):
+            if len(row) != 4:
+                errors.add(line, None, IncorrectNumberOfColumnsError,
+                           "Expected 4 columns, got {}".format(len(row)), row)
+                return None
+            parts = id_parts(line, row, errors)
+            if parts is None:
+                return None
+            clinic, family, member = parts
+            return [{'line': line, 'ind': row[0], 'clinic_id': clinic, 'family_id': family,
+                     'member_id': int(member), 'marker': row[1], 'call_1': row[2], 'call_2': row[3]}]
+
+        stage_rows(conn, stage, csv_input, errors, stage_row)
+        # Staged rows are private to the connection, only the checks against stored
+        # genotypes and the insert need to wait for other uploads into the project
+        lock_project_uploads(project_id)
+        if not errors.full:
+            check_genotypes(conn, stage, project_id, mode, errors)
+
+        if errors.cells:
+            return True, errors.report(lambda lines: staged_genotype_rows(conn, stage, lines))
+
+        return False, insert_genotypes(conn, stage, project_id, mode)
+    finally:
+        stage.drop(bind=conn)
+
+
+def check_genotypes(conn, stage, project_id, mode, errors):
+    marker = Marker.__table__
+    allele = MarkerAllele.__table__
+    stored = Genotype.__table__
+
+    resolve_individuals(conn, stage, project_id)
+    conn.execute(stage.update().values(
+        marker_id=select([marker.c.id]).where(marker.c.name == stage.c.marker).as_scalar()))
+
+    def lines(condition):
+        return select([stage.c.line]).where(condition).order_by(stage.c.line)
+
+    def not_allele(call):
+        return and_(stage.c.marker_id.isnot(None), call != MISSING_DATA_SYM,
+                    ~exists().where(and_(allele.c.marker_id == stage.c.marker_id, allele.c.allele == call)))
+
+    call_1, call_2 = stage.c.call_1, stage.c.call_2
+    errors.add_query(conn, lines(stage.c.ind_id.is_(None)), 0, CsvCellError,
+                     "No individual stored with this ID")
+    errors.add_query(conn, lines(stage.c.marker_id.is_(None)), 1, CsvCellError,
+                     "Invalid marker - not stored in marker management system")
+    errors.add_query(conn, lines(and_(call_1 == MISSING_DATA_SYM, call_2 != MISSING_DATA_SYM)), 2,
+                     CsvCellError, "Either both alleles must be missing, or neither")
+    errors.add_query(conn, lines(and_(call_1 != MISSING_DATA_SYM, call_2 == MISSING_DATA_SYM)), 3,
+                     CsvCellError, "Either both alleles must be missing, or neither")
+    errors.add_query(conn, lines(not_allele(call_1)), 2, CsvCellError, "Not a valid allele for this marker")
+    errors.add_query(conn, lines(not_allele(call_2)), 3, CsvCellError, "Not a valid allele for this marker")
+
+    # Repeats within the file, a window over the single staging table as MySQL cannot
+    # refer to a temporary table twice in one query
+    keys = (stage.c.ind_id, stage.c.marker_id)
+    numbered = select([stage.c.line, func.row_number().over(partition_by=keys, order_by=stage.c.line).label('n')]).\
+        where(and_(stage.c.ind_id.isnot(None), stage.c.marker_id.isnot(None))).alias('numbered')
+    errors.add_query(conn, select([numbered.c.line]).where(numbered.c.n > 1).order_by(numbered.c.line), 1,
+                     DuplicateInFileError, "Genotype for this individual and marker is repeated in the file")
+
+    if mode == UPLOAD_MODE_FAIL:
+        errors.add_query(conn, lines(and_(call_1 != MISSING_DATA_SYM, already_stored(stage, stored))), 0,
+                         DataAlreadyInDatabaseError, "A genotype is already stored for this individual and marker")
+
+
+def already_stored(stage, stored):
+    return exists().where(and_(stored.c.ind_id == stage.c.ind_id, stored.c.marker_id == stage.c.marker_id))
+
+
+def staged_genotype_rows(conn, stage, lines):
+    query = select([stage.c.line, stage.c.ind, stage.c.marker, stage.c.call_1, stage.c.call_2]).\
+        where(stage.c.line.in_(lines))
+    return {row[0]: tuple(row[1:]) for row in conn.execute(query)} if lines else {}
+
+
+# Moves the validated staged genotypes into the genotype table and counts them into the
+# tallies. Returns the number of genotypes written, the number already stored and the
+# IDs of the markers written to
+def insert_genotypes(conn, stage, project_id, mode):
+    stored = Genotype.__table__
+    called = stage.c.call_1 != MISSING_DATA_SYM
+    is_stored = and_(called, already_stored(stage, stored))
+    num_existing = conn.execute(select([func.count()]).select_from(stage).where(is_stored)).scalar() \
+        if mode != UPLOAD_MODE_FAIL else 0
+
+    # Tally increments of the incoming called rows, and decrements of any stored rows
+    # they replace
+    increments = Counter()
+    counted = and_(called, ~already_stored(stage, stored)) if mode == UPLOAD_MODE_SKIP else called
+    class_1, class_2 = genotype_class_columns(stage.c.call_1, stage.c.call_2)
+    query = select([stage.c.marker_id, class_1, class_2, func.count()]).where(counted).\
+        group_by(stage.c.marker_id, class_1, class_2)
+    for marker_id, call_1, call_2, n in conn.execute(query):
+        increments[(marker_id, call_1, call_2)] += n
+    num_inserted = sum(increments.values())
+    marker_ids = {marker_id for marker_id, _, _ in increments}
+
+    if mode == UPLOAD_MODE_OVERWRITE and num_existing:
+        old_1, old_2 = genotype_class_columns(stored.c.call_1, stored.c.call_2)
+        query = select([stored.c.marker_id, old_1, old_2, func.count()]).\
+            select_from(stage.join(stored, and_(stored.c.ind_id == stage.c.ind_id,
+                                                stored.c.marker_id == stage.c.marker_id))).\
+            where(called).group_by(stored.c.marker_id, old_1, old_2)
+        for marker_id, call_1, call_2, n in conn.execute(query):
+            increments[(marker_id, call_1, call_2)] -= n
+
+    columns = ['ind_id', 'marker_id', 'call_1', 'call_2']
+    rows = select([stage.c.ind_id, stage.c.marker_id, stage.c.call_1, stage.c.call_2]).where(called)
+    if mode == UPLOAD_MODE_OVERWRITE and num_existing:
+        statement = genotype_insert(mode, conn.dialect.name)
+        if statement is None:
+            replace_staged_genotypes(conn, stage)
+            statement = stored.insert()
+            rows = rows.where(~already_stored(stage, stored))
+    else:
+        statement = stored.insert()
+        rows = rows.where(~already_stored(stage, stored)) if num_existing else rows
+    conn.execute(statement.from_select(columns, rows))
+
+    apply_increments(project_id, increments)
+    return num_inserted, num_existing, marker_ids
+
+
+# Overwrites stored genotypes from the staging table where no upsert is available
+def replace_staged_genotypes(conn, stage):
+    stored = Genotype.__table__
+
+    def staged(column):
+        return select([column]).where(and_(stage.c.ind_id == stored.c.ind_id,
+                                           stage.c.marker_id == stored.c.marker_id)).as_scalar()
+
+    matched = exists().where(and_(stage.c.ind_id == stored.c.ind_id, stage.c.marker_id == stored.c.marker_id,
+                                  stage.c.call_1 != MISSING_DATA_SYM))
+    conn.execute(stored.update().where(matched).values(call_1=staged(stage.c.call_1),
+                                                       call_2=staged(stage.c.call_2)))
+
+
+#
+#   Phenotypes
+#
+
+
+def phenotype_stage_table():
+    return Table('tmp_stage_phenotype', MetaData(),
+                 Column('line', Integer, nullable=False),
+                 Column('col', Integer, nullable=False),
+                 Column('ind', String(RAW_LENGTH)),
+                 Column('clinic_id', String(RAW_LENGTH)),
+                 Column('family_id', String(RAW_LENGTH)),
+                 Column('member_id', Integer),
+                 Column('pheno_id', Integer),
+                 Column('value', String(RAW_LENGTH)),
+                 Column('ind_id', Integer),
+                 Index('ix_tmp_stage_phenotype_line', 'line', 'col'),
+                 prefixes=['TEMPORARY'])
+
+
+# Validates and stores a phenotype file in the caller's transaction. Returns
+# (error_found, (headers, errors)) or (error_found, number of values stored)
+def stage_phenotypes(csv_input, project_id, max_errors=None):
+    headers = next(csv_input, None)
+    if headers is None:
+        errors = StagedErrors(max_errors)
+        errors.add(1, None, IncorrectNumberOfColumnsError, "The file is empty, expected a header row")
+        return True, ([], errors.report(lambda lines: {}))
+    pheno_names = headers[1:]
+
+    # A phenotype named twice would be staged twice under one definition, the row by
+    # row handler rejects each such value as given more than once on its line
+    errors = header_errors(headers, max_errors)
+    if errors.cells:
+        return True, (headers, errors.report(lambda lines: {}))
+
+    # New definitions are flushed so that their IDs can be staged, they are rolled
+    # back with the rest of the upload if any error is found. As that writes to the
+    # project, the whole upload waits for any other upload into it
+    lock_project_uploads(project_id)
+    definitions = resolve_phenotype_definitions(project_id, pheno_names)
+    for definition in definitions:
+        if definition.id is None:
+            db.session.add(definition)
+    db.session.flush()
+
+    conn = db.session.connection()
+    stage = phenotype_stage_table()
+    create_temporary_table(conn, stage)
+    try:
+        errors = StagedErrors(max_errors)
+        expected_cols = len(headers)
+
+        def stage_row(line, row):
+            if len(row) != expected_cols:
+                errors.add(line, None, IncorrectNumberOfColumnsError,
+                           "Expected {} columns, got {}".format(expected_cols, len(row)), row)
+                return None
+            parts = id_parts(line, row, errors)
+            blank = [col_num for col_num, value in enumerate(row) if col_num > 0 and value == ""]
+            for col_num in blank:
+                errors.add(line, col_num, PhenotypeValueError, "Phenotype value cannot be blank", row)
+            if parts is None or blank:
+                return None
+            clinic, family, member = parts
+            return [{'line': line, 'col': col_num, 'ind': row[0], 'clinic_id': clinic, 'family_id': family,
+                     'member_id': int(member), 'pheno_id': definitions[col_num - 1].id, 'value': value}
+                    for col_num, value in enumerate(row) if col_num > 0]
+
+        stage_rows(conn, stage, csv_input, errors, stage_row, first_line=2)
+        if not errors.full:
+            check_phenotypes(conn, stage, project_id, errors)
+
+        if errors.cells:
+            return True, (headers, errors.report(lambda lines: staged_phenotype_rows(conn, stage, lines)))
+
+        stored = Phenotype.__table__
+        rows = select([stage.c.ind_id, stage.c.pheno_id, stage.c.value]).\
+            where(stage.c.value != MISSING_DATA_SYM)
+        result = conn.execute(stored.insert().from_select(['ind_id', 'pheno_id', 'value'], rows))
+        return False, result.rowcount
+    finally:
+        stage.drop(bind=conn)
+
+
+def header_errors(headers, max_errors):
+    errors = StagedErrors(max_errors)
+    first_cols = {}
+    for col_num, name in enumerate(headers):
+        if col_num > 0 and name in first_cols:
+            errors.add(1, col_num, DuplicateInFileError,
+                       "Phenotype given more than once in the header, first in column {}".format(
+                           first_cols[name] + 1), headers)
+        first_cols.setdefault(name, col_num)
+    return errors
+
+
+def check_phenotypes(conn, stage, project_id, errors):
+    stored = Phenotype.__table__
+    resolve_individuals(conn, stage, project_id)
+
+    first_cells = select([stage.c.line]).where(stage.c.col == 1).order_by(stage.c.line)
+    errors.add_query(conn, first_cells.where(stage.c.ind_id.is_(None)), 0, IndividualIDNotPresentError,
+                     "No individual stored with this ID")
+
+    numbered = select([stage.c.line, func.row_number().over(partition_by=stage.c.ind_id,
+                                                            order_by=stage.c.line).label('n')]).\
+        where(and_(stage.c.col == 1, stage.c.ind_id.isnot(None))).alias('numbered')
+    errors.add_query(conn, select([numbered.c.line]).where(numbered.c.n > 1).order_by(numbered.c.line), 0,
+                     DuplicateInFileError, "Individual is repeated in the file")
+
+    # Values already stored, found column by column so each error is shown against its cell
+    clashes = select([stage.c.line, stage.c.col]).\
+        where(and_(stage.c.value != MISSING_DATA_SYM,
+                   exists().where(and_(stored.c.ind_id == stage.c.ind_id, stored.c.pheno_id == stage.c.pheno_id)))).\
+        order_by(stage.c.line, stage.c.col)
+    if errors.max_rows is not None:
+        clashes = clashes.limit(errors.max_rows)
+    for line, col_num in conn.execute(clashes):
+        errors.add(line, col_num, DataAlreadyInDatabaseError,
+                   "A value is already stored for this individual and phenotype")
+
+
+def staged_phenotype_rows(conn, stage, lines):
+    if not lines:
+        return {}
+    rows = {}
+    query = select([stage.c.line, stage.c.col, stage.c.ind, stage.c.value]).\
+        where(stage.c.line.in_(lines)).order_by(stage.c.line, stage.c.col)
+    for line, _, ind, value in conn.execute(query):
+        rows.setdefault(line, [ind]).append(value)
+    return {line: tuple(cells) for line, cells in rows.items()}
@@ -0,0 +1,259 @@
+from sqlalchemy import MetaData, Table, Column, Integer, select, and_, bindparam, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from gendb_app import db
+from gendb_app.models import Genotype, Individual, Marker, MarkerAllele, MarkerCatalogue, Phenotype, \
+    PhenotypeDefinition
+from gendb_app.marker_cache import marker_cache
+from gendb_app.analysis.tally import update_tally
+from gendb_app.analysis.snapshot import update_snapshot
+from gendb_app.analysis.families import update_families
+from gendb_app.filehandling.handling import IND_ID_SEPARATOR
+from gendb_app.filehandling.exceptions import ErrorObject, ErrorList, DataAlreadyInDatabaseError
+
+# What to do with incoming genotypes already stored for the same individual and marker
+UPLOAD_MODE_FAIL = 'fail'
+UPLOAD_MODE_SKIP = 'skip'
+UPLOAD_MODE_OVERWRITE = 'overwrite'
+UPLOAD_MODES = (UPLOAD_MODE_FAIL, UPLOAD_MODE_SKIP, UPLOAD_MODE_OVERWRITE)
+
+# Number of rows per insert statement
+INSERT_BATCH_SIZE = 10000
+
+# Number of IDs per IN clause when looking up stored rows
+QUERY_CHUNK_SIZE = 1000
+
+# Columns of the error report of phenotype_conflict_errors
+PHENOTYPE_CONFLICT_HEADERS = ["ID", "Phenotype", "Value"]
+
+
+def execute_batches(conn, statement, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        conn.execute(statement, rows[start:start + INSERT_BATCH_SIZE])
+
+
+# Inserts validated markers and their alleles into the catalogue, in the caller's
+# transaction, returning the number of rows written. Bumping the catalogue version
+# first waits for any other marker upload to commit, see MarkerCatalogue, so the new
+# markers' IDs can be read back in one query as those above the highest ID before the
+# insert
+def store_markers(markers):
+    conn = db.session.connection()
+    table = Marker.__table__
+    MarkerCatalogue.bump_version()
+    last_id = conn.execute(select([func.max(table.c.id)])).scalar() or 0
+
+    execute_batches(conn, table.insert(), [{'name': marker.name, 'chromosome': marker.chromosome,
+                                            'position': marker.position} for marker in markers])
+    names = {marker.name for marker in markers}
+    ids = {name: marker_id for marker_id, name in
+           conn.execute(select([table.c.id, table.c.name]).where(table.c.id > last_id)) if name in names}
+
+    alleles = [{'marker_id': ids[marker.name], 'allele': allele} for marker in markers for allele in marker.alleles]
+    execute_batches(conn, MarkerAllele.__table__.insert(), alleles)
+    MarkerCatalogue.set_last_marker_id(max(ids.values(), default=last_id))
+    return len(markers) + len(alleles)
+
+
+# Adds validated individuals and their families to the caller's transaction, returning
+# the number of individuals
+def store_individuals(project_id, individuals):
+    db.session.add_all(individuals)
+    # Individuals need their IDs before they are added to the family index
+    db.session.flush()
+    update_families(project_id, individuals)
+    return len(individuals)
+
+
+# Adds validated phenotypes to the caller's transaction, returning the number of values
+def store_phenotypes(phenotypes):
+    db.session.add_all(phenotypes)
+    return len(phenotypes)
+
+
+# The (ind_id, pheno_id) of any incoming phenotypes with a value already stored. Those
+# of phenotypes new to the project have no definition ID yet, so cannot be stored.
+# Definitions that were new when the file was validated may have been stored by another
+# upload since, the phenotypes are first pointed at the stored ones
+def stored_phenotypes(project_id, phenotypes):
+    new = {pheno.definition.name for pheno in phenotypes if pheno.definition.id is None}
+    if new:
+        stored = {definition.name: definition for definition in
+                  PhenotypeDefinition.query.filter(PhenotypeDefinition.project_id == project_id,
+                                                   PhenotypeDefinition.name.in_(new))}
+        for pheno in phenotypes:
+            if pheno.definition.id is None and pheno.definition.name in stored:
+                pheno.definition = stored[pheno.definition.name]
+
+    incoming = {(pheno.ind_id, pheno.definition.id) for pheno in phenotypes if pheno.definition.id is not None}
+    ind_ids = sorted({ind_id for ind_id, _ in incoming})
+
+    stored = set()
+    for start in range(0, len(ind_ids), QUERY_CHUNK_SIZE):
+        query = db.session.query(Phenotype.ind_id, Phenotype.pheno_id).\
+            filter(Phenotype.ind_id.in_(ind_ids[start:start + QUERY_CHUNK_SIZE]))
+        stored.update((ind_id, pheno_id) for ind_id, pheno_id in query if (ind_id, pheno_id) in incoming)
+    return stored
+
+
+# Creates a temporary table on the session's connection, replacing any left behind by
+# an earlier upload that was rolled back on the same connection
+def create_temporary_table(conn, table):
+    table.drop(bind=conn, checkfirst=True)
+    table.create(bind=conn)
+
+
+# The stored calls of any incoming genotypes that already exist, as
+# (ind_id, marker_id) -> (call_1, call_2). The incoming keys are loaded into a
+# temporary table and joined against the genotype table in one query.
+def stored_genotypes(genotypes):
+    if not genotypes:
+        return {}
+
+    conn = db.session.connection()
+    incoming = Table('tmp_incoming_genotype', MetaData(),
+                     Column('ind_id', Integer, nullable=False),
+                     Column('marker_id', Integer, nullable=False),
+                     prefixes=['TEMPORARY'])
+    create_temporary_table(conn, incoming)
+    try:
+        execute_batches(conn, incoming.insert(),
+                        [{'ind_id': geno.ind_id, 'marker_id': geno.marker_id} for geno in genotypes])
+
+        stored = Genotype.__table__
+        query = select([stored.c.ind_id, stored.c.marker_id, stored.c.call_1, stored.c.call_2]).\
+            select_from(incoming.join(stored, and_(stored.c.ind_id == incoming.c.ind_id,
+                                                   stored.c.marker_id == incoming.c.marker_id)))
+        return {(ind_id, marker_id): (call_1, call_2) for ind_id, marker_id, call_1, call_2 in conn.execute(query)}
+    finally:
+        incoming.drop(bind=conn)
+
+
+# Insert statement for the upload mode, using the database's own way of ignoring or
+# replacing rows that clash with the genotype unique constraint
+def genotype_insert(mode, dialect):
+    table = Genotype.__table__
+    if mode == UPLOAD_MODE_SKIP:
+        if dialect == 'mysql':
+            return table.insert().prefix_with('IGNORE')
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR IGNORE')
+    elif mode == UPLOAD_MODE_OVERWRITE:
+        if dialect == 'mysql':
+            statement = mysql_insert(table)
+            return statement.on_duplicate_key_update(call_1=statement.inserted.call_1,
+                                                     call_2=statement.inserted.call_2)
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR REPLACE')
+    return None
+
+
+# Stores validated genotypes and updates the project's tallies, in the caller's
+# transaction. 'existing' is the result of stored_genotypes for the same genotypes
+def store_genotypes(project_id, genotypes, existing, mode):
+    conn = db.session.connection()
+    rows = [{'ind_id': geno.ind_id, 'marker_id': geno.marker_id,
+             'call_1': geno.call_1, 'call_2': geno.call_2} for geno in genotypes]
+
+    if not existing:
+        execute_batches(conn, Genotype.__table__.insert(), rows)
+        update_tally(project_id, genotypes)
+        return
+
+    statement = genotype_insert(mode, conn.dialect.name)
+    new_rows = [row for row in rows if (row['ind_id'], row['marker_id']) not in existing]
+    if statement is not None:
+        execute_batches(conn, statement, rows)
+    else:
+        # No upsert available, so replace the stored rows explicitly
+        if mode == UPLOAD_MODE_OVERWRITE:
+            replace_genotypes(conn, [row for row in rows if (row['ind_id'], row['marker_id']) in existing])
+        execute_batches(conn, Genotype.__table__.insert(), new_rows)
+
+    if mode == UPLOAD_MODE_SKIP:
+        update_tally(project_id, [geno for geno in genotypes if (geno.ind_id, geno.marker_id) not in existing])
+    else:
+        update_tally(project_id, genotypes, replaced=existing)
+
+
+# Stores genotypes for ChunkedUpload.commit, one chunk at a time, keeping count of the
+# stored genotypes each upload mode skipped or replaced
+class GenotypeChunkStore(object):
+    def __init__(self, project_id, mode):
+        self.project_id = project_id
+        self.mode = mode
+        self.num_existing = 0
+        self.written = None
+
+    # Returns the number of genotypes inserted or replaced
+    def store(self, genotypes):
+        # Clashes of a failing upload were looked for before any chunk was stored
+        existing = stored_genotypes(genotypes) if self.mode != UPLOAD_MODE_FAIL else {}
+        store_genotypes(self.project_id, genotypes, existing, self.mode)
+        self.num_existing += len(existing)
+        if self.mode == UPLOAD_MODE_SKIP and existing:
+            genotypes = [geno for geno in genotypes if (geno.ind_id, geno.marker_id) not in existing]
+        self.written = [(geno.ind_id, geno.marker_id, geno.call_1, geno.call_2) for geno in genotypes]
+        return len(genotypes)
+
+    # Copies the chunk's genotypes into the project's snapshot once they are committed
+    def committed(self, genotypes):
+        update_snapshot(self.project_id, {row[1] for row in self.written}, self.written)
+        self.written = None
+
+
+def replace_genotypes(conn, rows):
+    table = Genotype.__table__
+    statement = table.update().\
+        where(and_(table.c.ind_id == bindparam('b_ind_id'), table.c.marker_id == bindparam('b_marker_id'))).\
+        values(call_1=bindparam('b_call_1'), call_2=bindparam('b_call_2'))
+    execute_batches(conn, statement, [{'b_ind_id': row['ind_id'], 'b_marker_id': row['marker_id'],
+                                       'b_call_1': row['call_1'], 'b_call_2': row['call_2']} for row in rows])
+
+
+# Error report rows for the incoming genotypes that clash with stored ones, used when the
+# upload mode is to fail. The clashes are only found after the file has been read, so
+# the rows are identified by individual and marker rather than by line number.
+def conflict_errors(genotypes, existing, max_errors=None):
+    errors = ErrorList(max_errors)
+    clashes = [geno for geno in genotypes if (geno.ind_id, geno.marker_id) in existing]
+    if max_errors is not None and len(clashes) > max_errors:
+        clashes = clashes[:max_errors]
+        errors.truncated = True
+
+    full_ids = individual_full_ids({geno.ind_id for geno in clashes})
+    for geno in clashes:
+        call_1, call_2 = existing[(geno.ind_id, geno.marker_id)]
+        message = "A genotype is already stored for this individual and marker ({}, {})".format(call_1, call_2)
+        errors.add((ErrorObject("-"),
+                    ErrorObject(full_ids.get(geno.ind_id, str(geno.ind_id)), error=message),
+                    ErrorObject(marker_cache.get_by_id(geno.marker_id).name),
+                    ErrorObject(geno.call_1),
+                    ErrorObject(geno.call_2)), DataAlreadyInDatabaseError)
+    return errors
+
+
+# Error report rows for the incoming phenotypes with a value already stored, as found by
+# stored_phenotypes, shown with the columns of PHENOTYPE_CONFLICT_HEADERS
+def phenotype_conflict_errors(phenotypes, stored, max_errors=None):
+    errors = ErrorList(max_errors)
+    clashes = [pheno for pheno in phenotypes if (pheno.ind_id, pheno.definition.id) in stored]
+    if max_errors is not None and len(clashes) > max_errors:
+        clashes = clashes[:max_errors]
+        errors.truncated = True
+
+    full_ids = individual_full_ids({pheno.ind_id for pheno in clashes})
+    for pheno in clashes:
+        message = "A value is already stored for this individual and phenotype"
+        errors.add((ErrorObject("-"),
+                    ErrorObject(full_ids.get(pheno.ind_id, str(pheno.ind_id)), error=message),
+                    ErrorObject(pheno.definition.name),
+                    ErrorObject(pheno.value)), DataAlreadyInDatabaseError)
+    return errors
+
+
+def individual_full_ids(ind_ids):
+    full_ids = {}
+    for ind in Individual.query.filter(Individual.id.in_(ind_ids)):
+        full_ids[ind.id] = IND_ID_SEPARATOR.join((ind.clinic_id, ind.family_id, str(ind.member_id)))
+    return full_ids
@@ -0,0 +1,186 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import os
+import re
+
+from werkzeug.security import generate_password_hash
+
+from gendb_app import app, db
+from gendb_app.models import User, Project, ProjectMemship, SystemLog, ProjectLog
+from gendb_app.filehandling.handling import row_chunks, line_error, cell_error
+from gendb_app.filehandling.storing import execute_batches
+from gendb_app.filehandling.exceptions import ErrorList, IncorrectNumberOfColumnsError, \
+    DataAlreadyInDatabaseError, DuplicateInFileError, CsvCellError
+
+# Columns of a users file, the projects column may be left out. Projects are given by
+# ID separated by ';', with ':admin' after those the user is to administer, e.g. 3;5:admin
+USER_COLUMNS = ["Email", "Full name", "Password", "System admin", "Projects"]
+PROJECT_SEPARATOR = ';'
+PROJECT_ADMIN_SUFFIX = 'admin'
+VALID_SYS_ADMIN_VALUES = ['0', '1']
+
+# Shown in place of the password in error reports, which are kept on disk
+MASKED_PASSWORD = '********'
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+MAX_EMAIL_LENGTH = User.__table__.c.email.type.length
+MAX_NAME_LENGTH = User.__table__.c.full_name.type.length
+
+# A validated row of a users file. 'projects' is a list of (project ID, is project admin)
+NewUser = namedtuple('NewUser', ['email', 'full_name', 'password', 'is_sys_admin', 'projects'])
+
+
+# Users are checked against the stored accounts a chunk of rows at a time, with one
+# query per chunk, and are only inserted once the whole file is valid. On success the
+# result is the list of NewUsers to insert, see store_users
+def csv_to_users(csv_input, max_errors=None):
+    users = []
+    errors = ErrorList(max_errors)
+    project_ids = {project_id for project_id, in db.session.query(Project.id)}
+    # Lower case email -> line of each valid user read so far
+    first_lines = {}
+
+    row_num = 0
+    for chunk in row_chunks(csv_input):
+        emails = {row[0].strip() for row in chunk if row}
+        stored = {email.lower() for email, in db.session.query(User.email).filter(User.email.in_(emails))}
+
+        for row in chunk:
+            row_num += 1
+
+            try:
+                user = row_to_user(row, project_ids, stored, first_lines)
+                first_lines[user.email.lower()] = row_num
+                if not errors:
+                    users.append(user)
+                continue
+            except IncorrectNumberOfColumnsError as e:
+                errors.add(line_error(row_num, str(e)), e)
+            except DataAlreadyInDatabaseError as e:
+                errors.add(cell_error(row_num, masked(row), 0, str(e)), e)
+            except DuplicateInFileError as e:
+                errors.add(cell_error(row_num, masked(row), e.col_num, str(e)), e)
+            except CsvCellError as e:
+                errors.add(cell_error(row_num, masked(row), e.col_num, str(e)), e)
+
+            if errors.full:
+                errors.truncated = True
+                break
+        if errors.truncated:
+            break
+
+    error_found = len(errors) != 0
+    if error_found:
+        return error_found, errors
+    else:
+        return error_found, users
+
+
+def masked(row):
+    return row[:2] + [MASKED_PASSWORD] + row[3:]
+
+
+# 'project_ids' is every stored project, 'stored' the lower case emails of the row's
+# chunk that already have accounts and 'first_lines' the users given earlier in the file
+def row_to_user(row, project_ids, stored, first_lines):
+    if len(row) not in (len(USER_COLUMNS) - 1, len(USER_COLUMNS)):
+        raise IncorrectNumberOfColumnsError("Users files should have {} or {} columns".format(
+            len(USER_COLUMNS) - 1, len(USER_COLUMNS)))
+
+    email = row[0].strip()
+    full_name = row[1].strip()
+    password = row[2]
+    is_sys_admin = row[3].strip()
+
+    if not EMAIL_PATTERN.match(email):
+        raise CsvCellError(0, "Invalid email address")
+    if len(email) > MAX_EMAIL_LENGTH:
+        raise CsvCellError(0, "Email addresses can be at most {} characters".format(MAX_EMAIL_LENGTH))
+    if email.lower() in stored:
+        raise DataAlreadyInDatabaseError("A user with this email address already exists")
+    if email.lower() in first_lines:
+        raise DuplicateInFileError("Duplicate of the user on line {}".format(first_lines[email.lower()]))
+    if not full_name:
+        raise CsvCellError(1, "Full name is missing")
+    if len(full_name) > MAX_NAME_LENGTH:
+        raise CsvCellError(1, "Full names can be at most {} characters".format(MAX_NAME_LENGTH))
+    if not password:
+        raise CsvCellError(2, "Password is missing")
+    if is_sys_admin not in VALID_SYS_ADMIN_VALUES:
+        raise CsvCellError(3, "System admin should be 0 or 1")
+
+    projects = row_to_projects(row[4] if len(row) == len(USER_COLUMNS) else '', project_ids)
+    return NewUser(email, full_name, password, is_sys_admin == '1', projects)
+
+
+def row_to_projects(cell, project_ids):
+    projects = []
+    seen = set()
+    for entry in cell.split(PROJECT_SEPARATOR):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        project_id, _, role = entry.partition(':')
+        try:
+            project_id = int(project_id)
+        except ValueError:
+            raise CsvCellError(4, "Project '{}' is not a project ID".format(entry))
+        if role.strip() not in ('', PROJECT_ADMIN_SUFFIX):
+            raise CsvCellError(4, "Project '{}' should be an ID, optionally followed by ':{}'".format(
+                entry, PROJECT_ADMIN_SUFFIX))
+        if project_id not in project_ids:
+            raise CsvCellError(4, "Project {} does not exist".format(project_id))
+        if project_id in seen:
+            raise DuplicateInFileError("Project {} is given more than once".format(project_id), col_num=4)
+
+        seen.add(project_id)
+        projects.append((project_id, role.strip() == PROJECT_ADMIN_SUFFIX))
+    return projects
+
+
+# Hashes the passwords as User.set_password does, on a pool of 'workers' processes (one
+# per core if None). Each hash is deliberately slow, so an import of a few hundred users
+# is bound by them. The pool is started with spawn, so its processes inherit none of the
+# web worker's threads or database connections
+def hash_passwords(passwords, workers=None):
+    hash_password = partial(generate_password_hash, method=app.config['HASH_METHOD'],
+                            salt_length=app.config['SALT_LENGTH'])
+    workers = min(workers or os.cpu_count(), len(passwords))
+    if workers <= 1:
+        return [hash_password(password) for password in passwords]
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(hash_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+# Inserts validated users, their project memberships and the log entries of both in the
+# caller's transaction, with one batched insert per table. The system log gets a summary
+# of the import and an entry per account, as add_user writes, and each project's log an
+# entry per member added, as add_member writes. Returns the number of users and of
+# memberships
+def store_users(users, password_hashes, user_ip, admin_email, filename):
+    conn = db.session.connection()
+    execute_batches(conn, User.__table__.insert(), [
+        {'email': user.email, 'full_name': user.full_name, 'password_hash': password_hash,
+         'is_sys_admin': user.is_sys_admin} for user, password_hash in zip(users, password_hashes)])
+
+    memships = [(user.email, project_id, is_admin) for user in users for project_id, is_admin in user.projects]
+    execute_batches(conn, ProjectMemship.__table__.insert(), [
+        {'user_email': email, 'project_id': project_id, 'is_project_admin': is_admin}
+        for email, project_id, is_admin in memships])
+
+    system_logs = [{'user_ip': user_ip, 'user_email': admin_email,
+                    'message': "Imported {} user accounts from '{}'".format(len(users), filename)}]
+    system_logs += [{'user_ip': user_ip, 'user_email': admin_email,
+                     'message': "Created user account <" + user.email + ">"} for user in users]
+    execute_batches(conn, SystemLog.__table__.insert(), system_logs)
+
+    execute_batches(conn, ProjectLog.__table__.insert(), [
+        {'project_id': project_id, 'user_ip': user_ip, 'user_email': admin_email,
+         'message': "Added user " + email + " as " + ("administrator" if is_admin else "contributor")}
+        for email, project_id, is_admin in memships])
+
+    return len(users), len(memships)
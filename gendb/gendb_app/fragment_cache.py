@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+import os
+import uuid
+
+from flask import request, has_request_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from gendb_app import app
+
+# Rendered fragments of heavy templates, such as the marker catalogue table, cached with
+#
+#   {% cache 'markers', catalogue_version %} ... {% endcache %}
+#
+# A fragment is keyed on its name, the route and the route's arguments, and the values
+# given after the name, which should include the version of any data it shows. Fragments
+# are kept in memory, least recently used first out once they take more than
+# FRAGMENT_CACHE_MAX_BYTES, and in FRAGMENT_CACHE_DIR if set, where every worker process
+# of the host can read them.
+#
+# Routes changing what a fragment shows call invalidate() with its name once committed.
+# That gives the name a new generation, part of every key, so fragments rendered before
+# are no longer found. Generations are kept in FRAGMENT_CACHE_DIR, so an invalidation in
+# one worker reaches the memory of every other. Without the directory they are per
+# worker, which only suits a single worker process.
+
+
+class FragmentCache(object):
+    def __init__(self):
+        self.lock = Lock()
+        # (name, digest) -> rendered fragment
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generations = {}
+        # Lookups, see gendb_app.metrics
+        self.hits = 0
+        self.misses = 0
+
+    def generation_path(self, name):
+        return os.path.join(app.config['FRAGMENT_CACHE_DIR'], "{}.generation".format(name))
+
+    def fragment_path(self, key):
+        return os.path.join(app.config['FRAGMENT_CACHE_DIR'], "{}-{}.html".format(*key))
+
+    def generation(self, name):
+        if app.config['FRAGMENT_CACHE_DIR'] is None:
+            return self.generations.get(name, '')
+        try:
+            with open(self.generation_path(name)) as generation_file:
+                return generation_file.read()
+        except FileNotFoundError:
+            return ''
+
+    # Fragments of the named kind rendered so far are no longer used
+    def invalidate(self, name):
+        generation = uuid.uuid4().hex
+        with self.lock:
+            self.generations[name] = generation
+            for key in [key for key in self.entries if key[0] == name]:
+                self.size -= len(self.entries.pop(key))
+
+        cache_dir = app.config['FRAGMENT_CACHE_DIR']
+        if cache_dir is None:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        write_file(self.generation_path(name), generation)
+        prefix = name + '-'
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(prefix):
+                remove_file(os.path.join(cache_dir, file_name))
+
+    def key(self, name, vary):
+        parts = (self.generation(name), request.endpoint, sorted((request.view_args or {}).items()), vary)
+        return name, sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            fragment = self.entries.get(key)
+            if fragment is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        if app.config['FRAGMENT_CACHE_DIR'] is not None:
+            try:
+                with open(self.fragment_path(key), encoding='utf-8') as fragment_file:
+                    fragment = fragment_file.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.remember(key, fragment)
+                self.hits += 1
+                return fragment
+
+        self.misses += 1
+        return None
+
+    def set(self, key, fragment):
+        self.remember(key, fragment)
+        cache_dir = app.config['FRAGMENT_CACHE_DIR']
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_file(self.fragment_path(key), fragment)
+
+    # Adds the fragment to the memory cache, evicting the least recently used
+    def remember(self, key, fragment):
+        max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+        if len(fragment) > max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = fragment
+            self.size += len(fragment)
+            while self.size > max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    # Returns the cached fragment, rendering it with render_body() if not cached
+    def render(self, name, vary, render_body):
+        if not app.config['FRAGMENT_CACHE_ENABLED'] or not has_request_context():
+            return render_body()
+
+        key = self.key(name, vary)
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = str(render_body())
+            self.set(key, fragment)
+        return fragment
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+
+# Written under a temporary name and moved into place, so that other workers never read
+# a partly written file
+def write_file(path, text):
+    tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+        tmp_file.write(text)
+    os.replace(tmp_path, path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+fragment_cache = FragmentCache()
+
+
+# The {% cache name, value, ... %} ... {% endcache %} template tag
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        vary = []
+        while parser.stream.skip_if('comma'):
+            vary.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('render_fragment', [name, nodes.List(vary)]),
+                               [], [], body).set_lineno(lineno)
+
+    def render_fragment(self, name, vary, caller):
+        return Markup(fragment_cache.render(name, vary, caller))
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice
+from threading import Lock
+
+from gendb_app import db
+from gendb_app.models import Individual, Project
+from gendb_app.filehandling.handling import IND_ID_SEPARATOR
+
+
+def full_ind_id(clinic_id, family_id, member_id):
+    return IND_ID_SEPARATOR.join((clinic_id, family_id, str(member_id)))
+
+
+# In-memory prefix index of every individual's full ID, used by the individual search.
+# Each project's full IDs are kept in a sorted list, beside a list of the matching
+# individual IDs, so the individuals starting with a prefix are found by bisection.
+# Each project's lists are loaded at its Project.individuals_version, which only
+# individuals uploads bump, and a refresh reloads the projects whose version has changed
+# and drops deleted ones. Individual IDs are given out at insert rather than commit, so
+# uploads into different projects can commit out of ID order, and the highest ID seen
+# is no guide to what has been loaded.
+class IndividualIndex(object):
+    def __init__(self):
+        # Project ID -> (sorted full IDs, individual IDs)
+        self.by_project = {}
+        # Project ID -> individuals version its lists were loaded at
+        self.versions = {}
+        self.lock = Lock()
+
+    # Reloads the projects changed since the last refresh. Versions are read before the
+    # individuals, so an upload committed in between is loaded again next time. The
+    # individuals are read and sorted without the lock, searches meanwhile use the
+    # lists already loaded
+    def refresh(self):
+        versions = dict(db.session.query(Project.id, Project.individuals_version))
+
+        with self.lock:
+            for project_id in [project_id for project_id in self.versions if project_id not in versions]:
+                self.by_project.pop(project_id, None)
+                del self.versions[project_id]
+            changed = [project_id for project_id, version in versions.items()
+                       if self.versions.get(project_id) != version]
+        if not changed:
+            return
+
+        rows = db.session.query(Individual.project_id, Individual.clinic_id, Individual.family_id,
+                                Individual.member_id, Individual.id).\
+            filter(Individual.project_id.in_(changed))
+        lists = self.build(changed, rows)
+
+        with self.lock:
+            for project_id in changed:
+                # A refresh that read a later version may have finished first
+                if self.versions.get(project_id, 0) <= versions[project_id]:
+                    self.by_project[project_id] = lists[project_id]
+                    self.versions[project_id] = versions[project_id]
+
+    # Replaces the lists of the given projects with their (project_id, clinic_id,
+    # family_id, member_id, ind_id) rows. Lists are replaced rather than changed, so
+    # searches running meanwhile see either the old or the new lists
+    def load(self, project_ids, rows):
+        lists = self.build(project_ids, rows)
+        with self.lock:
+            self.by_project.update(lists)
+
+    # Project ID -> (sorted full IDs, individual IDs) of the given projects' rows
+    @staticmethod
+    def build(project_ids, rows):
+        new = {project_id: [] for project_id in project_ids}
+        for project_id, clinic_id, family_id, member_id, ind_id in rows:
+            new[project_id].append((full_ind_id(clinic_id, family_id, member_id), ind_id))
+
+        lists = {}
+        for project_id, entries in new.items():
+            entries.sort()
+            lists[project_id] = ([key for key, _ in entries], [ind_id for _, ind_id in entries])
+        return lists
+
+    # Returns up to 'limit' (full ID, project ID, individual ID) of the individuals in the
+    # given projects whose full ID starts with 'prefix', ordered by full ID
+    def search(self, project_ids, prefix, limit):
+        matches = []
+        for project_id in project_ids:
+            keys, ind_ids = self.by_project.get(project_id, ((), ()))
+            start = bisect_left(keys, prefix)
+            end = start
+            while end < len(keys) and end - start < limit and keys[end].startswith(prefix):
+                end += 1
+            matches.append([(keys[i], project_id, ind_ids[i]) for i in range(start, end)])
+        return list(islice(merge(*matches), limit))
+
+    def remove_project(self, project_id):
+        with self.lock:
+            self.by_project.pop(project_id, None)
+            self.versions.pop(project_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.by_project = {}
+            self.versions = {}
+
+
+individual_index = IndividualIndex()
@@ -0,0 +1,220 @@
+from collections import deque, OrderedDict
+from datetime import datetime
+from threading import Lock
+from time import perf_counter
+import cProfile
+import io
+import math
+import pstats
+import random
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from gendb_app import app
+from gendb_app.metrics import observe_request
+
+# Request level timings: wall time, SQL statement count and time, and template render
+# time, aggregated per route for the admin performance page. The figures are kept in
+# memory and are per worker process.
+
+# Number of lines of each sampled profile that are kept
+PROFILE_LINES = 40
+
+
+class RequestTiming(object):
+    __slots__ = ('start', 'sql_count', 'sql_time', 'template_time', 'profiler')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.profiler = None
+
+
+class RouteStats(object):
+    def __init__(self, window):
+        self.count = 0
+        # Wall times of the most recent requests, the percentiles are taken over these
+        self.wall_times = deque(maxlen=window)
+        self.total_wall = 0.0
+        self.max_wall = 0.0
+        self.total_sql_count = 0
+        self.total_sql_time = 0.0
+        self.total_template_time = 0.0
+
+    def record(self, wall, timing):
+        self.count += 1
+        self.wall_times.append(wall)
+        self.total_wall += wall
+        self.max_wall = max(self.max_wall, wall)
+        self.total_sql_count += timing.sql_count
+        self.total_sql_time += timing.sql_time
+        self.total_template_time += timing.template_time
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(int(math.ceil(fraction * len(ordered))) - 1, 0))]
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+            self.slow_queries = deque(maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+            self.profiles = OrderedDict()
+            self.next_profile_id = 1
+            self.since = datetime.utcnow()
+
+    def record(self, endpoint, wall, timing):
+        with self.lock:
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = RouteStats(app.config['INSTRUMENTATION_WINDOW'])
+            route.record(wall, timing)
+
+    def record_slow_query(self, endpoint, statement, seconds):
+        with self.lock:
+            self.slow_queries.appendleft({'time': datetime.utcnow(), 'endpoint': endpoint,
+                                          'seconds': seconds, 'statement': statement})
+
+    def add_profile(self, endpoint, wall, text):
+        with self.lock:
+            profile_id = self.next_profile_id
+            self.next_profile_id += 1
+            self.profiles[profile_id] = {'id': profile_id, 'time': datetime.utcnow(), 'endpoint': endpoint,
+                                         'seconds': wall, 'text': text}
+            while len(self.profiles) > app.config['PROFILE_KEEP']:
+                self.profiles.popitem(last=False)
+
+    # Per route aggregates, slowest total time first. Times are in milliseconds
+    def summary(self):
+        with self.lock:
+            routes = [(endpoint, route.count, sorted(route.wall_times), route.total_wall, route.max_wall,
+                       route.total_sql_count, route.total_sql_time, route.total_template_time)
+                      for endpoint, route in self.routes.items()]
+
+        rows = []
+        for endpoint, count, ordered, total_wall, max_wall, sql_count, sql_time, template_time in routes:
+            rows.append({
+                'endpoint': endpoint,
+                'count': count,
+                'p50': percentile(ordered, 0.50) * 1000,
+                'p95': percentile(ordered, 0.95) * 1000,
+                'p99': percentile(ordered, 0.99) * 1000,
+                'max': max_wall * 1000,
+                'total': total_wall * 1000,
+                'sql_count': sql_count / count,
+                'sql_time': sql_time / count * 1000,
+                'template_time': template_time / count * 1000,
+            })
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+
+request_stats = RequestStats()
+
+
+def current_timing():
+    return g.get('request_timing') if has_request_context() else None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    seconds = perf_counter() - starts.pop()
+
+    timing = current_timing()
+    if timing is not None:
+        timing.sql_count += 1
+        timing.sql_time += seconds
+
+    if seconds >= app.config['SLOW_QUERY_SECONDS']:
+        endpoint = request.endpoint if has_request_context() else None
+        request_stats.record_slow_query(endpoint, statement, seconds)
+
+
+# Jinja template whose render time is added to the current request's timing. Only the
+# outermost template is rendered through render(), so inherited and included templates
+# are not counted twice
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            timing = current_timing()
+            if timing is not None:
+                timing.template_time += perf_counter() - start
+
+
+if app.config['INSTRUMENTATION_ENABLED']:
+    app.jinja_env.template_class = TimedTemplate
+
+
+def should_profile(endpoint):
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    endpoints = app.config['PROFILE_ENDPOINTS']
+    if rate <= 0 or (endpoints is not None and endpoint not in endpoints):
+        return False
+    return random.random() < rate
+
+
+def profile_text(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return out.getvalue()
+
+
+@app.before_request
+def start_request_timing():
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    timing = g.request_timing = RequestTiming()
+
+    if should_profile(request.endpoint):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            timing.profiler = profiler
+        except ValueError:
+            # Another profiler is already running in this process
+            pass
+
+
+# The figures are recorded when the response is closed, so streamed responses include
+# the time taken to send their body
+@app.after_request
+def finish_request_timing(response):
+    timing = g.get('request_timing')
+    if timing is None:
+        return response
+    endpoint = request.endpoint or '<unmatched>'
+
+    def finish():
+        wall = perf_counter() - timing.start
+        if timing.profiler is not None:
+            timing.profiler.disable()
+            request_stats.add_profile(endpoint, wall, profile_text(timing.profiler))
+            timing.profiler = None
+        request_stats.record(endpoint, wall, timing)
+        observe_request(endpoint, wall)
+
+    response.call_on_close(finish)
+    return response
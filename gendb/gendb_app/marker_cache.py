@@ -0,0 +1,90 @@
+from collections import namedtuple
+from threading import Lock
+
+from gendb_app import db
+from gendb_app.models import Marker, MarkerAllele, MarkerCatalogue
+
+
+# Alleles are kept sorted so that every consumer agrees on the allele order of a marker
+CachedMarker = namedtuple('CachedMarker', ['id', 'name', 'chromosome', 'position', 'alleles'])
+
+
+# Bumped by every commit of new markers, see MarkerCatalogue
+def catalogue_version():
+    version, _ = MarkerCatalogue.current()
+    return version
+
+
+# In-memory copy of the marker catalogue, used to resolve marker names to their
+# integer IDs (and back) without querying the database for every genotype row.
+# Markers are only ever inserted, with their alleles, and commit in ID order, so a
+# refresh only loads markers above the last marker ID loaded, up to the one committed
+# with the catalogue version.
+class MarkerCache(object):
+    def __init__(self):
+        self.by_name = {}
+        self.by_id = {}
+        self.version = 0
+        self.last_marker_id = 0
+        self.lock = Lock()
+        # Lookups by name, see gendb_app.metrics
+        self.hits = 0
+        self.misses = 0
+
+    # Loads any markers added since the last refresh, returns the catalogue version
+    def refresh(self):
+        version, last_marker_id = MarkerCatalogue.current()
+
+        with self.lock:
+            # Catalogue was rebuilt (e.g. database restored), start again
+            if version < self.version or last_marker_id < self.last_marker_id:
+                self.by_name, self.by_id = {}, {}
+                self.version = 0
+                self.last_marker_id = 0
+
+            if last_marker_id > self.last_marker_id:
+                # Readers do not take the lock, so the dicts are copied, extended and
+                # swapped in rather than changed while they may be iterating them
+                by_name, by_id = dict(self.by_name), dict(self.by_id)
+                for marker in self.load_range(self.last_marker_id, last_marker_id):
+                    by_name[marker.name] = marker
+                    by_id[marker.id] = marker
+                self.by_name, self.by_id = by_name, by_id
+            self.version = version
+            self.last_marker_id = last_marker_id
+
+        return self.version
+
+    # Returns the CachedMarkers with IDs in (after_id, up_to_id]
+    def load_range(self, after_id, up_to_id):
+        alleles = {}
+        allele_rows = db.session.query(MarkerAllele.marker_id, MarkerAllele.allele).\
+            filter(MarkerAllele.marker_id > after_id, MarkerAllele.marker_id <= up_to_id)
+        for marker_id, allele in allele_rows:
+            alleles.setdefault(marker_id, []).append(allele)
+
+        marker_rows = db.session.query(Marker.id, Marker.name, Marker.chromosome, Marker.position).\
+            filter(Marker.id > after_id, Marker.id <= up_to_id)
+        return [CachedMarker(marker_id, name, chromosome, position, tuple(sorted(alleles.get(marker_id, []))))
+                for marker_id, name, chromosome, position in marker_rows]
+
+    # Returns the cached marker with the given name, or None if not in the catalogue
+    def get(self, name):
+        marker = self.by_name.get(name)
+        if marker is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return marker
+
+    def get_by_id(self, marker_id):
+        return self.by_id.get(marker_id)
+
+    def clear(self):
+        with self.lock:
+            self.by_name, self.by_id = {}, {}
+            self.version = 0
+            self.last_marker_id = 0
+
+
+marker_cache = MarkerCache()
@@ -0,0 +1,145 @@
+import os
+
+from flask import request
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from gendb_app import app
+from gendb_app.marker_cache import marker_cache
+from gendb_app.fragment_cache import fragment_cache
+
+# Prometheus metrics, served in the text format by the /metrics route. When the server
+# runs in several worker processes PROMETHEUS_MULTIPROC_DIR must name an empty directory
+# shared by the workers, each worker then writes its values there and a scrape of any
+# worker reports the sum over all of them.
+
+# Request latency buckets in seconds, uploads and analyses can take minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REQUEST_LATENCY = Histogram('gendb_request_duration_seconds', "Time taken to handle a request",
+                            ['endpoint'], buckets=LATENCY_BUCKETS)
+
+POOL_CHECKED_OUT = Gauge('gendb_db_pool_checked_out', "Database connections currently in use",
+                         multiprocess_mode='livesum')
+POOL_OPEN = Gauge('gendb_db_pool_connections', "Database connections currently open",
+                  multiprocess_mode='livesum')
+
+UPLOAD_ROWS_VALIDATED = Counter('gendb_upload_rows_validated_total', "Rows of uploaded files read and validated",
+                                ['type', 'project'])
+UPLOAD_ROWS_INSERTED = Counter('gendb_upload_rows_inserted_total', "Database rows written by successful uploads",
+                               ['type', 'project'])
+UPLOAD_ERRORS = Counter('gendb_upload_errors_total', "Errors found in failed uploads, by error class",
+                        ['type', 'error'])
+UPLOAD_FAILURES = Counter('gendb_upload_failures_total', "Uploads rejected because of errors in the file",
+                          ['type'])
+
+CACHE_HITS = Counter('gendb_cache_hits_total', "Lookups answered by an in-memory cache", ['cache'])
+CACHE_MISSES = Counter('gendb_cache_misses_total', "Lookups not found in an in-memory cache", ['cache'])
+
+
+#
+#   Database pool
+#
+
+@event.listens_for(Pool, 'connect')
+def pool_connect(dbapi_connection, connection_record):
+    POOL_OPEN.inc()
+
+
+@event.listens_for(Pool, 'close')
+def pool_close(dbapi_connection, connection_record):
+    POOL_OPEN.dec()
+
+
+@event.listens_for(Pool, 'checkout')
+def pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, 'checkin')
+def pool_checkin(dbapi_connection, connection_record):
+    POOL_CHECKED_OUT.dec()
+
+
+#
+#   Caches
+#
+
+# Caches count their own hits and misses as plain integers, so a lookup costs no more
+# than an addition. The counts are copied into the Prometheus counters after each request
+caches = {}
+flushed = {}
+
+
+def register_cache(name, cache):
+    caches[name] = cache
+    flushed[name] = (0, 0)
+
+
+def flush_cache_counts():
+    for name, cache in caches.items():
+        hits, misses = cache.hits, cache.misses
+        last_hits, last_misses = flushed[name]
+        # A cleared cache starts counting again from zero
+        if hits < last_hits or misses < last_misses:
+            last_hits, last_misses = 0, 0
+        if hits > last_hits:
+            CACHE_HITS.labels(name).inc(hits - last_hits)
+        if misses > last_misses:
+            CACHE_MISSES.labels(name).inc(misses - last_misses)
+        flushed[name] = (hits, misses)
+
+
+register_cache('markers', marker_cache)
+register_cache('fragments', fragment_cache)
+
+
+@app.after_request
+def record_cache_counts(response):
+    flush_cache_counts()
+    return response
+
+
+#
+#   Requests and uploads
+#
+
+def observe_request(endpoint, seconds):
+    REQUEST_LATENCY.labels(endpoint).observe(seconds)
+
+
+# Records an upload of the given type ('markers', 'individuals', 'phenotypes' or
+# 'genotypes'). 'errors' is the ErrorList of a failed upload, None if it succeeded
+def record_upload(file_type, project_id, validated, inserted=0, errors=None):
+    project = str(project_id) if project_id is not None else ''
+    UPLOAD_ROWS_VALIDATED.labels(file_type, project).inc(validated)
+    if errors is None:
+        UPLOAD_ROWS_INSERTED.labels(file_type, project).inc(inserted)
+        return
+
+    UPLOAD_FAILURES.labels(file_type).inc()
+    for error_class, count in errors.classes.items():
+        UPLOAD_ERRORS.labels(file_type, error_class).inc(count)
+
+
+# Records an upload that could not be read at all
+def record_upload_failure(file_type, error):
+    UPLOAD_FAILURES.labels(file_type).inc()
+    UPLOAD_ERRORS.labels(file_type, type(error).__name__).inc()
+
+
+def metrics_response():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def metrics_allowed():
+    allowed = app.config['METRICS_ALLOWED_IPS']
+    return allowed is None or request.remote_addr in allowed
@@ -1,7 +1,7 @@
 from gendb_app import app, db, login
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index
 from datetime import datetime
 
 
@@ -46,6 +46,10 @@ class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     desc = db.Column(db.String(300), nullable=False)
+    # Incremented by every change to the project's data, exports are cached per version
+    data_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Incremented only when individuals are added, see gendb_app.individual_index
+    individuals_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     memships = db.relationship('ProjectMemship', backref='project',
                                lazy='dynamic', cascade="all, delete-orphan")
@@ -64,6 +68,17 @@ class Project(db.Model):
             members.append(memship.user)
         return members
 
+    # Bumps the data version of the given project, or of every project if none is given
+    # (e.g. when the marker catalogue changes), in the caller's transaction. The
+    # individuals version is bumped too when 'individuals' is set
+    @staticmethod
+    def bump_data_version(proj_id=None, individuals=False):
+        query = Project.query if proj_id is None else Project.query.filter_by(id=proj_id)
+        values = {Project.data_version: Project.data_version + 1}
+        if individuals:
+            values[Project.individuals_version] = Project.individuals_version + 1
+        query.update(values, synchronize_session=False)
+
 
 class ProjectMemship(db.Model):
     user_email = db.Column(db.String(120), db.ForeignKey('user.email'), primary_key=True)
@@ -85,6 +100,8 @@ class Individual(db.Model):
     __table_args__ = (
         UniqueConstraint('project_id', 'clinic_id', 'family_id',
                          'member_id', name="_individual_uc"),
+        # Full ID lookups across projects, for the individual search
+        Index('ix_individual_full_id', 'clinic_id', 'family_id', 'member_id'),
         {}
     )
 
@@ -95,15 +112,64 @@ class Individual(db.Model):
         return self.clinic_id + "_" + self.family_id + "_" + self.member_id
 
 
+# Family index of each project, kept up to date on individual upload so that families
+# and trios can be listed without grouping the project's individuals. Member 1 of a
+# family is the father, member 2 the mother and every other member their child
+class Family(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    clinic_id = db.Column(db.String(5), nullable=False)
+    family_id = db.Column(db.String(15), nullable=False)
+    father_id = db.Column(db.Integer, db.ForeignKey('individual.id'))
+    mother_id = db.Column(db.Integer, db.ForeignKey('individual.id'))
+    num_members = db.Column(db.Integer, nullable=False)
+    num_children = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('project_id', 'clinic_id', 'family_id',
+                         name="_family_uc"),
+        {}
+    )
+
+    def __repr__(self):
+        return "<Family - Project: {} - {}_{}>".format(self.project_id, self.clinic_id, self.family_id)
+
+    # Both parents and at least one child, each child then forms a trio
+    @property
+    def is_complete(self):
+        return self.father_id is not None and self.mother_id is not None and self.num_children > 0
+
+    @staticmethod
+    def complete():
+        return db.and_(Family.father_id.isnot(None), Family.mother_id.isnot(None), Family.num_children > 0)
+
+
+class PhenotypeDefinition(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    name = db.Column(db.String(30), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('project_id', 'name',
+                         name="_pheno_def_uc"),
+        {}
+    )
+
+    def __repr__(self):
+        return "<PhenotypeDefinition - ID: {} - Name: {}>".format(self.id, self.name)
+
+
 class Phenotype(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ind_id = db.Column(db.Integer, db.ForeignKey('individual.id'), nullable=False)
-    name = db.Column(db.String(30), nullable=False)
+    pheno_id = db.Column(db.Integer, db.ForeignKey('phenotype_definition.id'), nullable=False)
     value = db.Column(db.String(50), nullable=False)
 
+    definition = db.relationship('PhenotypeDefinition')
+
     __table_args__ = (
-        UniqueConstraint('ind_id', 'name',
-                         name="_pheno_uc"),
+        UniqueConstraint('ind_id', 'pheno_id',
+                         name="_pheno_id_uc"),
         {}
     )
 
@@ -119,13 +185,15 @@ class Phenotype(db.Model):
 class Genotype(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ind_id = db.Column(db.Integer, db.ForeignKey('individual.id'), nullable=False)
-    marker = db.Column(db.String(20), db.ForeignKey('marker.id'), nullable=False)
+    marker_id = db.Column(db.Integer, db.ForeignKey('marker.id'), nullable=False)
     call_1 = db.Column(db.String(1), nullable=False)
     call_2 = db.Column(db.String(2), nullable=False)
 
+    marker = db.relationship('Marker')
+
     __table_args__ = (
-        UniqueConstraint('ind_id', 'marker',
-                         name="_geno_uc"),
+        UniqueConstraint('ind_id', 'marker_id',
+                         name="_geno_id_uc"),
         {}
     )
 
@@ -138,21 +206,126 @@ class Genotype(db.Model):
         return Genotype.query.filter(Genotype.ind_id.in_(subquery))
 
 
+# Markers are identified by an integer surrogate key so that the genotype table
+# and its indexes do not repeat the marker name in every row
 class Marker(db.Model):
-    id = db.Column(db.String(15), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(15), nullable=False, unique=True)
     chromosome = db.Column(db.Integer, nullable=False)
     position = db.Column(db.Integer, nullable=False)
 
+    alleles = db.relationship('MarkerAllele', backref='marker')
+
     def __repr__(self):
-        return "<Marker - ID: {}>".format(self.id)
+        return "<Marker - ID: {} - Name: {}>".format(self.id, self.name)
 
 
 class MarkerAllele(db.Model):
-    marker = db.Column(db.String(15), db.ForeignKey('marker.id'), primary_key=True)
+    marker_id = db.Column(db.Integer, db.ForeignKey('marker.id'), primary_key=True)
     allele = db.Column(db.String(1), primary_key=True)
 
     def __repr__(self):
-        return "<MarkerAllele - Marker: {} - Allele: {}>".format(self.marker, self.allele)
+        return "<MarkerAllele - Marker: {} - Allele: {}>".format(self.marker_id, self.allele)
+
+
+# Version of the marker catalogue, a single row. Every marker upload bumps the version
+# before inserting its markers, which keeps the row locked until the upload commits, so
+# marker uploads insert and commit one at a time and marker IDs follow commit order.
+# 'last_marker_id' is the highest marker ID committed with the version
+class MarkerCatalogue(db.Model):
+    ROW_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    last_marker_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<MarkerCatalogue - Version: {} - Last marker: {}>".format(self.version, self.last_marker_id)
+
+    # Bumps the version in the caller's transaction, adding the row if there is none
+    @staticmethod
+    def bump_version():
+        query = MarkerCatalogue.query.filter_by(id=MarkerCatalogue.ROW_ID)
+        if not query.update({MarkerCatalogue.version: MarkerCatalogue.version + 1}, synchronize_session=False):
+            db.session.add(MarkerCatalogue(id=MarkerCatalogue.ROW_ID, version=1, last_marker_id=0))
+            db.session.flush()
+
+    @staticmethod
+    def set_last_marker_id(marker_id):
+        MarkerCatalogue.query.filter_by(id=MarkerCatalogue.ROW_ID).\
+            update({MarkerCatalogue.last_marker_id: marker_id}, synchronize_session=False)
+
+    # (version, last marker ID). Without the row, before the first marker upload of a
+    # database not created by the migrations, the version is 0 and every stored marker
+    # is counted
+    @staticmethod
+    def current():
+        row = db.session.query(MarkerCatalogue.version, MarkerCatalogue.last_marker_id).\
+            filter_by(id=MarkerCatalogue.ROW_ID).first()
+        if row is None:
+            return 0, db.session.query(db.func.max(Marker.id)).scalar() or 0
+        return row.version, row.last_marker_id
+
+
+# Cached per-marker quality control statistics of a project, see gendb_app.analysis.qc
+class MarkerQC(db.Model):
+    __tablename__ = 'marker_qc'
+
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), primary_key=True)
+    marker_id = db.Column(db.Integer, db.ForeignKey('marker.id'), primary_key=True)
+    n_called = db.Column(db.Integer, nullable=False)
+    n_missing = db.Column(db.Integer, nullable=False)
+    call_rate = db.Column(db.Float)
+    major_allele = db.Column(db.String(1))
+    minor_allele = db.Column(db.String(1))
+    maf = db.Column(db.Float)
+    hwe_p = db.Column(db.Float)
+    computed = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<MarkerQC - Project: {} - Marker: {}>".format(self.project_id, self.marker_id)
+
+
+# Running count of each genotype class per project and marker, kept up to date on upload
+# so that allele frequencies and call rates never need a scan of the genotype table.
+# Genotype classes are stored with the calls in sorted order, missing calls are not counted
+class GenotypeTally(db.Model):
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), primary_key=True)
+    marker_id = db.Column(db.Integer, db.ForeignKey('marker.id'), primary_key=True)
+    call_1 = db.Column(db.String(1), primary_key=True)
+    call_2 = db.Column(db.String(1), primary_key=True)
+    n_genotypes = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<GenotypeTally - Project: {} - Marker: {} - {}{}>".format(
+            self.project_id, self.marker_id, self.call_1, self.call_2)
+
+
+# Progress of a chunked upload, see gendb_app.filehandling.chunked. Updated in the same
+# transaction as each chunk of rows it counts, so an interrupted upload of the same file
+# (told apart by the SHA-1 of its contents) can carry on after the last committed chunk
+class UploadState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    upload_type = db.Column(db.String(15), nullable=False)
+    digest = db.Column(db.String(40), nullable=False)
+    filename = db.Column(db.String(100), nullable=False)
+    user_email = db.Column(db.String(120), nullable=False)
+    # Data rows of the file, not counting any header
+    total_rows = db.Column(db.Integer)
+    committed_rows = db.Column(db.Integer, nullable=False, default=0)
+    finished = db.Column(db.Boolean, nullable=False, default=False)
+    started = db.Column(db.DateTime, default=datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_upload_state_file', 'project_id', 'upload_type', 'digest'),
+        {}
+    )
+
+    def __repr__(self):
+        return "<UploadState - Project: {} - {} - {}/{}>".format(self.project_id, self.upload_type,
+                                                                self.committed_rows, self.total_rows)
 
 
 class SystemLog(db.Model):
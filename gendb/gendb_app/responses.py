@@ -0,0 +1,160 @@
+from functools import wraps
+from hashlib import sha1
+from itertools import chain
+import gzip
+import zlib
+
+from flask import request, session, make_response
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from gendb_app import app
+
+# Conditional GETs of pages and gzip compression of large responses.
+#
+# A page decorated with conditional_page is sent with an ETag made from the versions of
+# the data it shows, and a Last-Modified date where there is one, and is answered with
+# 304 Not Modified while the browser's copy is current, skipping its queries and render.
+# HTML, CSV and NDJSON responses of at least COMPRESS_MIN_BYTES are gzip compressed for
+# clients that accept it, streamed ones as they are sent. Files sent as they are stored
+# are left alone: exports are served from a compressed copy instead, see
+# gendb_app.filehandling.export_cache.
+
+
+# The ETag of a page showing the given versions to the current user. Pages differ per
+# user (their name, admin links), so the user is part of it, hashed so that it is not
+# given away in the header
+def page_etag(versions):
+    user = (current_user.email, current_user.is_sys_admin) if current_user.is_authenticated else None
+    key = repr((request.endpoint, sorted(request.view_args.items()), request.query_string, user, versions))
+    return sha1(key.encode('utf-8')).hexdigest()
+
+
+# Decorator answering requests for a page with 304 Not Modified while the client's copy
+# is current. 'validators' is called with the view's arguments and returns the versions
+# of everything the page shows, and when it last changed or None. Apply it after any
+# access checks, so that only users allowed to see the page are told it is unchanged
+def conditional_page(validators):
+    def real_decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            # A page showing flashed messages is only right once, so is never reused
+            if session.get('_flashes'):
+                response = make_response(fn(*args, **kwargs))
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+
+            versions, last_modified = validators(*args, **kwargs)
+            etag = page_etag(versions)
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+
+            # Weak, as the compressed and uncompressed page share it
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Browsers keep the page but check it is current before showing it again
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return real_decorator
+
+
+# Gzip compresses a response body as it is sent
+class GzipStream(object):
+    def __init__(self, chunks, charset, level):
+        self.chunks = chunks
+        self.charset = charset
+        self.level = level
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self.chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(self.charset)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    # Closes the generator of a streamed response
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+# Reads chunks of a streamed body until there are at least 'size' bytes or it ends,
+# returning those chunks, their length and the iterator of the rest
+def peek_stream(body, size):
+    rest = iter(body)
+    head = []
+    length = 0
+    for chunk in rest:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return head, length, rest
+
+
+class ClosingChain(object):
+    def __init__(self, head, rest, body):
+        self.chunks = chain(head, rest)
+        self.body = body
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+# Whether a response of the mimetype may be sent gzip compressed to this client
+def accepts_gzip(mimetype):
+    return app.config['COMPRESS_ENABLED'] and mimetype in app.config['COMPRESS_MIMETYPES'] and \
+        request.accept_encodings['gzip'] > 0
+
+
+def should_compress(response):
+    if request.method == 'HEAD' or response.direct_passthrough:
+        return False
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return False
+    return accepts_gzip(response.mimetype)
+
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype in app.config['COMPRESS_MIMETYPES']:
+        response.vary.add('Accept-Encoding')
+    if not should_compress(response):
+        return response
+
+    min_bytes = app.config['COMPRESS_MIN_BYTES']
+    level = app.config['COMPRESS_LEVEL']
+
+    if response.is_streamed:
+        length = response.content_length
+        if length is None:
+            # Streamed bodies are of unknown length until read, so read enough to tell
+            body = response.response
+            head, length, rest = peek_stream(body, min_bytes)
+            response.response = ClosingChain(head, rest, body)
+        if length < min_bytes:
+            return response
+        response.response = GzipStream(response.response, response.charset, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_bytes:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=level))
+
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
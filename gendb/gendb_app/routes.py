@@ -1,15 +1,52 @@
 from sqlalchemy import func
+from flask_sqlalchemy import Pagination
 from werkzeug.utils import secure_filename
+from io import StringIO
+import csv
 
 from gendb_app import app, db
 from gendb_app.forms import LoginForm, AddProjectForm, SetupForm, ChangePasswordForm
-from gendb_app.models import Marker, MarkerAllele, User, Project, ProjectMemship, Individual, Phenotype, SystemLog, ProjectLog, Genotype
-from gendb_app.filehandling import file_to_obj_list
-from flask import render_template, url_for, flash, redirect, request
+from gendb_app.models import Marker, MarkerAllele, User, Project, ProjectMemship, Individual, Phenotype, PhenotypeDefinition, SystemLog, ProjectLog, Genotype, MarkerQC, Family, UploadState
+from gendb_app.filehandling import file_to_obj_list, file_to_csv
+from gendb_app.filehandling.exceptions import UploadFileError, IndividualIDFormatError, IndividualMemberIDError
+from gendb_app.filehandling.handling import full_ind_id_to_parts
+from gendb_app.filehandling.reports import save_error_report, load_error_report
+from gendb_app.filehandling.storing import stored_genotypes, store_genotypes, store_markers, conflict_errors, \
+    store_individuals, store_phenotypes, stored_phenotypes, phenotype_conflict_errors, GenotypeChunkStore, \
+    PHENOTYPE_CONFLICT_HEADERS, UPLOAD_MODES, UPLOAD_MODE_FAIL, UPLOAD_MODE_SKIP
+from gendb_app.filehandling.chunked import ChunkedUpload
+from gendb_app.filehandling.users import hash_passwords, store_users, USER_COLUMNS
+from gendb_app.filehandling.locking import lock_project_uploads
+from gendb_app.filehandling.staging import stage_genotypes, stage_phenotypes
+from gendb_app.filehandling.exports import EXPORT_FORMATS
+from gendb_app.filehandling.export_cache import cached_export, compressed_export, remove_project_exports
+from gendb_app.individual_index import individual_index, full_ind_id
+from gendb_app.instrumentation import request_stats
+from gendb_app.marker_cache import catalogue_version
+from gendb_app.fragment_cache import fragment_cache
+from gendb_app.responses import conditional_page, accepts_gzip
+from gendb_app.metrics import record_upload, record_upload_failure, metrics_response, metrics_allowed
+from gendb_app.analysis import run_project_qc, qc_summary, check_project_mendel, clear_tally, update_snapshot, \
+    remove_snapshot, clear_families, family_members, project_trios, check_project_relatedness
+from gendb_app.analysis.mendel import FATHER_MEMBER_ID, MOTHER_MEMBER_ID
+from flask import render_template, url_for, flash, redirect, request, Response, stream_with_context, send_file
 from flask_login import login_required, current_user, login_user, logout_user
 from werkzeug.urls import url_parse
 from functools import wraps
 
+# Columns of a genotype file, as shown on its upload error report
+GENOTYPE_HEADERS = ["ID", "Marker", "Allele 1", "Allele 2"]
+
+# Number of markers listed on the Mendelian inconsistency page, the rest are in the download
+MENDEL_REPORT_MARKERS = 100
+
+# Number of pairs listed on the relatedness page, the rest are in the download
+RELATEDNESS_REPORT_PAIRS = 200
+
+# Upload type of each upload route, as recorded in the upload metrics
+UPLOAD_TYPES = {'upload_markers': 'markers', 'upload_individuals': 'individuals',
+                'upload_phenotypes': 'phenotypes', 'upload_genotypes': 'genotypes', 'import_users': 'users'}
+
 
 #
 #
@@ -69,6 +106,78 @@ def proj_admin_only(arg_name):
     return real_decorator
 
 
+# Streams the given header and rows as a downloadable CSV file
+def csv_response(filename, header, rows):
+    def generate():
+        line = StringIO()
+        writer = csv.writer(line)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            # Flush every so often rather than yielding every single row
+            if line.tell() > 65536:
+                yield line.getvalue()
+                line.seek(0)
+                line.truncate(0)
+        yield line.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+# Versions of a project page: its data, its members and when QC was last run
+def project_page_versions(id):
+    project = Project.query.get(id)
+    members = db.session.query(ProjectMemship.user_email, ProjectMemship.is_project_admin).\
+        filter_by(project_id=id).order_by(ProjectMemship.user_email).all()
+    qc_computed, _ = qc_report_versions(id)
+    return (project.data_version, project.title, project.desc, members, qc_computed), None
+
+
+# A project's QC results are all replaced each time QC is run
+def qc_report_versions(proj_id):
+    computed = db.session.query(func.max(MarkerQC.computed)).filter(MarkerQC.project_id == proj_id).scalar()
+    return computed, computed
+
+
+# Logs are only ever added to, so the newest entry versions every page of them
+def log_page_versions(log_model):
+    latest_id, latest_time = db.session.query(func.max(log_model.id), func.max(log_model.time)).one()
+    return latest_id, latest_time
+
+
+# An upload that could not be read at all, such as a damaged compressed file, nothing
+# from it has been committed
+@app.errorhandler(UploadFileError)
+def upload_file_error(e):
+    if request.endpoint in UPLOAD_TYPES:
+        record_upload_failure(UPLOAD_TYPES[request.endpoint], e)
+    flash("Failed to upload file: {}".format(e), "danger")
+    return redirect(request.referrer or url_for('index'))
+
+
+# Stores the errors of a failed upload and sends the user to the first page of the report
+def error_report_redirect(title, filename, headers, errors):
+    report_id = save_error_report(current_user.email, title, filename, headers, errors)
+    return redirect(url_for('upload_report', report_id=report_id))
+
+
+# Addition to an upload's success message when a chunked upload carried on from an
+# earlier, interrupted upload of the same file
+def resumed_message(upload):
+    if upload is None or not upload.skipped:
+        return ""
+    return ", resumed after the {} rows already stored".format(upload.skipped)
+
+
+# Returns the stored upload error report if the current user may see it
+def get_error_report(report_id):
+    report = load_error_report(report_id)
+    if report is None or (report.owner != current_user.email and not current_user.is_sys_admin):
+        return None
+    return report
+
+
 #
 #
 #   AUTHENTICATION HANDLERS
@@ -151,6 +260,7 @@ def setup():
                         "Setup the system with the first admin account")
         db.session.add(log)
         db.session.commit()
+        fragment_cache.invalidate('users')
 
         flash("Administrator account registered", "success")
         return redirect(url_for('login'))
@@ -192,52 +302,55 @@ def change_password():
 
 @app.route('/markers')
 @login_required
+@conditional_page(lambda: (catalogue_version(), None))
 def manage_markers():
+    # Only run if the table is not in the fragment cache
     markers = db.session.query(
-        Marker.id,
+        Marker.name,
         Marker.chromosome,
         Marker.position,
         func.group_concat(MarkerAllele.allele)
-    ).filter(Marker.id == MarkerAllele.marker).group_by(Marker.id).all()
+    ).filter(Marker.id == MarkerAllele.marker_id).group_by(Marker.id)
 
     return render_template("manage_markers.html",
                            title="Manage Markers",
-                           markers=markers)
+                           markers=markers, catalogue_version=catalogue_version())
 
 
+# The marker catalogue is shared by every project, so only system administrators add to it
 @app.route('/markers/upload', methods=['POST'])
+@login_required
+@sys_admin_only
 def upload_markers():
     markers_file = request.files['markers']
     filename = secure_filename(markers_file.filename)
 
     # TODO: Also test the file is a CSV
     if markers_file:
-        error, result = file_to_obj_list("MARKERS", markers_file, None)
+        rows = file_to_csv(markers_file)
+        error, result = file_to_obj_list("MARKERS", rows, None)
 
         if error:
-            return render_template('upload_error_report.html',
-                                   title='Markers Upload Error Report',
-                                   filename=filename,
-                                   headers=['Marker', 'Chromosome', 'Position',
-                                            'Number of possible alleles', 'Possible alleles'],
-                                   errors=result)
-
-        markers, alleles = result
-        with db.session.no_autoflush:
-            for marker in markers:
-                db.session.add(marker)
-
-            # TODO: Remove this
-            db.session.commit()
+            record_upload('markers', None, rows.count, errors=result)
+            return error_report_redirect('Markers Upload Error Report', filename,
+                                         ['Marker', 'Chromosome', 'Position',
+                                          'Number of possible alleles', 'Possible alleles'],
+                                         result)
 
-            for allele in alleles:
-                db.session.add(allele)
+        num_inserted = store_markers(result)
+        # Exports include every catalogue marker
+        Project.bump_data_version()
 
-            # Project log entry
-            log = SystemLog(request.remote_addr, current_user.email,
-                             "Uploaded Markers File: '{}'".format(filename))
-            db.session.add(log)
-            db.session.commit()
+        # Project log entry
+        log = SystemLog(request.remote_addr, current_user.email,
+                        "Uploaded Markers File: '{}'".format(filename))
+        db.session.add(log)
+        db.session.commit()
+        fragment_cache.invalidate('markers')
+        # Snapshots of chromosomes without new markers carry on at the new data version
+        for project_id, in db.session.query(Project.id):
+            update_snapshot(project_id, ())
+        record_upload('markers', None, rows.count, num_inserted)
 
         flash("Successfully uploaded markers file: '{}'".format(filename), "success")
 
@@ -245,6 +358,48 @@ def upload_markers():
 
 
 
+#
+#
+#   UPLOAD ERROR REPORTS
+#
+#
+
+
+@app.route('/upload_report/<report_id>')
+@app.route('/upload_report/<report_id>/page/<int:page>')
+@login_required
+def upload_report(report_id, page=1):
+    report = get_error_report(report_id)
+    if report is None:
+        flash("Upload error report not found, it may have expired", "danger")
+        return redirect(url_for('index'))
+
+    per_page = app.config['UPLOAD_REPORT_PAGE_SIZE']
+    start = (page - 1) * per_page
+    rows = Pagination(None, page, per_page, report.num_rows, list(report.rows(start, per_page)))
+
+    return render_template('upload_error_report.html', title=report.title,
+                           report=report, filename=report.filename,
+                           headers=report.headers, errors=rows)
+
+
+@app.route('/upload_report/<report_id>/download')
+@login_required
+def download_upload_report(report_id):
+    report = get_error_report(report_id)
+    if report is None:
+        flash("Upload error report not found, it may have expired", "danger")
+        return redirect(url_for('index'))
+
+    def rows():
+        for row in report.rows():
+            errors = [cell.error for cell in row if cell.error]
+            yield [row[0].message, "; ".join(errors)] + [cell.message for cell in row[1:]]
+
+    name = "{}_errors.csv".format(report.filename.rsplit('.', 1)[0] or "upload")
+    return csv_response(name, ["Line no.", "Errors"] + report.headers, rows())
+
+
 #
 #
 #   MAIN HANDLERS
@@ -258,8 +413,8 @@ def index():
     project_count = Project.query.count()
     ind_count = Individual.query.count()
     # TODO Possibly change what is considered a 'distinct' genotype
-    gen_count = db.session.query(Genotype.marker).distinct().count()
-    phen_count = db.session.query(Phenotype.name).distinct().count()
+    gen_count = db.session.query(Genotype.marker_id).distinct().count()
+    phen_count = db.session.query(PhenotypeDefinition.name).distinct().count()
 
     user_projects = current_user.get_projects()
 
@@ -302,10 +457,15 @@ def delete_project(id):
     ProjectMemship.query.filter_by(project_id=id).delete()
 
     # TODO Delete all geno, pheno, group, indv
+    MarkerQC.query.filter_by(project_id=id).delete()
+    clear_tally(id)
     Genotype.query_by_project(id).delete(synchronize_session=False)
     Phenotype.query_by_project(id).delete(synchronize_session=False)
+    PhenotypeDefinition.query.filter_by(project_id=id).delete()
+    clear_families(id)
     Individual.query.filter_by(project_id=id).\
         delete()
+    UploadState.query.filter_by(project_id=id).delete()
 
     # Delete the project itself
     Project.query.filter_by(id=id).delete()
@@ -315,6 +475,10 @@ def delete_project(id):
                      "Deleted project {}".format(id))
     db.session.add(log)
     db.session.commit()
+    remove_snapshot(id)
+    remove_project_exports(id)
+    fragment_cache.invalidate('members')
+    individual_index.remove_project(int(id))
 
     flash("Project deleted successfully", "success")
     return redirect(url_for('index'))
@@ -323,6 +487,7 @@ def delete_project(id):
 @app.route('/project/<id>')
 @login_required
 @proj_member_only('id')
+@conditional_page(project_page_versions)
 def project(id):
     project = Project.query.get(id)
     members = project.get_members()
@@ -331,11 +496,75 @@ def project(id):
     proj_ind_count = Individual.query.filter_by(project_id=id).count()
     genos_proj = Genotype.query_by_project(id).count()
     proj_pheno_count = Phenotype.query_by_project(id).count()
+    qc = qc_summary(id)
 
     return render_template('project.html', title=project.title,
                            project=project, members=members,
                            proj_ind_count=proj_ind_count, genos_proj=genos_proj,
-                           proj_pheno_count=proj_pheno_count)
+                           proj_pheno_count=proj_pheno_count, qc=qc)
+
+
+# Finds individuals by full ID across every project of the current user. Exact searches
+# are answered by the database, prefix searches by the in-memory individual index
+@app.route('/search')
+@login_required
+def search_individuals():
+    query = request.args.get('q', '').strip()
+    exact = request.args.get('exact') is not None
+    limit = app.config['INDIVIDUAL_SEARCH_LIMIT']
+    projects = {project.id: project for project in current_user.get_projects()}
+
+    results = []
+    if query and projects:
+        if exact:
+            try:
+                clinic, family, member = full_ind_id_to_parts(query)
+            except (IndividualIDFormatError, IndividualMemberIDError):
+                clinic = None
+            if clinic is not None:
+                results = Individual.query.filter_by(clinic_id=clinic, family_id=family, member_id=int(member)).\
+                    filter(Individual.project_id.in_(projects)).order_by(Individual.project_id).all()
+        else:
+            individual_index.refresh()
+            matches = individual_index.search(projects, query, limit + 1)
+            by_id = {ind.id: ind for ind in
+                     Individual.query.filter(Individual.id.in_([ind_id for _, _, ind_id in matches]))}
+            # Individuals deleted since the index was refreshed are left out
+            results = [by_id[ind_id] for _, _, ind_id in matches if ind_id in by_id]
+
+    return render_template('search_individuals.html', title="Search Individuals",
+                           query=query, exact=exact, projects=projects, limit=limit,
+                           results=[(full_ind_id(ind.clinic_id, ind.family_id, ind.member_id), ind)
+                                    for ind in results[:limit]],
+                           more=len(results) > limit)
+
+
+# Serves the export from the export cache, generating it first if the project's data
+# has changed since it was last downloaded. Clients accepting gzip get the cached
+# compressed copy
+@app.route('/project/<proj_id>/export/<export_format>')
+@login_required
+@proj_member_only('proj_id')
+def export_project(proj_id, export_format):
+    if export_format not in EXPORT_FORMATS:
+        flash("Unknown export format", "danger")
+        return redirect(url_for('project', id=proj_id))
+
+    project = Project.query.get(proj_id)
+    extension, mimetype, _ = EXPORT_FORMATS[export_format]
+    etag = "{}-{}-{}".format(project.id, project.data_version, export_format)
+    compressed = accepts_gzip(mimetype)
+    if compressed:
+        path = compressed_export(project.id, project.data_version, export_format)
+        etag += "-gzip"
+    else:
+        path = cached_export(project.id, project.data_version, export_format)
+
+    response = send_file(path, mimetype=mimetype, as_attachment=True,
+                         download_name="project_{}.{}".format(project.id, extension), conditional=True, etag=etag)
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 @app.route('/add_member/<proj_id>', methods=['POST'])
@@ -357,6 +586,7 @@ def add_member(proj_id):
                      message)
     db.session.add(log)
     db.session.commit()
+    fragment_cache.invalidate('members')
 
     flash("Member added to project", "success")
     return redirect(url_for('project', id=proj_id))
@@ -381,6 +611,7 @@ def remove_member(user_email, proj_id):
                      ("Removed user " + user_email))
     db.session.add(log)
     db.session.commit()
+    fragment_cache.invalidate('members')
 
     flash("User removed successfully", "success")
 
@@ -406,27 +637,37 @@ def upload_individuals(proj_id):
 
     # TODO Also test the file is a CSV
     if ind_file:
-        error, result = file_to_obj_list("INDIVIDUALS", ind_file, proj_id)
+        upload = None
+        if app.config['UPLOAD_CHUNKED']:
+            upload = ChunkedUpload(ind_file, "INDIVIDUALS", proj_id, filename, current_user.email)
+            rows = upload.rows
+            error, result = upload.validate()
+        else:
+            rows = file_to_csv(ind_file)
+            error, result = file_to_obj_list("INDIVIDUALS", rows, proj_id)
 
         if error:
-            return render_template('upload_error_report.html',
-                                   title="Individuals Upload Error Report",
-                                   filename=filename,
-                                   headers=["ID", "Gender"],
-                                   errors=result)
-
-        for ind in result:
-            # TODO Test the individual does not already exist
-            # TODO Create dummy parents?
-            db.session.add(ind)
+            record_upload('individuals', proj_id, rows.count, errors=result)
+            return error_report_redirect("Individuals Upload Error Report", filename,
+                                         ["ID", "Gender"], result)
+
+        # TODO Create dummy parents?
+        lock_project_uploads(proj_id)
+        if upload is not None:
+            num_inserted = upload.commit(result, lambda individuals: store_individuals(proj_id, individuals))
+        else:
+            num_inserted = store_individuals(proj_id, result)
+        Project.bump_data_version(proj_id, individuals=True)
 
         # Project log entry
         log = ProjectLog(proj_id, request.remote_addr, current_user.email,
                          "Uploaded Individuals File: '{}'".format(filename))
         db.session.add(log)
         db.session.commit()
+        record_upload('individuals', proj_id, rows.count, num_inserted)
+        individual_index.refresh()
 
-        flash("Successfully uploaded individuals file: '{}'".format(filename), "success")
+        flash("Successfully uploaded individuals file: '{}'{}".format(filename, resumed_message(upload)), "success")
     else:
         flash("No individuals file", "danger")
 
@@ -450,26 +691,56 @@ def upload_phenotypes(proj_id):
 
     # TODO: Also test the file is a CSV
     if pheno_file:
-        error, result = file_to_obj_list("PHENOTYPES", pheno_file, proj_id)
+        upload = None
+        if app.config['UPLOAD_STAGING']:
+            rows = file_to_csv(pheno_file)
+            error, result = stage_phenotypes(rows, proj_id, app.config['UPLOAD_ERROR_CAP'])
+        elif app.config['UPLOAD_CHUNKED']:
+            upload = ChunkedUpload(pheno_file, "PHENOTYPES", proj_id, filename, current_user.email)
+            rows = upload.rows
+            error, result = upload.validate()
+        else:
+            rows = file_to_csv(pheno_file)
+            error, result = file_to_obj_list("PHENOTYPES", rows, proj_id)
+        # Not counting the header row
+        num_rows = max(rows.count - 1, 0)
 
         if error:
             headers, error_list = result
-            return render_template('upload_error_report.html',
-                                   title="Phenotypes Upload Error Report",
-                                   filename=filename,
-                                   headers=headers,
-                                   errors=error_list)
-
-        for pheno in result:
-            db.session.add(pheno)
+            record_upload('phenotypes', proj_id, num_rows, errors=error_list)
+            return error_report_redirect("Phenotypes Upload Error Report", filename,
+                                         headers, error_list)
+
+        if not app.config['UPLOAD_STAGING']:
+            # Values stored by another upload while this one was validated are only seen
+            # once it holds the lock. The staging ingest takes the lock itself
+            lock_project_uploads(proj_id)
+            existing = stored_phenotypes(proj_id, result)
+            if existing:
+                errors = phenotype_conflict_errors(result, existing, app.config['UPLOAD_ERROR_CAP'])
+                record_upload('phenotypes', proj_id, num_rows, errors=errors)
+                return error_report_redirect("Phenotypes Upload Error Report", filename,
+                                             PHENOTYPE_CONFLICT_HEADERS, errors)
+
+        if app.config['UPLOAD_STAGING']:
+            num_inserted = result
+        elif upload is not None:
+            # Each chunk's commit bumps the data version, which the snapshot follows
+            num_inserted = upload.commit(result, store_phenotypes, lambda phenotypes: update_snapshot(proj_id, ()))
+        else:
+            num_inserted = store_phenotypes(result)
+        Project.bump_data_version(proj_id)
 
         # Project log entry
         log = ProjectLog(proj_id, request.remote_addr, current_user.email,
                          "Uploaded Phenotypes File: '{}'".format(filename))
         db.session.add(log)
         db.session.commit()
+        # Genotypes are unchanged, the snapshot moves on to the new data version
+        update_snapshot(proj_id, ())
+        record_upload('phenotypes', proj_id, num_rows, num_inserted)
 
-        flash("Successfully uploaded phenotypes file: '{}'".format(filename), "success")
+        flash("Successfully uploaded phenotypes file: '{}'{}".format(filename, resumed_message(upload)), "success")
     else:
         flash("No phenotypes file", "danger")
     return redirect(url_for('project', id=proj_id))
@@ -481,33 +752,253 @@ def upload_phenotypes(proj_id):
 def upload_genotypes(proj_id):
     geno_file = request.files['genotypes']
     filename = secure_filename(geno_file.filename)
+    mode = request.form.get('mode', UPLOAD_MODE_FAIL)
+    if mode not in UPLOAD_MODES:
+        flash("Invalid upload mode", "danger")
+        return redirect(url_for('project', id=proj_id))
 
     # TODO: Also test the file is a CSV
     if geno_file:
-        error, result = file_to_obj_list("GENOTYPES", geno_file, proj_id)
-
-        if error:
-            return render_template('upload_error_report.html',
-                                   title="Genotypes Upload Error Report",
-                                   filename=filename,
-                                   headers=["ID", "Marker", "Allele 1", "Allele 2"],
-                                   errors=result)
-
-        for geno in result:
-            db.session.add(geno)
+        upload = None
+        if app.config['UPLOAD_STAGING']:
+            rows = file_to_csv(geno_file)
+            error, result = stage_genotypes(rows, proj_id, mode, app.config['UPLOAD_ERROR_CAP'])
+            if error:
+                record_upload('genotypes', proj_id, rows.count, errors=result)
+                return error_report_redirect("Genotypes Upload Error Report", filename, GENOTYPE_HEADERS, result)
+            num_inserted, num_existing, marker_ids = result
+            written = None
+        elif app.config['UPLOAD_CHUNKED']:
+            upload = ChunkedUpload(geno_file, "GENOTYPES", proj_id, filename, current_user.email)
+            rows = upload.rows
+            error, result = upload.validate()
+            if error:
+                record_upload('genotypes', proj_id, rows.count, errors=result)
+                return error_report_redirect("Genotypes Upload Error Report", filename, GENOTYPE_HEADERS, result)
+
+            lock_project_uploads(proj_id)
+            if mode == UPLOAD_MODE_FAIL:
+                genotypes = result
+                existing = stored_genotypes(genotypes)
+                if existing:
+                    errors = conflict_errors(genotypes, existing, app.config['UPLOAD_ERROR_CAP'])
+                    record_upload('genotypes', proj_id, rows.count, errors=errors)
+                    return error_report_redirect("Genotypes Upload Error Report", filename, GENOTYPE_HEADERS,
+                                                 errors)
+                del genotypes, existing
+
+            # Each chunk's genotypes are copied into the snapshot as it is committed
+            chunks = GenotypeChunkStore(proj_id, mode)
+            num_inserted = upload.commit(result, chunks.store, chunks.committed)
+            num_existing = chunks.num_existing
+            marker_ids, written = set(), None
+        else:
+            rows = file_to_csv(geno_file)
+            error, result = file_to_obj_list("GENOTYPES", rows, proj_id)
+            if error:
+                record_upload('genotypes', proj_id, rows.count, errors=result)
+                return error_report_redirect("Genotypes Upload Error Report", filename, GENOTYPE_HEADERS, result)
+
+            genotypes = result
+            lock_project_uploads(proj_id)
+            existing = stored_genotypes(genotypes)
+            if existing and mode == UPLOAD_MODE_FAIL:
+                errors = conflict_errors(genotypes, existing, app.config['UPLOAD_ERROR_CAP'])
+                record_upload('genotypes', proj_id, rows.count, errors=errors)
+                return error_report_redirect("Genotypes Upload Error Report", filename, GENOTYPE_HEADERS, errors)
+
+            store_genotypes(proj_id, genotypes, existing, mode)
+            num_existing = len(existing)
+            if mode == UPLOAD_MODE_SKIP and existing:
+                genotypes = [geno for geno in genotypes if (geno.ind_id, geno.marker_id) not in existing]
+            num_inserted = len(genotypes)
+            marker_ids = {geno.marker_id for geno in genotypes}
+            written = [(geno.ind_id, geno.marker_id, geno.call_1, geno.call_2) for geno in genotypes]
+        Project.bump_data_version(proj_id)
 
         # Project log entry
         log = ProjectLog(proj_id, request.remote_addr, current_user.email,
                          "Uploaded Genotypes File: '{}'".format(filename))
         db.session.add(log)
         db.session.commit()
-
-        flash("Successfully uploaded genotypes file: '{}'".format(filename), "success")
+        record_upload('genotypes', proj_id, rows.count, num_inserted)
+        # Also needed after a chunked upload, whose chunks' genotypes are already in the
+        # snapshot, to move it on to the data version of the final commit
+        update_snapshot(proj_id, marker_ids, written)
+
+        if num_existing and mode == UPLOAD_MODE_SKIP:
+            flash("Successfully uploaded genotypes file: '{}', skipped {} genotypes already stored{}".format(
+                filename, num_existing, resumed_message(upload)), "success")
+        elif num_existing:
+            flash("Successfully uploaded genotypes file: '{}', replaced {} stored genotypes{}".format(
+                filename, num_existing, resumed_message(upload)), "success")
+        else:
+            flash("Successfully uploaded genotypes file: '{}'{}".format(filename, resumed_message(upload)), "success")
     else:
         flash("No genotypes file", "danger")
     return redirect(url_for('project', id=proj_id))
 
 
+#
+#
+#   FAMILIES
+#
+#
+
+
+@app.route('/project/<proj_id>/families')
+@app.route('/project/<proj_id>/families/page/<int:page>')
+@login_required
+@proj_member_only('proj_id')
+def families(proj_id, page=1):
+    project = Project.query.get(proj_id)
+    complete = request.args.get('complete') is not None
+
+    query = Family.query.filter_by(project_id=proj_id)
+    if complete:
+        query = query.filter(Family.complete())
+    rows = query.order_by(Family.clinic_id, Family.family_id).\
+        paginate(page, app.config['FAMILY_PAGE_SIZE'], error_out=False)
+    num_complete = Family.query.filter_by(project_id=proj_id).filter(Family.complete()).count()
+    num_trios = db.session.query(func.coalesce(func.sum(Family.num_children), 0)).\
+        filter(Family.project_id == proj_id).filter(Family.complete()).scalar()
+
+    return render_template('families.html', title="Families",
+                           project=project, families=rows, complete=complete,
+                           num_complete=num_complete, num_trios=num_trios)
+
+
+@app.route('/project/<proj_id>/family/<clinic_id>/<family_id>')
+@login_required
+@proj_member_only('proj_id')
+def family(proj_id, clinic_id, family_id):
+    project = Project.query.get(proj_id)
+    members = family_members(proj_id, clinic_id, family_id)
+    if not members:
+        flash("Family not found", "danger")
+        return redirect(url_for('families', proj_id=proj_id))
+
+    return render_template('family.html', title="Family {}_{}".format(clinic_id, family_id),
+                           project=project, members=members,
+                           father_id=FATHER_MEMBER_ID, mother_id=MOTHER_MEMBER_ID)
+
+
+@app.route('/project/<proj_id>/trios')
+@login_required
+@proj_member_only('proj_id')
+def trios(proj_id):
+    rows = ((full_ind_id(child.clinic_id, child.family_id, child.member_id),
+             full_ind_id(father.clinic_id, father.family_id, father.member_id),
+             full_ind_id(mother.clinic_id, mother.family_id, mother.member_id))
+            for child, father, mother in project_trios(proj_id).yield_per(10000))
+
+    return csv_response("project_{}_trios.csv".format(proj_id), ["Child", "Father", "Mother"], rows)
+
+
+#
+#
+#   QUALITY CONTROL
+#
+#
+
+
+@app.route('/project/<proj_id>/qc/run', methods=['POST'])
+@login_required
+@proj_member_only('proj_id')
+def run_qc(proj_id):
+    # Statistics come from the genotype tallies unless a recount of the genotypes is asked for
+    rescan = request.form.get('rescan') == 'on'
+    num_markers, num_untyped = run_project_qc(proj_id, rescan)
+
+    # Project log entry
+    log = ProjectLog(proj_id, request.remote_addr, current_user.email,
+                     "Ran marker QC over {} markers{}".format(num_markers, " from the genotypes" if rescan else ""))
+    db.session.add(log)
+    db.session.commit()
+
+    flash("Marker QC complete for {} markers, {} catalogue markers without genotypes in this project left out".
+          format(num_markers, num_untyped), "success")
+    return redirect(url_for('project', id=proj_id))
+
+
+@app.route('/project/<proj_id>/qc/report')
+@login_required
+@proj_member_only('proj_id')
+@conditional_page(qc_report_versions)
+def qc_report(proj_id):
+    rows = db.session.query(
+        Marker.name,
+        Marker.chromosome,
+        Marker.position,
+        MarkerQC.n_called,
+        MarkerQC.n_missing,
+        MarkerQC.call_rate,
+        MarkerQC.major_allele,
+        MarkerQC.minor_allele,
+        MarkerQC.maf,
+        MarkerQC.hwe_p
+    ).filter(Marker.id == MarkerQC.marker_id, MarkerQC.project_id == proj_id).\
+        order_by(Marker.chromosome, Marker.position).yield_per(10000)
+
+    return csv_response("project_{}_marker_qc.csv".format(proj_id),
+                        ["Marker", "Chromosome", "Position", "Called", "Missing", "Call rate",
+                         "Major allele", "Minor allele", "MAF", "HWE p-value"],
+                        rows)
+
+
+@app.route('/project/<proj_id>/mendel')
+@login_required
+@proj_member_only('proj_id')
+def mendel_report(proj_id):
+    project = Project.query.get(proj_id)
+    report = check_project_mendel(proj_id)
+
+    return render_template('mendel_report.html', title="Mendelian Inconsistencies",
+                           project=project, report=report,
+                           worst_markers=report.worst_markers(MENDEL_REPORT_MARKERS))
+
+
+@app.route('/project/<proj_id>/mendel/markers')
+@login_required
+@proj_member_only('proj_id')
+def mendel_marker_report(proj_id):
+    report = check_project_mendel(proj_id)
+    rows = ((marker.name, marker.chromosome, marker.position, errors, checked)
+            for marker, errors, checked in zip(report.markers, report.marker_errors, report.marker_checked))
+
+    return csv_response("project_{}_mendel_markers.csv".format(proj_id),
+                        ["Marker", "Chromosome", "Position", "Errors", "Checked genotypes"],
+                        rows)
+
+
+# Genotype relatedness of every pair of individuals against their declared families
+@app.route('/project/<proj_id>/relatedness')
+@login_required
+@proj_member_only('proj_id')
+def relatedness_report(proj_id):
+    project = Project.query.get(proj_id)
+    report = check_project_relatedness(project)
+
+    return render_template('relatedness_report.html', title="Relatedness",
+                           project=project, report=report, swaps=report.swap_candidates(),
+                           problems=report.problems[:RELATEDNESS_REPORT_PAIRS])
+
+
+@app.route('/project/<proj_id>/relatedness/pairs')
+@login_required
+@proj_member_only('proj_id')
+def relatedness_pairs(proj_id):
+    report = check_project_relatedness(Project.query.get(proj_id))
+    rows = ((pair.individual_a, pair.individual_b, pair.markers, pair.ibs0, pair.ibs1, pair.ibs2,
+             "{:.4f}".format(pair.kinship), pair.expected_name, pair.observed_name, "Yes" if pair.problem else "")
+            for pair in report.pairs)
+
+    return csv_response("project_{}_relatedness.csv".format(proj_id),
+                        ["Individual 1", "Individual 2", "Markers", "IBS0", "IBS1", "IBS2", "Kinship",
+                         "Declared", "Found", "Mismatch"],
+                        rows)
+
+
 #
 #
 #   ADMIN FUNCTIONALITY HANDLERS
@@ -522,11 +1013,53 @@ def admin():
     return render_template('admin.html', title="Admin Dashboard")
 
 
+@app.route('/admin/performance')
+@login_required
+@sys_admin_only
+def admin_performance():
+    return render_template('admin_performance.html', title="Performance",
+                           routes=request_stats.summary(), since=request_stats.since,
+                           slow_queries=list(request_stats.slow_queries),
+                           profiles=list(request_stats.profiles.values()),
+                           slow_query_seconds=app.config['SLOW_QUERY_SECONDS'])
+
+
+@app.route('/admin/performance/profile/<int:profile_id>')
+@login_required
+@sys_admin_only
+def admin_profile(profile_id):
+    profile = request_stats.profiles.get(profile_id)
+    if profile is None:
+        flash("Profile not found, it may have been replaced by a newer one", "danger")
+        return redirect(url_for('admin_performance'))
+    return render_template('admin_profile.html', title="Profile", profile=profile)
+
+
+@app.route('/admin/performance/reset', methods=['POST'])
+@login_required
+@sys_admin_only
+def reset_performance():
+    request_stats.reset()
+    flash("Performance figures reset", "success")
+    return redirect(url_for('admin_performance'))
+
+
+# Prometheus metrics, for the monitoring server rather than users so restricted by
+# address instead of login
+@app.route('/metrics')
+def metrics():
+    if not metrics_allowed():
+        return Response("Forbidden", status=403, mimetype='text/plain')
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/admin/users')
 @login_required
 @sys_admin_only
 def users():
-    user_list = User.query.all()
+    # Only run if the table is not in the fragment cache
+    user_list = User.query
     return render_template('users.html', title='Users', users=user_list)
 
 
@@ -545,12 +1078,46 @@ def add_user():
                     "Created user account <" + user.email + ">")
     db.session.add(log)
     db.session.commit()
+    fragment_cache.invalidate('users')
+    return redirect(url_for('users'))
+
+
+@app.route('/admin/users/import', methods=['POST'])
+@login_required
+@sys_admin_only
+def import_users():
+    users_file = request.files['users']
+    filename = secure_filename(users_file.filename)
+
+    if users_file:
+        rows = file_to_csv(users_file)
+        error, result = file_to_obj_list("USERS", rows, None)
+
+        if error:
+            record_upload('users', None, rows.count, errors=result)
+            return error_report_redirect("Users Import Error Report", filename, USER_COLUMNS, result)
+
+        # Hashed before any row is written, so the transaction is not held open meanwhile
+        password_hashes = hash_passwords([user.password for user in result], app.config['USER_IMPORT_WORKERS'])
+        num_users, num_memships = store_users(result, password_hashes, request.remote_addr,
+                                              current_user.email, filename)
+        db.session.commit()
+        fragment_cache.invalidate('users')
+        if num_memships:
+            fragment_cache.invalidate('members')
+        record_upload('users', None, rows.count, num_users + num_memships)
+
+        flash("Successfully imported {} user accounts from '{}'".format(num_users, filename), "success")
+    else:
+        flash("No users file", "danger")
+
     return redirect(url_for('users'))
 
 
 @app.route('/admin/sys_logs')
 @app.route('/admin/sys_logs/page/<int:page>')
 @sys_admin_only
+@conditional_page(lambda page=1: log_page_versions(SystemLog))
 def sys_logs(page=1):
     logs = SystemLog.query.order_by(SystemLog.time.desc()).\
         paginate(page, 20, False)
@@ -560,6 +1127,7 @@ def sys_logs(page=1):
 @app.route('/admin/proj_logs')
 @app.route('/admin/proj_logs/page/<int:page>')
 @sys_admin_only
+@conditional_page(lambda page=1: log_page_versions(ProjectLog))
 def admin_proj_logs(page=1):
     logs = ProjectLog.query.order_by(ProjectLog.time.desc()).\
         paginate(page, 20, False)
@@ -634,12 +1202,6 @@ def single_geno():
 #
 
 
-@app.route('/project/<proj_id>/download_ped')
-def download_ped(proj_id):
-    flash("Not yet implemented", "danger")
-    return redirect(url_for('index'))
-
-
 @app.route('/help')
 def help():
     flash("Not yet implemented", "danger")
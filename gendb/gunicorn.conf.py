@@ -0,0 +1,71 @@
+# Gunicorn settings for serving GenDB, see the README. Run from the gendb directory:
+#   gunicorn -c gunicorn.conf.py "app:create_app()"
+# Each setting can be overridden from the environment, or on the command line.
+
+import multiprocessing
+import os
+import re
+import tempfile
+
+bind = os.environ.get('GENDB_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GENDB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Threads per worker, requests mostly wait on the database
+worker_class = 'gthread'
+threads = int(os.environ.get('GENDB_THREADS', 4))
+
+# Uploads and analyses of large projects can take several minutes
+timeout = int(os.environ.get('GENDB_TIMEOUT', 600))
+graceful_timeout = 60
+
+# Workers are replaced after this many requests, give or take the jitter so they do
+# not all restart at once. In-flight requests are finished before a worker exits
+max_requests = int(os.environ.get('GENDB_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+# Load and warm up the app once in the master, workers share it copy-on-write
+preload_app = True
+
+accesslog = '-'
+
+# Workers write their Prometheus metrics here, see gendb_app.metrics. It must exist
+# before the app is loaded. By default each server gets its own directory, named by the
+# address it binds, so servers on one host do not count or remove each other's metrics
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    tempfile.gettempdir(), 'gendb_prometheus_' + re.sub(r'\W', '_', bind)))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+# Metrics files are named after the process writing them, e.g. counter_1234.db
+METRICS_FILE_PID = re.compile(r'_(\d+)\.db$')
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Metrics left behind by an earlier run would be added to this one's. Only the files
+# of processes no longer running are removed, in case the directory is shared with
+# another server
+def on_starting(server):
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for name in os.listdir(directory):
+        match = METRICS_FILE_PID.search(name)
+        if match and not is_running(int(match.group(1))):
+            os.remove(os.path.join(directory, name))
+
+
+# Each worker opens its own database connections, any pooled connection copied from
+# the master would be shared with the other workers
+def post_fork(server, worker):
+    from gendb_app import db
+    db.engine.dispose()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,81 @@
+"""Phenotype definition table
+
+Revision ID: 3f1c2a9d7b64
+Revises: eb939f97758d
+Create Date: 2026-10-19 09:12:41.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b64'
+down_revision = 'eb939f97758d'
+branch_labels = None
+depends_on = None
+
+# Number of phenotype rows updated per statement during the backfill
+BATCH_SIZE = 50000
+
+
+def batched_update(conn, statement):
+    # Runs the given update over consecutive primary key ranges of the phenotype table
+    max_id = conn.execute(sa.text("SELECT MAX(id) FROM phenotype")).scalar() or 0
+    for low in range(0, max_id + 1, BATCH_SIZE):
+        conn.execute(statement, low=low, high=low + BATCH_SIZE)
+
+
+def upgrade():
+    op.create_table('phenotype_definition',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('project_id', 'name', name='_pheno_def_uc')
+    )
+    op.add_column('phenotype', sa.Column('pheno_id', sa.Integer(), nullable=True))
+
+    conn = op.get_bind()
+    conn.execute(sa.text(
+        "INSERT INTO phenotype_definition (project_id, name) "
+        "SELECT DISTINCT individual.project_id, phenotype.name "
+        "FROM phenotype JOIN individual ON individual.id = phenotype.ind_id"))
+
+    batched_update(conn, sa.text(
+        "UPDATE phenotype SET pheno_id = ("
+        "SELECT phenotype_definition.id FROM phenotype_definition "
+        "JOIN individual ON individual.project_id = phenotype_definition.project_id "
+        "WHERE individual.id = phenotype.ind_id AND phenotype_definition.name = phenotype.name) "
+        "WHERE phenotype.id >= :low AND phenotype.id < :high"))
+
+    # The new unique constraint is created before the old one is dropped so that
+    # the foreign key on ind_id is always backed by an index
+    with op.batch_alter_table('phenotype') as batch_op:
+        batch_op.alter_column('pheno_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_foreign_key('fk_phenotype_pheno_id', 'phenotype_definition', ['pheno_id'], ['id'])
+        batch_op.create_unique_constraint('_pheno_id_uc', ['ind_id', 'pheno_id'])
+    with op.batch_alter_table('phenotype') as batch_op:
+        batch_op.drop_constraint('_pheno_uc', type_='unique')
+        batch_op.drop_column('name')
+
+
+def downgrade():
+    op.add_column('phenotype', sa.Column('name', sa.String(length=30), nullable=True))
+
+    conn = op.get_bind()
+    batched_update(conn, sa.text(
+        "UPDATE phenotype SET name = ("
+        "SELECT phenotype_definition.name FROM phenotype_definition "
+        "WHERE phenotype_definition.id = phenotype.pheno_id) "
+        "WHERE phenotype.id >= :low AND phenotype.id < :high"))
+
+    with op.batch_alter_table('phenotype') as batch_op:
+        batch_op.alter_column('name', existing_type=sa.String(length=30), nullable=False)
+        batch_op.create_unique_constraint('_pheno_uc', ['ind_id', 'name'])
+    with op.batch_alter_table('phenotype') as batch_op:
+        batch_op.drop_constraint('fk_phenotype_pheno_id', type_='foreignkey')
+        batch_op.drop_constraint('_pheno_id_uc', type_='unique')
+        batch_op.drop_column('pheno_id')
+    op.drop_table('phenotype_definition')
@@ -0,0 +1,51 @@
+"""Genotype tally table
+
+Revision ID: 5be08f3d1a72
+Revises: c27d90e4f5a1
+Create Date: 2026-10-19 16:40:52.730214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5be08f3d1a72'
+down_revision = 'c27d90e4f5a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('genotype_tally',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('marker_id', sa.Integer(), nullable=False),
+    sa.Column('call_1', sa.String(length=1), nullable=False),
+    sa.Column('call_2', sa.String(length=1), nullable=False),
+    sa.Column('n_genotypes', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['marker_id'], ['marker.id'], ),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('project_id', 'marker_id', 'call_1', 'call_2')
+    )
+
+    # Count the genotypes already stored, one project at a time. Explicitly missing
+    # calls were never stored, so there is nothing to backfill for them
+    conn = op.get_bind()
+    project_ids = [row[0] for row in conn.execute(sa.text("SELECT id FROM project"))]
+    for project_id in project_ids:
+        conn.execute(sa.text(
+            "INSERT INTO genotype_tally (project_id, marker_id, call_1, call_2, n_genotypes) "
+            "SELECT individual.project_id, genotype.marker_id, "
+            "CASE WHEN genotype.call_1 <= genotype.call_2 THEN genotype.call_1 ELSE genotype.call_2 END, "
+            "CASE WHEN genotype.call_1 <= genotype.call_2 THEN genotype.call_2 ELSE genotype.call_1 END, "
+            "COUNT(*) "
+            "FROM genotype JOIN individual ON individual.id = genotype.ind_id "
+            "WHERE individual.project_id = :project_id "
+            "GROUP BY individual.project_id, genotype.marker_id, "
+            "CASE WHEN genotype.call_1 <= genotype.call_2 THEN genotype.call_1 ELSE genotype.call_2 END, "
+            "CASE WHEN genotype.call_1 <= genotype.call_2 THEN genotype.call_2 ELSE genotype.call_1 END"),
+            project_id=project_id)
+
+
+def downgrade():
+    op.drop_table('genotype_tally')
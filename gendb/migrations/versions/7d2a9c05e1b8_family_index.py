@@ -0,0 +1,49 @@
+"""Family index table
+
+Revision ID: 7d2a9c05e1b8
+Revises: b83e2f6a4c19
+Create Date: 2026-10-19 21:15:36.552907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2a9c05e1b8'
+down_revision = 'b83e2f6a4c19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('family',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('clinic_id', sa.String(length=5), nullable=False),
+    sa.Column('family_id', sa.String(length=15), nullable=False),
+    sa.Column('father_id', sa.Integer(), nullable=True),
+    sa.Column('mother_id', sa.Integer(), nullable=True),
+    sa.Column('num_members', sa.Integer(), nullable=False),
+    sa.Column('num_children', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['father_id'], ['individual.id'], ),
+    sa.ForeignKeyConstraint(['mother_id'], ['individual.id'], ),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('project_id', 'clinic_id', 'family_id', name='_family_uc')
+    )
+
+    # Index the families of the individuals already stored
+    op.execute(
+        "INSERT INTO family (project_id, clinic_id, family_id, father_id, mother_id, num_members, num_children) "
+        "SELECT project_id, clinic_id, family_id, "
+        "MAX(CASE WHEN member_id = 1 THEN id END), "
+        "MAX(CASE WHEN member_id = 2 THEN id END), "
+        "COUNT(*), "
+        "SUM(CASE WHEN member_id NOT IN (1, 2) THEN 1 ELSE 0 END) "
+        "FROM individual "
+        "GROUP BY project_id, clinic_id, family_id")
+
+
+def downgrade():
+    op.drop_table('family')
@@ -0,0 +1,158 @@
+"""Integer surrogate keys for markers
+
+Revision ID: 8a4e6d21c0f3
+Revises: 3f1c2a9d7b64
+Create Date: 2026-10-19 11:03:17.529861
+
+The conversion is done online: the new integer columns are added as nullable
+and backfilled in primary key ranges, so no single statement has to rewrite the
+whole genotype table. Only the final constraint swap needs the tables briefly.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d21c0f3'
+down_revision = '3f1c2a9d7b64'
+branch_labels = None
+depends_on = None
+
+# Number of rows assigned or updated per statement during the backfill
+BATCH_SIZE = 50000
+
+
+def batched_update(conn, table, statement):
+    # Runs the given update over consecutive primary key ranges of an integer keyed table
+    max_id = conn.execute(sa.text("SELECT MAX(id) FROM {}".format(table))).scalar() or 0
+    for low in range(0, max_id + 1, BATCH_SIZE):
+        conn.execute(statement, low=low, high=low + BATCH_SIZE)
+
+
+def drop_marker_foreign_keys(conn, table):
+    # The original foreign keys were created without names, so look them up
+    if conn.dialect.name == 'sqlite':
+        # Batch mode recreates the table, dropping the column drops its foreign key
+        return
+    for fk in sa.inspect(conn).get_foreign_keys(table):
+        if fk['referred_table'] == 'marker':
+            op.drop_constraint(fk['name'], table, type_='foreignkey')
+
+
+def drop_primary_key(conn, batch_op):
+    # SQLite batch mode replaces the primary key when the table is recreated
+    if conn.dialect.name != 'sqlite':
+        batch_op.drop_constraint('PRIMARY', type_='primary')
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    # Number the existing markers, walking the string keys in order
+    op.add_column('marker', sa.Column('num_id', sa.Integer(), nullable=True))
+    next_id = 1
+    last_name = ''
+    while True:
+        names = [row[0] for row in conn.execute(
+            sa.text("SELECT id FROM marker WHERE id > :last ORDER BY id LIMIT :limit"),
+            last=last_name, limit=BATCH_SIZE)]
+        if not names:
+            break
+        conn.execute(sa.text("UPDATE marker SET num_id = :num_id WHERE id = :name"),
+                     [{'num_id': next_id + i, 'name': name} for i, name in enumerate(names)])
+        next_id += len(names)
+        last_name = names[-1]
+
+    op.add_column('genotype', sa.Column('marker_id', sa.Integer(), nullable=True))
+    op.add_column('marker_allele', sa.Column('marker_id', sa.Integer(), nullable=True))
+
+    batched_update(conn, 'genotype', sa.text(
+        "UPDATE genotype SET marker_id = ("
+        "SELECT marker.num_id FROM marker WHERE marker.id = genotype.marker) "
+        "WHERE genotype.id >= :low AND genotype.id < :high"))
+    conn.execute(sa.text(
+        "UPDATE marker_allele SET marker_id = ("
+        "SELECT marker.num_id FROM marker WHERE marker.id = marker_allele.marker)"))
+
+    # Swap the keys over, the marker table first so the new foreign keys have a target
+    drop_marker_foreign_keys(conn, 'genotype')
+    drop_marker_foreign_keys(conn, 'marker_allele')
+
+    # Renames are done in their own steps so each step refers to unambiguous column names
+    with op.batch_alter_table('marker') as batch_op:
+        drop_primary_key(conn, batch_op)
+        batch_op.alter_column('id', new_column_name='name',
+                              existing_type=sa.String(length=15), nullable=False)
+    with op.batch_alter_table('marker') as batch_op:
+        batch_op.alter_column('num_id', new_column_name='id',
+                              existing_type=sa.Integer(), nullable=False)
+    with op.batch_alter_table('marker') as batch_op:
+        batch_op.create_primary_key('pk_marker', ['id'])
+        batch_op.create_unique_constraint('uq_marker_name', ['name'])
+    if conn.dialect.name == 'mysql':
+        op.execute("ALTER TABLE marker MODIFY id INTEGER NOT NULL AUTO_INCREMENT")
+
+    with op.batch_alter_table('marker_allele') as batch_op:
+        drop_primary_key(conn, batch_op)
+        batch_op.drop_column('marker')
+        batch_op.alter_column('marker_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_marker_allele', ['marker_id', 'allele'])
+        batch_op.create_foreign_key('fk_marker_allele_marker_id', 'marker', ['marker_id'], ['id'])
+
+    # The new unique constraint is created before the old one is dropped so that
+    # the foreign key on ind_id is always backed by an index
+    with op.batch_alter_table('genotype') as batch_op:
+        batch_op.alter_column('marker_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_unique_constraint('_geno_id_uc', ['ind_id', 'marker_id'])
+        batch_op.create_foreign_key('fk_genotype_marker_id', 'marker', ['marker_id'], ['id'])
+    with op.batch_alter_table('genotype') as batch_op:
+        batch_op.drop_constraint('_geno_uc', type_='unique')
+        batch_op.drop_column('marker')
+
+
+def downgrade():
+    conn = op.get_bind()
+
+    op.add_column('genotype', sa.Column('marker', sa.String(length=20), nullable=True))
+    op.add_column('marker_allele', sa.Column('marker', sa.String(length=15), nullable=True))
+
+    batched_update(conn, 'genotype', sa.text(
+        "UPDATE genotype SET marker = ("
+        "SELECT marker.name FROM marker WHERE marker.id = genotype.marker_id) "
+        "WHERE genotype.id >= :low AND genotype.id < :high"))
+    conn.execute(sa.text(
+        "UPDATE marker_allele SET marker = ("
+        "SELECT marker.name FROM marker WHERE marker.id = marker_allele.marker_id)"))
+
+    with op.batch_alter_table('genotype') as batch_op:
+        batch_op.drop_constraint('fk_genotype_marker_id', type_='foreignkey')
+        batch_op.alter_column('marker', existing_type=sa.String(length=20), nullable=False)
+        batch_op.create_unique_constraint('_geno_uc', ['ind_id', 'marker'])
+    with op.batch_alter_table('genotype') as batch_op:
+        batch_op.drop_constraint('_geno_id_uc', type_='unique')
+        batch_op.drop_column('marker_id')
+
+    with op.batch_alter_table('marker_allele') as batch_op:
+        batch_op.drop_constraint('fk_marker_allele_marker_id', type_='foreignkey')
+        drop_primary_key(conn, batch_op)
+        batch_op.drop_column('marker_id')
+        batch_op.alter_column('marker', existing_type=sa.String(length=15), nullable=False)
+        batch_op.create_primary_key('pk_marker_allele', ['marker', 'allele'])
+
+    if conn.dialect.name == 'mysql':
+        op.execute("ALTER TABLE marker MODIFY id INTEGER NOT NULL")
+    with op.batch_alter_table('marker') as batch_op:
+        batch_op.drop_constraint('uq_marker_name', type_='unique')
+        drop_primary_key(conn, batch_op)
+        batch_op.drop_column('id')
+    with op.batch_alter_table('marker') as batch_op:
+        batch_op.alter_column('name', new_column_name='id',
+                              existing_type=sa.String(length=15), nullable=False)
+    with op.batch_alter_table('marker') as batch_op:
+        batch_op.create_primary_key('pk_marker', ['id'])
+
+    with op.batch_alter_table('marker_allele') as batch_op:
+        batch_op.create_foreign_key('fk_marker_allele_marker', 'marker', ['marker'], ['id'])
+    with op.batch_alter_table('genotype') as batch_op:
+        batch_op.create_foreign_key('fk_genotype_marker', 'marker', ['marker'], ['id'])
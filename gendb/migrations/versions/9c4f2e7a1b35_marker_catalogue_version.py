@@ -0,0 +1,31 @@
+"""Marker catalogue version
+
+Revision ID: 9c4f2e7a1b35
+Revises: f3a8d60b2c17
+Create Date: 2026-10-20 10:12:44.215093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4f2e7a1b35'
+down_revision = 'f3a8d60b2c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('marker_catalogue',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('last_marker_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO marker_catalogue (id, version, last_marker_id) "
+               "SELECT 1, 1, COALESCE(MAX(id), 0) FROM marker")
+
+
+def downgrade():
+    op.drop_table('marker_catalogue')
@@ -0,0 +1,24 @@
+"""Project individuals version
+
+Revision ID: a6d3f09c2e58
+Revises: 9c4f2e7a1b35
+Create Date: 2026-10-21 09:40:17.552301
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d3f09c2e58'
+down_revision = '9c4f2e7a1b35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('project', sa.Column('individuals_version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('project', 'individuals_version')
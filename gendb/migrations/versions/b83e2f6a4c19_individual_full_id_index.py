@@ -0,0 +1,24 @@
+"""Individual full ID index
+
+Revision ID: b83e2f6a4c19
+Revises: e5b7c1d94a20
+Create Date: 2026-10-19 20:41:53.106284
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83e2f6a4c19'
+down_revision = 'e5b7c1d94a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_individual_full_id', 'individual', ['clinic_id', 'family_id', 'member_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_individual_full_id', table_name='individual')
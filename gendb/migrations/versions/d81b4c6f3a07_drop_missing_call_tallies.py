@@ -0,0 +1,27 @@
+"""Drop missing call tallies
+
+Revision ID: d81b4c6f3a07
+Revises: a6d3f09c2e58
+Create Date: 2026-10-21 11:05:32.918640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81b4c6f3a07'
+down_revision = 'a6d3f09c2e58'
+branch_labels = None
+depends_on = None
+
+
+# Missing calls are no longer tallied, a marker's missing calls are the project's
+# individuals less its called genotypes
+def upgrade():
+    op.execute("DELETE FROM genotype_tally WHERE call_1 = 'x'")
+
+
+# The missing calls were never stored, so their counts cannot be restored
+def downgrade():
+    pass
@@ -0,0 +1,24 @@
+"""Project data version
+
+Revision ID: e5b7c1d94a20
+Revises: 5be08f3d1a72
+Create Date: 2026-10-19 18:12:07.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7c1d94a20'
+down_revision = '5be08f3d1a72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('project', sa.Column('data_version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('project', 'data_version')
@@ -0,0 +1,40 @@
+"""Upload state table
+
+Revision ID: f3a8d60b2c17
+Revises: 7d2a9c05e1b8
+Create Date: 2026-10-19 22:41:09.163582
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8d60b2c17'
+down_revision = '7d2a9c05e1b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('upload_type', sa.String(length=15), nullable=False),
+    sa.Column('digest', sa.String(length=40), nullable=False),
+    sa.Column('filename', sa.String(length=100), nullable=False),
+    sa.Column('user_email', sa.String(length=120), nullable=False),
+    sa.Column('total_rows', sa.Integer(), nullable=True),
+    sa.Column('committed_rows', sa.Integer(), nullable=False),
+    sa.Column('finished', sa.Boolean(), nullable=False),
+    sa.Column('started', sa.DateTime(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_upload_state_file', 'upload_state', ['project_id', 'upload_type', 'digest'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_upload_state_file', table_name='upload_state')
+    op.drop_table('upload_state')